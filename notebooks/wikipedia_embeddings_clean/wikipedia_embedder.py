@@ -19,6 +19,8 @@ class WikiEmbedder:
         pinecone_index_name: str,
         batch_size: int = 50,
         embedding_model: str = "multilingual-e5-large",
+        embedding_cache=None,
+        duplicates_path: str = None,
     ):
         self.input_parquet_path = input_parquet_path
         self.checkpoint_path = checkpoint_path
@@ -26,6 +28,14 @@ class WikiEmbedder:
         self.batch_size = batch_size
         self.embedding_model = embedding_model
 
+        # Optional EmbeddingCache (src/vectordb/embedding/embedding_cache.py),
+        # chunks whose text was embedded before are not sent to Pinecone again
+        self.embedding_cache = embedding_cache
+
+        # Optional duplicates.parquet of src/vectordb/dedup_stage.py, the
+        # near-duplicate chunks listed there are not embedded
+        self.duplicate_chunks = self._load_duplicates(duplicates_path)
+
         # Initialize Pinecone
         self.pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
         self.index = self.pc.Index(self.index_name)
@@ -61,6 +71,7 @@ class WikiEmbedder:
         def get_unprocessed_mask(row):
             return any(
                 (row["title_match"], chunk_idx) not in processed_chunks
+                and (row["title_match"], chunk_idx) not in self.duplicate_chunks
                 for chunk_idx in range(row["n_chunks"])
             )
 
@@ -82,6 +93,16 @@ class WikiEmbedder:
             return pd.read_parquet(self.checkpoint_path)
         return pd.DataFrame(columns=["title_match", "chunk_idx"])
 
+    def _load_duplicates(self, duplicates_path: str) -> set:
+        """Load the (title_match, chunk_idx) of near-duplicate chunks"""
+        if duplicates_path is None:
+            return set()
+        duplicates = pd.read_parquet(
+            duplicates_path, columns=["title_match", "chunk_idx"]
+        )
+        logging.info(f"Skipping {len(duplicates)} near-duplicate chunks")
+        return set(zip(duplicates["title_match"], duplicates["chunk_idx"]))
+
     def _save_checkpoint(self, new_chunks: pd.DataFrame):
         """Append new chunks to checkpoint and save"""
         self.processed_chunks = pd.concat([self.processed_chunks, new_chunks])
@@ -99,6 +120,9 @@ class WikiEmbedder:
                 # Skip if chunk already processed
                 if self._is_processed(row["title_match"], i):
                     continue
+                # Skip if chunk is a near-duplicate of a chunk that is embedded
+                if (row["title_match"], i) in self.duplicate_chunks:
+                    continue
 
                 chunk_text = row["split_text"][i]
                 prefix = prefix_template.format(title=row["title"].strip())
@@ -133,12 +157,28 @@ class WikiEmbedder:
         )
 
     def embed_chunks(self, df_to_embed: pd.DataFrame):
+        """Generate embeddings, from the embedding cache when one is given"""
+        texts = df_to_embed["chunk_text"].tolist()
+        if self.embedding_cache is None:
+            return self._embed_texts(texts)
+
+        # The cache key includes the input type, passages and queries embed differently
+        embeddings = self.embedding_cache.embed(
+            f"{self.embedding_model}:passage", texts, self._embed_texts
+        )
+        logging.info(
+            f"Embedding cache: {self.embedding_cache.hits} hits,"
+            f" {self.embedding_cache.misses} embedded so far"
+        )
+        return embeddings
+
+    def _embed_texts(self, texts: List[str]):
         """Generate embeddings in batches"""
         all_embeddings = []
 
-        for start_idx in range(0, len(df_to_embed), self.batch_size):
+        for start_idx in range(0, len(texts), self.batch_size):
             end_idx = start_idx + self.batch_size
-            batch_texts = df_to_embed["chunk_text"].iloc[start_idx:end_idx].tolist()
+            batch_texts = texts[start_idx:end_idx]
 
             batch_embeddings = self.pc.inference.embed(
                 model=self.embedding_model,
@@ -0,0 +1,361 @@
+"""
+Parity checks and throughput benchmarks for chunk_utils.split_text.
+
+Compares the span based splitter of chunk_utils against the langchain
+RecursiveCharacterTextSplitter implementation it replaced, on the articles
+of a Parquet file with a processed_text column (the output of
+select_articles.py) or on synthetic Wikipedia sized articles, and
+remove_html_tags against the full BeautifulSoup parse on the articles and
+a fixture corpus of HTML snippets. Chunks sized in tokens are checked to
+fit their chunk size and to have exact token counts, and, when transformers
+can load the embedding model's tokenizer, to fit its window with the title
+prefix.
+
+Usage (from src):
+    python -m vectordb.chunk_benchmark [articles.parquet] [n_articles]
+"""
+import random
+import sys
+import time
+import warnings
+from typing import List, Optional
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from vectordb.chunk_utils import (
+    SEPARATORS,
+    TOKEN_ENCODING,
+    chunk_spans,
+    chunk_spans_by_tokens,
+    get_encoding,
+    prepare_text,
+    remove_html_tags,
+    remove_html_tags_bs4,
+    split_text,
+)
+from vectordb.chunk_stage import EMBEDDING_MODEL, EMBEDDING_WINDOW_TOKENS
+
+# Settings of the final filtering notebooks
+CHUNK_SIZES = [1000, 1500, 2000]
+CHUNK_OVERLAP = 300
+DISCARD_CHUNK_N_WORDS_CUTOFF = 12
+MIN_WORDS_PER_CHUNK = 45
+
+# Token sizes of chunk_stage.py
+TOKEN_CHUNK_SIZES = [250, 300, 350]
+TOKEN_CHUNK_OVERLAP = 60
+
+# Text WikiEmbedder embeds for a chunk, "passage: " is the e5 input type
+# prefix. The title stands in for the article titles, which the benchmark
+# articles do not have, and is longer than most.
+EMBEDDED_CHUNK_TEMPLATE = (
+    "passage: This is text from the wikipedia article with title: '{title}'\n{chunk}"
+)
+WINDOW_CHECK_TITLE = "List of accidents and incidents involving commercial aircraft in Europe"
+
+N_SYNTHETIC_ARTICLES = 500
+
+N_HTML_FIXTURES = 20_000
+
+# Pieces of the HTML fixtures: tags bs4 treats specially (void, whitespace
+# preserving and string container tags), comments, declarations, entities
+# and broken markup
+HTML_PIECES = [
+    "<p>", "</p>", "<br>", "<br/>", "</br>", "<pre>", "</pre>", "<textarea>", "</textarea>",
+    "<script>", "</script>", "<style>", "</style>", "<template>", "</template>", "<rt>", "</rt>",
+    "<b class='x'>", "</b>", '<a href="x">', "</a>", "<img src=x>", "</img>",
+    "<table><tr><td>", "</td></tr></table>", "<!-- comment -->", "<!DOCTYPE html>",
+    "<![CDATA[x<y]]>", "<![if x]>", "<?pi x?>", "&amp;", "&lt;", "&nbsp;", "&#147;", "&#x41;",
+    "&#129;", "&#0;", "&#99999999;", "&foo;", "AT&T", "&", "<", ">", "< p", "x=1<2", "<div",
+    "</", "<!", "<!--", "&#", "  ", "\n", "\n\n", "\t", "\r\n", "\x0c", " ", "word", "Þórður",
+]
+
+
+def _combine_short_chunks_reference(chunks: List[str], min_words_per_chunk: int) -> List[str]:
+    combined_chunks = []
+    temp_chunk = ""
+
+    for chunk in chunks:
+        word_count = len(chunk.split())
+
+        if word_count < min_words_per_chunk:
+            if combined_chunks:
+                combined_chunks[-1] += " " + chunk
+            else:
+                temp_chunk += " " + chunk
+        else:
+            if temp_chunk:
+                combined_chunks.append(temp_chunk.strip() + " " + chunk)
+                temp_chunk = ""
+            else:
+                combined_chunks.append(chunk)
+
+    if temp_chunk:
+        if combined_chunks:
+            combined_chunks[-1] += " " + temp_chunk.strip()
+        else:
+            combined_chunks.append(temp_chunk.strip())
+
+    return combined_chunks
+
+
+def split_text_reference(
+    text: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    discard_chunk_n_words_cutoff: Optional[int] = None,
+    min_words_per_chunk: Optional[int] = None,
+) -> List[str]:
+    """
+    The langchain implementation of split_text, on an already prepared text.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        separators=SEPARATORS,
+    )
+
+    chunks = text_splitter.split_text(text)
+    if discard_chunk_n_words_cutoff is not None:
+        chunks = [
+            chunk
+            for chunk in chunks
+            if len(chunk.split()) >= discard_chunk_n_words_cutoff
+        ]
+
+    if min_words_per_chunk:
+        chunks = _combine_short_chunks_reference(chunks, min_words_per_chunk)
+
+    return chunks
+
+
+def synthetic_articles(n_articles: int, seed: int = 0) -> List[str]:
+    """
+    Articles of paragraphs and lists with a length distribution like
+    Wikipedia's, including very long words and blank lines to exercise
+    every separator.
+    """
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyzáðéíóúýþæö") for _ in range(rng.randint(1, 12)))
+        for _ in range(5000)
+    ]
+    articles = []
+    for _ in range(n_articles):
+        n_words = int(min(rng.paretovariate(1.2) * 300, 40_000))
+        paragraphs = []
+        while n_words > 0:
+            length = min(n_words, rng.randint(5, 250))
+            n_words -= length
+            words = [rng.choice(vocabulary) for _ in range(length)]
+            if rng.random() < 0.01:
+                words.append("x" * rng.randint(100, 3000))
+            paragraph = " ".join(words)
+            if rng.random() < 0.2:
+                paragraph = "\n".join(f"* {item}" for item in paragraph.split(", ")[:20])
+                paragraph = paragraph.replace(" ab", "\n ab")
+            paragraphs.append(paragraph)
+        articles.append(rng.choice(["\n\n", "\n\n\n", "\n"]).join(paragraphs))
+    return articles
+
+
+def html_fixtures(n_fixtures: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(HTML_PIECES) for _ in range(rng.randint(0, 25)))
+        for _ in range(n_fixtures)
+    ]
+
+
+def load_articles(input_file: str, n_articles: Optional[int] = None) -> List[str]:
+    import pyarrow.parquet as pq
+
+    texts = pq.read_table(input_file, columns=["processed_text"]).column("processed_text")
+    texts = [text for text in texts.to_pylist() if text]
+    return texts[:n_articles] if n_articles else texts
+
+
+def check_parity(texts: List[str]) -> int:
+    """
+    Compare both splitters on every text and chunk size with and without
+    the discard and combine steps. Returns the number of mismatches.
+    """
+    mismatches = 0
+    settings = [(None, None), (DISCARD_CHUNK_N_WORDS_CUTOFF, MIN_WORDS_PER_CHUNK)]
+    for i, text in enumerate(texts):
+        for chunk_size in CHUNK_SIZES + [50, 200]:
+            overlap = min(CHUNK_OVERLAP, chunk_size // 2)
+            for cutoff, min_words in settings:
+                expected = split_text_reference(text, chunk_size, overlap, cutoff, min_words)
+                chunks = chunk_spans(text, chunk_size, overlap, cutoff, min_words)
+                got = [chunk.materialize(text) for chunk in chunks]
+                word_counts = [len(chunk.split()) for chunk in got]
+                if got != expected or word_counts != [chunk.word_count for chunk in chunks]:
+                    mismatches += 1
+                    print(f"Mismatch: article {i}, chunk size {chunk_size}, cutoff {cutoff}")
+    return mismatches
+
+
+def check_token_budget(texts: List[str], encoding_name: str = TOKEN_ENCODING) -> int:
+    """
+    Chunk every text in tokens of encoding_name, with and without the
+    discard and combine steps, and check that no chunk is over its chunk
+    size and that every token_count is exact. Returns the number of
+    articles with a chunk over its size or a wrong count.
+    """
+    encoding = get_encoding(encoding_name)
+    chunk_sizes = [TOKEN_CHUNK_SIZES[i % len(TOKEN_CHUNK_SIZES)] for i in range(len(texts))]
+    settings = [(None, None), (DISCARD_CHUNK_N_WORDS_CUTOFF, MIN_WORDS_PER_CHUNK)]
+    failures = 0
+    for cutoff, min_words in settings:
+        article_chunks = chunk_spans_by_tokens(
+            texts, chunk_sizes, TOKEN_CHUNK_OVERLAP, cutoff, min_words, encoding_name
+        )
+        for i, (text, chunk_size, chunks) in enumerate(zip(texts, chunk_sizes, article_chunks)):
+            token_counts = [
+                len(encoding.encode_ordinary(chunk.materialize(text))) for chunk in chunks
+            ]
+            if token_counts != [chunk.token_count for chunk in chunks] or (
+                token_counts and max(token_counts) > chunk_size
+            ):
+                failures += 1
+                print(f"Token budget: article {i}, chunk size {chunk_size}, cutoff {cutoff}")
+    return failures
+
+
+def check_model_window(
+    texts: List[str],
+    model_name: str = EMBEDDING_MODEL,
+    window_tokens: int = EMBEDDING_WINDOW_TOKENS,
+    encoding_name: str = TOKEN_ENCODING,
+) -> Optional[int]:
+    """
+    Chunk every text at the largest token chunk size and count the tokens of
+    every chunk, as embedded with the title prefix, with the tokenizer of
+    model_name. Returns the number of chunks over window_tokens, or None when
+    the tokenizer can not be loaded.
+    """
+    try:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+    except Exception as e:
+        print(f"Model window: skipped, can not load the {model_name} tokenizer ({e})")
+        return None
+
+    chunk_size = max(TOKEN_CHUNK_SIZES)
+    article_chunks = chunk_spans_by_tokens(
+        texts,
+        [chunk_size] * len(texts),
+        TOKEN_CHUNK_OVERLAP,
+        DISCARD_CHUNK_N_WORDS_CUTOFF,
+        MIN_WORDS_PER_CHUNK,
+        encoding_name,
+    )
+    embedded = [
+        EMBEDDED_CHUNK_TEMPLATE.format(title=WINDOW_CHECK_TITLE, chunk=chunk.materialize(text))
+        for text, chunks in zip(texts, article_chunks)
+        for chunk in chunks
+    ]
+    model_counts = [len(ids) for ids in tokenizer(embedded)["input_ids"]]
+    if not model_counts:
+        return 0
+    over = sum(count > window_tokens for count in model_counts)
+    model_counts.sort()
+    print(
+        f"Model window: {len(model_counts)} chunks of {chunk_size} {encoding_name} tokens take"
+        f" {model_counts[len(model_counts) // 2]} (median) to {model_counts[-1]} (max)"
+        f" {model_name} tokens with the prefix, {over} over {window_tokens}"
+    )
+    return over
+
+
+def check_html_parity(texts: List[str]) -> int:
+    """
+    Compare remove_html_tags with the BeautifulSoup parse on every text,
+    including the errors raised. Returns the number of mismatches.
+    """
+    mismatches = 0
+    for i, text in enumerate(texts):
+        results = []
+        for remove in (remove_html_tags_bs4, remove_html_tags):
+            try:
+                results.append(remove(text))
+            except Exception as e:
+                results.append(type(e))
+        if results[0] != results[1]:
+            mismatches += 1
+            print(f"HTML mismatch: text {i} {text[:80]!r}")
+    return mismatches
+
+
+def benchmark_html(texts: List[str], name: str):
+    for engine, remove in (("bs4", remove_html_tags_bs4), ("fast", remove_html_tags)):
+        start = time.perf_counter()
+        for text in texts:
+            remove(text)
+        elapsed = time.perf_counter() - start
+        print(f"{name} {engine:>4}: {len(texts) / elapsed:,.0f} texts/s")
+
+
+def benchmark(texts: List[str]):
+    n_characters = sum(len(text) for text in texts)
+    engines = [
+        ("langchain", split_text_reference),
+        ("spans", lambda text, *args: [c.materialize(text) for c in chunk_spans(text, *args)]),
+        ("spans only", chunk_spans),
+    ]
+    for name, split in engines:
+        n_chunks = 0
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            chunk_size = CHUNK_SIZES[i % len(CHUNK_SIZES)]
+            chunks = split(
+                text, chunk_size, CHUNK_OVERLAP, DISCARD_CHUNK_N_WORDS_CUTOFF, MIN_WORDS_PER_CHUNK
+            )
+            n_chunks += len(chunks)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>10}: {n_chunks} chunks in {elapsed:.2f}s,"
+            f" {n_chunks / elapsed:,.0f} chunks/s, {n_characters / elapsed / 1e6:.1f} M chars/s"
+        )
+
+    # End to end, including the HTML and whitespace cleaning of split_text
+    start = time.perf_counter()
+    n_chunks = sum(
+        len(split_text(text, 1500, CHUNK_OVERLAP, DISCARD_CHUNK_N_WORDS_CUTOFF,
+                       min_words_per_chunk=MIN_WORDS_PER_CHUNK))
+        for text in texts
+    )
+    elapsed = time.perf_counter() - start
+    print(f"split_text: {n_chunks} chunks in {elapsed:.2f}s, {n_chunks / elapsed:,.0f} chunks/s")
+
+
+def main():
+    # bs4 warns about fixtures that look like file names or URLs
+    warnings.simplefilter("ignore")
+    if len(sys.argv) > 1:
+        n_articles = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        texts = load_articles(sys.argv[1], n_articles)
+    else:
+        texts = synthetic_articles(N_SYNTHETIC_ARTICLES)
+    fixtures = html_fixtures(N_HTML_FIXTURES)
+    mismatches = check_html_parity(texts + fixtures)
+    print(f"HTML parity: {mismatches} mismatches")
+    benchmark_html(texts, "articles")
+    benchmark_html(fixtures, "fixtures")
+
+    texts = [prepare_text(text) for text in texts]
+    print(f"{len(texts)} articles, {sum(len(text) for text in texts) / 1e6:.1f} M characters")
+
+    mismatches = check_parity(texts[:200])
+    print(f"Parity: {mismatches} mismatches")
+    failures = check_token_budget(texts)
+    print(f"Token budget: {failures} articles with chunks over their size")
+    check_model_window(texts)
+    benchmark(texts)
+
+
+if __name__ == "__main__":
+    main()
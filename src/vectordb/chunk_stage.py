@@ -0,0 +1,239 @@
+"""
+Parallel, streaming chunking of the selected articles into chunk shards.
+
+Articles are streamed from DuckDB in batches, every batch is split by a
+worker process with chunk_utils.chunk_spans and written as one Parquet shard
+with a row per chunk:
+
+    page_id, title_match, title, url, chunk_idx, chunk_text, word_count, chunk_size, token_count
+
+With a token_encoding, chunk sizes and overlap are in tiktoken tokens
+instead of characters and token_count is the number of tokens of every
+chunk, so the embedding cost is known before embedding. These are not the
+embedding model's tokens, the sizes only leave a margin below its window
+(see TOKEN_CHUNK_SIZE_RANGE, checked by chunk_benchmark.check_model_window).
+
+Only a few batches are in flight at a time, so memory stays bounded however
+many articles are chunked. The shards are read back with
+read_parquet('<output_dir>/*.parquet').
+
+Usage (from src):
+    python -m vectordb.chunk_stage <selected_articles.parquet> <output_dir> [token_encoding]
+"""
+import os
+import random
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, Optional, Tuple
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from vectordb.chunk_utils import chunk_spans, chunk_spans_by_tokens, prepare_text
+
+# Every article gets a chunk size drawn from this range, seeded by its
+# page_id so reruns produce the same chunks
+CHUNK_SIZE_RANGE = (1000, 2000)
+CHUNK_OVERLAP = 300
+DISCARD_CHUNK_N_WORDS_CUTOFF = 12
+MIN_WORDS_PER_CHUNK = 45
+
+# Token window of multilingual-e5-large (XLM-R SentencePiece tokens, longer
+# inputs are truncated) and the model it is checked with
+EMBEDDING_MODEL = "intfloat/multilingual-e5-large"
+EMBEDDING_WINDOW_TOKENS = 512
+
+# Chunk sizes and overlap in tokens of the token_encoding (cl100k_base), not
+# of the model. Chunks never exceed their chunk size (see
+# chunk_utils.chunk_spans_by_tokens), the largest size leaves a margin of 30%
+# of the window for the title prefix WikiEmbedder puts before every chunk and
+# for chunks that take more model tokens than cl100k_base tokens. Check it on
+# the selected articles with chunk_benchmark.check_model_window when changing it.
+TOKEN_CHUNK_SIZE_RANGE = (250, 350)
+TOKEN_CHUNK_OVERLAP = 60
+
+# Articles per batch and shard
+ARTICLES_PER_SHARD = 2000
+
+NUM_WORKERS = os.cpu_count()
+
+# Batches read ahead of the workers, per worker
+BATCHES_IN_FLIGHT_PER_WORKER = 2
+
+ARTICLE_COLUMNS = ["page_id", "title_match", "title", "url", "processed_text"]
+
+CHUNK_SCHEMA = pa.schema(
+    [
+        ("page_id", pa.int64()),
+        ("title_match", pa.string()),
+        ("title", pa.string()),
+        ("url", pa.string()),
+        ("chunk_idx", pa.int32()),
+        ("chunk_text", pa.string()),
+        ("word_count", pa.int32()),
+        ("chunk_size", pa.int32()),
+        ("token_count", pa.int32()),
+    ]
+)
+
+
+def chunk_size_for(page_id: int, chunk_size_range: Tuple[int, int] = CHUNK_SIZE_RANGE) -> int:
+    """Chunk size of an article, random across articles but fixed per page_id."""
+    return random.Random(page_id).randint(*chunk_size_range)
+
+
+def iter_article_batches(
+    source: str,
+    database_file: Optional[str] = None,
+    batch_rows: int = ARTICLES_PER_SHARD,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the articles of source, a table, view or table function such as
+    read_parquet('selected.parquet'), as Arrow batches of batch_rows.
+    """
+    conn = duckdb.connect(database_file or ":memory:", read_only=database_file is not None)
+    reader = conn.execute(
+        f"SELECT {', '.join(ARTICLE_COLUMNS)} FROM {source}"
+    ).fetch_record_batch(batch_rows)
+    try:
+        yield from reader
+    finally:
+        conn.close()
+
+
+def chunk_batch(
+    batch: pa.RecordBatch,
+    shard_path: str,
+    chunk_size_range: Tuple[int, int] = CHUNK_SIZE_RANGE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    token_encoding: Optional[str] = None,
+    tokenizer_threads: int = 1,
+) -> Tuple[int, int, int]:
+    """
+    Split the articles of batch and write their chunks to shard_path, sized
+    in tokens of token_encoding if given. Returns the number of articles,
+    chunks and tokens.
+    """
+    articles = batch.to_pylist()
+    texts = [prepare_text(article["processed_text"]) for article in articles]
+    chunk_sizes = [chunk_size_for(article["page_id"], chunk_size_range) for article in articles]
+    if token_encoding is not None:
+        article_chunks = chunk_spans_by_tokens(
+            texts,
+            chunk_sizes,
+            chunk_overlap,
+            DISCARD_CHUNK_N_WORDS_CUTOFF,
+            MIN_WORDS_PER_CHUNK,
+            encoding_name=token_encoding,
+            num_threads=tokenizer_threads,
+        )
+    else:
+        article_chunks = [
+            chunk_spans(
+                text,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                discard_chunk_n_words_cutoff=DISCARD_CHUNK_N_WORDS_CUTOFF,
+                min_words_per_chunk=MIN_WORDS_PER_CHUNK,
+            )
+            for text, chunk_size in zip(texts, chunk_sizes)
+        ]
+
+    columns = {name: [] for name in CHUNK_SCHEMA.names}
+    for article, text, chunk_size, chunks in zip(articles, texts, chunk_sizes, article_chunks):
+        for chunk_idx, chunk in enumerate(chunks):
+            for name in ("page_id", "title_match", "title", "url"):
+                columns[name].append(article[name])
+            columns["chunk_idx"].append(chunk_idx)
+            columns["chunk_text"].append(chunk.materialize(text))
+            columns["word_count"].append(chunk.word_count)
+            columns["chunk_size"].append(chunk_size)
+            columns["token_count"].append(chunk.token_count)
+
+    table = pa.Table.from_pydict(columns, schema=CHUNK_SCHEMA)
+    pq.write_table(table, shard_path + ".tmp", compression="zstd")
+    os.replace(shard_path + ".tmp", shard_path)
+    n_tokens = sum(token_count or 0 for token_count in columns["token_count"])
+    return batch.num_rows, table.num_rows, n_tokens
+
+
+def run_chunk_stage(
+    source: str,
+    output_dir: str,
+    database_file: Optional[str] = None,
+    num_workers: int = NUM_WORKERS,
+    chunk_size_range: Tuple[int, int] = CHUNK_SIZE_RANGE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    token_encoding: Optional[str] = None,
+) -> Tuple[int, int]:
+    """
+    Chunk all articles of source into Parquet shards in output_dir, which is
+    emptied first. chunk_size_range and chunk_overlap are in tokens of
+    token_encoding if given. Returns the number of articles and chunks.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    n_articles = n_chunks = n_tokens = 0
+    max_in_flight = num_workers * BATCHES_IN_FLIGHT_PER_WORKER
+    # The cores left over by the workers tokenize in threads
+    tokenizer_threads = max(1, os.cpu_count() // num_workers)
+
+    def collect(done):
+        nonlocal n_articles, n_chunks, n_tokens
+        for future in done:
+            articles, chunks, tokens = future.result()
+            n_articles += articles
+            n_chunks += chunks
+            n_tokens += tokens
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = set()
+        batches = iter_article_batches(source, database_file)
+        for shard_idx, batch in enumerate(batches):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            shard_path = os.path.join(output_dir, f"chunks-{shard_idx:06d}.parquet")
+            in_flight.add(
+                executor.submit(
+                    chunk_batch,
+                    batch,
+                    shard_path,
+                    chunk_size_range,
+                    chunk_overlap,
+                    token_encoding,
+                    tokenizer_threads,
+                )
+            )
+        collect(wait(in_flight).done)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Chunked {n_articles} articles into {n_chunks} chunks in {elapsed:.1f}s"
+        f" ({n_articles / max(elapsed, 1e-9):.0f} articles/s)"
+    )
+    if token_encoding is not None:
+        print(f"{n_tokens} {token_encoding} tokens to embed")
+    return n_articles, n_chunks
+
+
+def main():
+    input_file, output_dir = sys.argv[1], sys.argv[2]
+    if len(sys.argv) > 3:
+        run_chunk_stage(
+            f"read_parquet('{input_file}')",
+            output_dir,
+            chunk_size_range=TOKEN_CHUNK_SIZE_RANGE,
+            chunk_overlap=TOKEN_CHUNK_OVERLAP,
+            token_encoding=sys.argv[3],
+        )
+    else:
+        run_chunk_stage(f"read_parquet('{input_file}')", output_dir)
+
+
+if __name__ == "__main__":
+    main()
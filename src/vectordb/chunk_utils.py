@@ -1,9 +1,30 @@
+import bisect
+import collections
+import functools
 import hashlib
+import itertools
 import re
-from typing import List, Dict, Optional
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from html.parser import HTMLParser
+from typing import List, Dict, NamedTuple, Optional, Tuple
 import pydantic
+import tiktoken
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution
+
+
+# Separators of the recursive splitter, tried in order
+SEPARATORS = ["\n\n", "\n", " ", ""]
+
+# tiktoken encoding of chunks sized in tokens, and the threads encoding a
+# batch of texts
+TOKEN_ENCODING = "cl100k_base"
+TOKENIZER_THREADS = 8
+
+# UTF-8 bytes that continue a multi byte character
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+Span = Tuple[int, int]
 
 
 class Chunk(pydantic.BaseModel):
@@ -18,9 +39,141 @@ class Chunk(pydantic.BaseModel):
     vector: Optional[List[float]] = None
 
 
+class _TextExtractor(HTMLParser):
+    """
+    The text BeautifulSoup(text, "html.parser").get_text(separator=" ") returns,
+    without building the tree: the same parser events are turned into the
+    strings bs4 would store, following its rules for joining data,
+    collapsing whitespace only strings and leaving out comments,
+    declarations and the contents of script, style, template, rt and rp.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.strings = []
+        self.already_closed_empty_element = []
+        self._current_data = []
+        self._tag_stack = []
+        self._open_tag_counter = collections.Counter()
+        self._preserve_whitespace_depth = 0
+        self._string_container_depth = 0
+
+    def _end_data(self, string_type: Optional[str] = None) -> None:
+        """string_type: None for text, "cdata" for CDATA, "other" for strings get_text skips."""
+        if not self._current_data:
+            return
+        data = "".join(self._current_data)
+        self._current_data = []
+        if not self._preserve_whitespace_depth and not data.strip(BeautifulSoup.ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if string_type == "cdata" or (string_type is None and not self._string_container_depth):
+            self.strings.append(data)
+
+    def _push_tag(self, name: str) -> None:
+        preserve_whitespace = name in HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+        string_container = name in HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS
+        self._tag_stack.append((name, preserve_whitespace, string_container))
+        self._open_tag_counter[name] += 1
+        self._preserve_whitespace_depth += preserve_whitespace
+        self._string_container_depth += string_container
+
+    def _pop_to_tag(self, name: str) -> None:
+        while self._open_tag_counter[name]:
+            popped, preserve_whitespace, string_container = self._tag_stack.pop()
+            self._open_tag_counter[popped] -= 1
+            self._preserve_whitespace_depth -= preserve_whitespace
+            self._string_container_depth -= string_container
+            if popped == name:
+                break
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, handle_empty_element=False)
+        self.handle_endtag(name)
+
+    def handle_starttag(self, name, attrs, handle_empty_element=True):
+        self._end_data()
+        self._push_tag(name)
+        if handle_empty_element and name in HTMLTreeBuilder.empty_element_tags:
+            self.handle_endtag(name, check_already_closed=False)
+            self.already_closed_empty_element.append(name)
+
+    def handle_endtag(self, name, check_already_closed=True):
+        if check_already_closed and name in self.already_closed_empty_element:
+            self.already_closed_empty_element.remove(name)
+        else:
+            self._end_data()
+            self._pop_to_tag(name)
+
+    def handle_data(self, data):
+        self._current_data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith(("x", "X")):
+            code_point = int(name.lstrip("xX"), 16)
+        else:
+            code_point = int(name)
+        data = None
+        if code_point < 256:
+            # Like bs4, read low references as Windows-1252 (&#147; is a quotation mark)
+            try:
+                data = bytearray([code_point]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(code_point)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data):
+        self._end_data()
+        self.handle_data(data)
+        self._end_data("other")
+
+    def handle_decl(self, data):
+        self._end_data()
+        self.handle_data(data)
+        self._end_data("other")
+
+    def unknown_decl(self, data):
+        self._end_data()
+        if data.upper().startswith("CDATA["):
+            self.handle_data(data[len("CDATA[") :])
+            self._end_data("cdata")
+        else:
+            self.handle_data(data)
+            self._end_data("other")
+
+    def handle_pi(self, data):
+        self._end_data()
+        self.handle_data(data)
+        self._end_data("other")
+
+    def get_text(self, text: str) -> str:
+        self.feed(text)
+        self.close()
+        self._end_data()
+        return " ".join(self.strings)
+
+
+def remove_html_tags_bs4(text: str) -> str:
+    """remove_html_tags with a full BeautifulSoup parse, kept as its reference."""
+    soup = BeautifulSoup(text, "html.parser")
+    return soup.get_text(separator=" ")
+
+
 def remove_html_tags(text: str) -> str:
     """
-    Remove HTML tags from the provided text using BeautifulSoup.
+    Remove HTML tags from the provided text, with the same result as
+    BeautifulSoup(text, "html.parser").get_text(separator=" ").
+
+    Text without tags or entities, most Wikipedia text, is returned as it
+    is, other text is streamed through html.parser without building a tree.
 
     Args:
         text (str): The text containing HTML content.
@@ -28,8 +181,15 @@ def remove_html_tags(text: str) -> str:
     Returns:
         str: The sanitized text without HTML tags.
     """
-    soup = BeautifulSoup(text, "html.parser")
-    return soup.get_text(separator=" ")
+    if "<" not in text and "&" not in text:
+        if text and not text.strip(BeautifulSoup.ASCII_SPACES):
+            return "\n" if "\n" in text else " "
+        return text
+    try:
+        return _TextExtractor().get_text(text)
+    except AssertionError:
+        # html.parser rejects the markup, let bs4 raise its error for it
+        return remove_html_tags_bs4(text)
 
 
 def generate_source_id(source_title: str, source_url: str) -> str:
@@ -57,82 +217,417 @@ def normalize_whitespace(text: str) -> str:
     return text
 
 
-def _combine_short_chunks(chunks: List[str], min_words_per_chunk: int) -> List[str]:
-    combined_chunks = []
-    temp_chunk = ""
+class ChunkSpans(NamedTuple):
+    """
+    A chunk as (start, end) character spans into the text it was split from,
+    one span unless short chunks were combined, with its number of words
+    and, when sized in tokens, of tokens.
+    """
 
-    for chunk in chunks:
-        word_count = len(chunk.split())
+    spans: Tuple[Span, ...]
+    word_count: int
+    token_count: Optional[int] = None
 
-        if word_count < min_words_per_chunk:
-            if combined_chunks:
-                # Merge with the last chunk in combined_chunks
-                combined_chunks[-1] += " " + chunk
-            else:
-                # If there is no previous chunk, store in temp_chunk
-                temp_chunk += " " + chunk
-        else:
-            if temp_chunk:
-                # Merge the temp_chunk with the current chunk
-                combined_chunks.append(temp_chunk.strip() + " " + chunk)
-                temp_chunk = ""
-            else:
-                combined_chunks.append(chunk)
+    def materialize(self, text: str) -> str:
+        return " ".join(text[start:end] for start, end in self.spans)
 
-    # If there's any remaining temp_chunk, append it to the last chunk
-    if temp_chunk:
-        if combined_chunks:
-            combined_chunks[-1] += " " + temp_chunk.strip()
-        else:
-            combined_chunks.append(temp_chunk.strip())
 
-    return combined_chunks
+def _strip_span(text: str, start: int, end: int) -> Span:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
 
 
-def split_text(
+def _separator_splits(text: str, start: int, end: int, separator: str) -> List[Span]:
+    """
+    Split text[start:end] before every occurrence of separator, each split
+    keeps the separator it starts with. Splits into characters when the
+    separator is empty.
+    """
+    if not separator:
+        return [(i, i + 1) for i in range(start, end)]
+    splits = []
+    split_start = start
+    position = text.find(separator, start, end)
+    while position != -1:
+        if position > split_start:
+            splits.append((split_start, position))
+            split_start = position
+        position = text.find(separator, position + len(separator), end)
+    splits.append((split_start, end))
+    return splits
+
+
+def _span_length(start: int, end: int, token_starts: Optional[List[int]]) -> int:
+    """Characters of a span, or tokens starting in it given token_starts."""
+    if token_starts is None:
+        return end - start
+    return bisect.bisect_left(token_starts, end) - bisect.bisect_left(token_starts, start)
+
+
+def _merge_splits(
     text: str,
+    splits: List[Span],
     chunk_size: int,
     chunk_overlap: int,
-    discard_chunk_n_words_cutoff: Optional[int] = None,
-    clean_whitespace: bool = True,
-    clean_html: bool = True,
-    min_words_per_chunk: Optional[int] = None,
-) -> List[str]:
+    chunks: List[Span],
+    token_starts: Optional[List[int]] = None,
+) -> None:
     """
-    Split text into chunks using RecursiveCharacterTextSplitter.
+    Merge consecutive splits into chunks of at most chunk_size characters
+    (or tokens), starting every chunk with up to chunk_overlap of the
+    previous one, and append their whitespace stripped spans to chunks.
+    """
+    current = collections.deque()
+    lengths = collections.deque()
+    total = 0
+    for start, end in splits:
+        length = _span_length(start, end, token_starts)
+        if total + length > chunk_size and current:
+            chunk = _strip_span(text, current[0][0], current[-1][1])
+            if chunk[0] < chunk[1]:
+                chunks.append(chunk)
+            while total > chunk_overlap or (total + length > chunk_size and total > 0):
+                current.popleft()
+                total -= lengths.popleft()
+        current.append((start, end))
+        lengths.append(length)
+        total += length
+    if current:
+        chunk = _strip_span(text, current[0][0], current[-1][1])
+        if chunk[0] < chunk[1]:
+            chunks.append(chunk)
+
+
+def _split_spans(
+    text: str,
+    start: int,
+    end: int,
+    separators: List[str],
+    chunk_size: int,
+    chunk_overlap: int,
+    chunks: List[Span],
+    token_starts: Optional[List[int]] = None,
+) -> None:
+    separator = separators[-1]
+    new_separators = []
+    for i, candidate in enumerate(separators):
+        if candidate == "":
+            separator = candidate
+            break
+        if text.find(candidate, start, end) != -1:
+            separator = candidate
+            new_separators = separators[i + 1 :]
+            break
+
+    good_splits = []
+    for split_start, split_end in _separator_splits(text, start, end, separator):
+        if _span_length(split_start, split_end, token_starts) < chunk_size:
+            good_splits.append((split_start, split_end))
+            continue
+        if good_splits:
+            _merge_splits(text, good_splits, chunk_size, chunk_overlap, chunks, token_starts)
+            good_splits = []
+        if not new_separators:
+            chunks.append((split_start, split_end))
+        else:
+            _split_spans(
+                text,
+                split_start,
+                split_end,
+                new_separators,
+                chunk_size,
+                chunk_overlap,
+                chunks,
+                token_starts,
+            )
+    if good_splits:
+        _merge_splits(text, good_splits, chunk_size, chunk_overlap, chunks, token_starts)
 
-    discard_chunk_n_words_cutoff: If set, discard chunks with less than this number of words.
 
-    min_words_per_chunk: If set, combine chunks with less than this number of words.
+def split_spans(
+    text: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    separators: List[str] = SEPARATORS,
+    token_starts: Optional[List[int]] = None,
+) -> List[Span]:
+    """
+    Split text recursively by separators into chunks of at most chunk_size
+    characters overlapping by up to chunk_overlap, returned as (start, end)
+    spans. Produces the chunks of langchain's RecursiveCharacterTextSplitter
+    with length_function=len, without copying the text.
+
+    Given the token_starts of the text, chunk_size and chunk_overlap are in
+    tokens, a split counting the tokens that start in it.
+    """
+    chunks = []
+    _split_spans(
+        text, 0, len(text), separators, chunk_size, chunk_overlap, chunks, token_starts
+    )
+    return chunks
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = TOKEN_ENCODING) -> tiktoken.Encoding:
+    """The tiktoken encoding encoding_name, loaded once per process."""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def token_starts(encoding: tiktoken.Encoding, text: str, tokens: List[int]) -> List[int]:
+    """
+    Character offsets in text where its tokens start. A token starting
+    inside a multi byte character starts at that character.
+    """
+    token_bytes = encoding.decode_tokens_bytes(tokens)
+    if text.isascii():
+        return list(itertools.accumulate(map(len, token_bytes), initial=0))[:-1]
+    starts = []
+    n_characters = 0
+    for token in token_bytes:
+        starts.append(max(0, n_characters - (0x80 <= token[0] < 0xC0)))
+        n_characters += len(token.translate(None, _CONTINUATION_BYTES))
+    return starts
+
+
+def _chunk_length(chunk: ChunkSpans, token_starts: Optional[List[int]]) -> int:
+    return sum(_span_length(start, end, token_starts) for start, end in chunk.spans)
+
+
+def _combine_short_chunks(
+    chunks: List[ChunkSpans],
+    min_words_per_chunk: int,
+    max_length: Optional[int] = None,
+    token_starts: Optional[List[int]] = None,
+) -> List[ChunkSpans]:
+    """
+    Append every chunk with less than min_words_per_chunk words to the
+    previous chunk, or to the next one at the start of the text.
+
+    Given max_length, chunks are only combined while the result has at most
+    max_length characters (or tokens given token_starts), a short chunk that
+    does not fit stays a chunk of its own.
     """
+    combined_chunks = []
+    lengths = []
+    leading_chunks = []
+    leading_length = 0
+
+    def fits(length: int, added: int) -> bool:
+        return max_length is None or length + added <= max_length
+
+    for chunk in chunks:
+        length = _chunk_length(chunk, token_starts)
+        if chunk.word_count < min_words_per_chunk:
+            if not combined_chunks and not fits(leading_length, length):
+                combined_chunks.append(leading_chunks)
+                lengths.append(leading_length)
+                leading_chunks, leading_length = [], 0
+            if combined_chunks and fits(lengths[-1], length):
+                combined_chunks[-1].append(chunk)
+                lengths[-1] += length
+            elif combined_chunks:
+                combined_chunks.append([chunk])
+                lengths.append(length)
+            else:
+                leading_chunks.append(chunk)
+                leading_length += length
+        else:
+            if leading_chunks and not fits(leading_length, length):
+                combined_chunks.append(leading_chunks)
+                lengths.append(leading_length)
+                leading_chunks, leading_length = [], 0
+            combined_chunks.append(leading_chunks + [chunk])
+            lengths.append(leading_length + length)
+            leading_chunks, leading_length = [], 0
+
+    if leading_chunks:
+        combined_chunks.append(leading_chunks)
+
+    return [
+        ChunkSpans(
+            tuple(span for chunk in group for span in chunk.spans),
+            sum(chunk.word_count for chunk in group),
+        )
+        for group in combined_chunks
+    ]
 
+
+def prepare_text(text: str, clean_whitespace: bool = True, clean_html: bool = True) -> str:
+    """The text split_text splits, with HTML tags removed and whitespace normalized."""
     if clean_html:
         text = remove_html_tags(text)
 
     if clean_whitespace:
         text = normalize_whitespace(text)
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        separators=["\n\n", "\n", " ", ""],
-    )
+    return text
+
 
-    chunks = text_splitter.split_text(text)
+def chunk_spans(
+    text: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    discard_chunk_n_words_cutoff: Optional[int] = None,
+    min_words_per_chunk: Optional[int] = None,
+    token_starts: Optional[List[int]] = None,
+) -> List[ChunkSpans]:
+    """
+    Split an already prepared text into chunks as spans with their word
+    counts, see split_text. The words of every chunk are counted once.
+    chunk_size and chunk_overlap are in tokens given token_starts, and short
+    chunks are then only combined within chunk_size.
+    """
+    chunks = [
+        ChunkSpans(((start, end),), len(text[start:end].split()))
+        for start, end in split_spans(
+            text, chunk_size, chunk_overlap, token_starts=token_starts
+        )
+    ]
     if discard_chunk_n_words_cutoff is not None:
-        chunks = [
-            chunk
-            for chunk in chunks
-            if len(chunk.split()) >= discard_chunk_n_words_cutoff
-        ]
+        chunks = [chunk for chunk in chunks if chunk.word_count >= discard_chunk_n_words_cutoff]
 
     if min_words_per_chunk:
-        chunks = _combine_short_chunks(chunks, min_words_per_chunk)
+        max_length = chunk_size if token_starts is not None else None
+        chunks = _combine_short_chunks(chunks, min_words_per_chunk, max_length, token_starts)
 
     return chunks
 
 
+def _fit_token_budget(
+    encoding: tiktoken.Encoding,
+    text: str,
+    chunk: ChunkSpans,
+    chunk_size: int,
+    chunk_overlap: int,
+    token_starts: List[int],
+) -> List[ChunkSpans]:
+    """
+    Split a chunk whose exact token_count is over chunk_size into chunks
+    that fit: combined chunks into their parts, a single span again with a
+    budget reduced by the excess. The parts get their exact token_count.
+    """
+    if chunk.token_count <= chunk_size:
+        return [chunk]
+    if len(chunk.spans) > 1:
+        spans = list(chunk.spans)
+    else:
+        start, end = chunk.spans[0]
+        excess = chunk.token_count - chunk_size
+        budget = max(1, min(chunk_size, _span_length(start, end, token_starts)) - excess)
+        spans = []
+        _split_spans(
+            text, start, end, SEPARATORS, budget, min(chunk_overlap, budget // 2), spans, token_starts
+        )
+    fitted = []
+    for start, end in spans:
+        part = ChunkSpans(
+            ((start, end),),
+            len(text[start:end].split()),
+            len(encoding.encode_ordinary(text[start:end])),
+        )
+        fitted.extend(
+            _fit_token_budget(encoding, text, part, chunk_size, chunk_overlap, token_starts)
+        )
+    return fitted
+
+
+def chunk_spans_by_tokens(
+    texts: List[str],
+    chunk_sizes: List[int],
+    chunk_overlap: int,
+    discard_chunk_n_words_cutoff: Optional[int] = None,
+    min_words_per_chunk: Optional[int] = None,
+    encoding_name: str = TOKEN_ENCODING,
+    num_threads: int = TOKENIZER_THREADS,
+) -> List[List[ChunkSpans]]:
+    """
+    chunk_spans of every prepared text with its chunk size and the overlap
+    in tokens of encoding_name. The texts and then all their chunks are
+    tokenized as batches on num_threads threads, and every chunk gets its
+    exact token_count, at most its chunk size.
+    """
+    encoding = get_encoding(encoding_name)
+    text_tokens = encoding.encode_ordinary_batch(texts, num_threads=num_threads)
+    text_starts = [token_starts(encoding, text, tokens) for text, tokens in zip(texts, text_tokens)]
+    text_chunks = [
+        chunk_spans(
+            text,
+            chunk_size,
+            chunk_overlap,
+            discard_chunk_n_words_cutoff,
+            min_words_per_chunk,
+            starts,
+        )
+        for text, starts, chunk_size in zip(texts, text_starts, chunk_sizes)
+    ]
+
+    # A chunk can tokenize slightly differently than within its text
+    chunk_texts = [
+        chunk.materialize(text) for text, chunks in zip(texts, text_chunks) for chunk in chunks
+    ]
+    token_counts = iter(
+        len(tokens) for tokens in encoding.encode_ordinary_batch(chunk_texts, num_threads=num_threads)
+    )
+    # Chunks over their chunk size by the exact count are split again, a
+    # chunk can be a few tokens longer than the tokens starting in its spans
+    return [
+        [
+            fitted
+            for chunk in chunks
+            for fitted in _fit_token_budget(
+                encoding,
+                text,
+                chunk._replace(token_count=next(token_counts)),
+                chunk_size,
+                chunk_overlap,
+                starts,
+            )
+        ]
+        for text, starts, chunk_size, chunks in zip(texts, text_starts, chunk_sizes, text_chunks)
+    ]
+
+
+def split_text(
+    text: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    discard_chunk_n_words_cutoff: Optional[int] = None,
+    clean_whitespace: bool = True,
+    clean_html: bool = True,
+    min_words_per_chunk: Optional[int] = None,
+    token_encoding: Optional[str] = None,
+) -> List[str]:
+    """
+    Split text into chunks like langchain's RecursiveCharacterTextSplitter.
+
+    discard_chunk_n_words_cutoff: If set, discard chunks with less than this number of words.
+
+    min_words_per_chunk: If set, combine chunks with less than this number of words.
+
+    token_encoding: If set, chunk_size and chunk_overlap are in tokens of this tiktoken
+    encoding instead of characters, see chunk_spans_by_tokens to split many texts.
+    """
+    text = prepare_text(text, clean_whitespace, clean_html)
+    if token_encoding is not None:
+        (chunks,) = chunk_spans_by_tokens(
+            [text],
+            [chunk_size],
+            chunk_overlap,
+            discard_chunk_n_words_cutoff,
+            min_words_per_chunk,
+            encoding_name=token_encoding,
+            num_threads=1,
+        )
+    else:
+        chunks = chunk_spans(
+            text, chunk_size, chunk_overlap, discard_chunk_n_words_cutoff, min_words_per_chunk
+        )
+    return [chunk.materialize(text) for chunk in chunks]
+
+
 def create_chunks(
     text: str,
     language: str,
@@ -0,0 +1,344 @@
+"""
+Near-duplicate chunk detection with MinHash and LSH banding, run between
+chunking and embedding.
+
+Every chunk gets a MinHash signature of its word 5-grams. The signatures
+are cut into bands and chunks sharing a band are candidates. A chunk is
+compared with the first BUCKET_CANDIDATES chunks of each of its buckets
+before it and dropped in favour of the first one that is kept and has an
+estimated Jaccard similarity of at least SIMILARITY_THRESHOLD, so every
+dropped chunk is similar to the chunk kept for it. The first chunk in the order
+of the source is kept, for the chunk shards of chunk_stage.py that is the
+chunk of the article ranked higher by pageviews.
+
+Signatures are computed by a process pool on streamed batches, and the band
+keys and signatures go to a DuckDB work database on disk, so memory stays
+bounded for millions of chunks: only the dropped chunks are held in memory.
+The result is duplicates.parquet in output_dir, mapping every dropped chunk
+to the chunk kept for it:
+
+    title_match, chunk_idx, kept_title_match, kept_chunk_idx, similarity
+
+Chunks are identified by (title_match, chunk_idx) like in the WikiEmbedder
+checkpoint. The deduplicated chunks are deduplicated_chunks_sql(...), and
+WikiEmbedder skips the dropped chunks when given the file.
+
+Usage (from src):
+    python -m vectordb.dedup_stage <chunk_shards_dir | split_text.parquet> <output_dir>
+"""
+import os
+import shutil
+import sys
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+# Words per shingle, shorter chunks are a single shingle
+SHINGLE_WORDS = 5
+
+# 16 bands of 4 rows make pairs with a similarity of 0.8 candidates with a
+# probability of 99.98%, the candidates are then checked on the full signature
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SIMILARITY_THRESHOLD = 0.8
+
+SEED = 1
+
+# Chunks per batch of signatures
+CHUNKS_PER_BATCH = 20_000
+NUM_WORKERS = os.cpu_count()
+BATCHES_IN_FLIGHT_PER_WORKER = 2
+
+# DuckDB spills the band grouping beyond this limit
+MEMORY_LIMIT = "4GB"
+
+# Earlier chunks of a bucket a chunk is compared with, bounds the pairs of
+# the large buckets of boilerplate text
+BUCKET_CANDIDATES = 8
+
+# Candidate pairs checked at a time
+PAIRS_PER_BATCH = 100_000
+
+DUPLICATES_FILE = "duplicates.parquet"
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Multiplier combining word hashes into shingle hashes and rows into band keys
+_COMBINE = np.uint64(1_000_003)
+
+_rng = np.random.RandomState(SEED)
+_PERM_A = _rng.randint(1, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+
+
+def split_text_source(parquet_file: str) -> str:
+    """
+    The chunks of a Parquet file with split_text list columns (the cache of
+    the final filtering notebooks) as a DuckDB source of flat chunks.
+    """
+    return f"""(
+        SELECT
+            title_match,
+            UNNEST(range(len(split_text))) AS chunk_idx,
+            UNNEST(split_text) AS chunk_text
+        FROM read_parquet('{parquet_file}')
+    )"""
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """32 bit hashes of the word SHINGLE_WORDS-grams of text."""
+    words = text.split()
+    word_hashes = np.fromiter(
+        map(zlib.crc32, map(str.encode, words)), dtype=np.uint64, count=len(words)
+    )
+    n_shingles = max(1, len(words) - SHINGLE_WORDS + 1)
+    hashes = np.zeros(n_shingles, dtype=np.uint64)
+    for j in range(min(SHINGLE_WORDS, len(words))):
+        hashes = hashes * _COMBINE + word_hashes[j : j + n_shingles]
+    return hashes & _MAX_HASH
+
+
+def minhash_signatures(texts) -> np.ndarray:
+    """MinHash signatures of texts, an array of len(texts) x NUM_PERM."""
+    if not texts:
+        return np.empty((0, NUM_PERM), dtype=np.uint64)
+    shingles = [shingle_hashes(text) for text in texts]
+    offsets = np.cumsum([0] + [len(hashes) for hashes in shingles[:-1]])
+    hashes = np.concatenate(shingles)
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for i in range(NUM_PERM):
+            permuted = ((_PERM_A[i] * hashes + _PERM_B[i]) % _MERSENNE_PRIME) & _MAX_HASH
+            signatures[:, i] = np.minimum.reduceat(permuted, offsets)
+    return signatures
+
+
+def band_keys(signatures: np.ndarray) -> np.ndarray:
+    """One 64 bit key per band of every signature, len(signatures) x BANDS."""
+    keys = np.zeros((len(signatures), BANDS), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for row in range(ROWS_PER_BAND):
+            keys = keys * _COMBINE + signatures[:, row::ROWS_PER_BAND]
+    return keys.view(np.int64)
+
+
+def signature_batch(batch: pa.RecordBatch, first_ordinal: int):
+    """
+    Signatures and band keys of a batch of chunks numbered from
+    first_ordinal, as the rows of the signatures and bands tables.
+    """
+    texts = batch.column("chunk_text").to_pylist()
+    signatures = minhash_signatures(texts).astype(np.uint32)
+    ordinals = np.arange(first_ordinal, first_ordinal + len(texts), dtype=np.int64)
+    signature_rows = pa.table(
+        {
+            "ordinal": ordinals,
+            "title_match": batch.column("title_match"),
+            "chunk_idx": batch.column("chunk_idx"),
+            "signature": [signature.tobytes() for signature in signatures],
+        }
+    )
+    keys = band_keys(signatures.astype(np.uint64))
+    band_rows = pa.table(
+        {
+            "band": np.tile(np.arange(BANDS, dtype=np.int16), len(texts)),
+            "band_key": keys.ravel(),
+            "ordinal": np.repeat(ordinals, BANDS),
+        }
+    )
+    return signature_rows, band_rows
+
+
+def iter_chunk_batches(source: str, batch_rows: int = CHUNKS_PER_BATCH) -> Iterator[pa.RecordBatch]:
+    conn = duckdb.connect()
+    reader = conn.execute(
+        f"SELECT title_match, CAST(chunk_idx AS INTEGER) AS chunk_idx, chunk_text FROM {source}"
+    ).fetch_record_batch(batch_rows)
+    try:
+        yield from reader
+    finally:
+        conn.close()
+
+
+def _store_signatures(conn, source: str, num_workers: int) -> int:
+    conn.execute(
+        "CREATE TABLE signatures (ordinal BIGINT, title_match VARCHAR, chunk_idx INTEGER, signature BLOB)"
+    )
+    conn.execute("CREATE TABLE bands (band SMALLINT, band_key BIGINT, ordinal BIGINT)")
+    n_chunks = 0
+    max_in_flight = num_workers * BATCHES_IN_FLIGHT_PER_WORKER
+
+    def store(done):
+        for future in done:
+            signature_rows, band_rows = future.result()
+            conn.register("signature_rows", signature_rows)
+            conn.execute("INSERT INTO signatures SELECT * FROM signature_rows")
+            conn.unregister("signature_rows")
+            conn.register("band_rows", band_rows)
+            conn.execute("INSERT INTO bands SELECT * FROM band_rows")
+            conn.unregister("band_rows")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = set()
+        for batch in iter_chunk_batches(source):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                store(done)
+            in_flight.add(executor.submit(signature_batch, batch, n_chunks))
+            n_chunks += batch.num_rows
+        store(wait(in_flight).done)
+    return n_chunks
+
+
+def _find_duplicates(conn, similarity_threshold: float) -> int:
+    """
+    Check the candidate pairs, every chunk against the first chunks of each
+    of its buckets that are kept, and store the dropped chunks with their
+    kept chunk.
+    """
+    reader = conn.execute(
+        f"""
+        WITH buckets AS (
+            SELECT band, band_key
+            FROM bands
+            GROUP BY band, band_key
+            HAVING COUNT(*) > 1
+        ),
+        members AS (
+            SELECT
+                band,
+                band_key,
+                ordinal,
+                ROW_NUMBER() OVER (PARTITION BY band, band_key ORDER BY ordinal) AS bucket_rank
+            FROM bands SEMI JOIN buckets USING (band, band_key)
+        ),
+        pairs AS (
+            SELECT DISTINCT m.ordinal, k.ordinal AS kept
+            FROM members m
+            JOIN members k
+                ON m.band = k.band
+                AND m.band_key = k.band_key
+                AND k.bucket_rank <= {BUCKET_CANDIDATES}
+                AND k.ordinal < m.ordinal
+        )
+        SELECT p.ordinal, p.kept, s.signature, t.signature AS kept_signature
+        FROM pairs p
+        JOIN signatures s ON s.ordinal = p.ordinal
+        JOIN signatures t ON t.ordinal = p.kept
+        ORDER BY p.ordinal, p.kept
+        """
+    ).fetch_record_batch(PAIRS_PER_BATCH)
+
+    # Dropped chunk -> (kept chunk, similarity). Candidates come in order, so
+    # whether a chunk is kept is final before any later chunk is compared with
+    # it. Dropped chunks are not kept chunks of others: A -> B -> C chains
+    # would drop C for A without comparing them
+    dropped = {}
+    for batch in reader:
+        signatures = np.frombuffer(
+            b"".join(batch.column("signature").to_pylist()), dtype=np.uint32
+        ).reshape(-1, NUM_PERM)
+        kept_signatures = np.frombuffer(
+            b"".join(batch.column("kept_signature").to_pylist()), dtype=np.uint32
+        ).reshape(-1, NUM_PERM)
+        similarities = (signatures == kept_signatures).mean(axis=1)
+        ordinals = batch.column("ordinal").to_pylist()
+        kept = batch.column("kept").to_pylist()
+        for ordinal, kept_ordinal, similarity in zip(ordinals, kept, similarities.tolist()):
+            if (
+                similarity >= similarity_threshold
+                and ordinal not in dropped
+                and kept_ordinal not in dropped
+            ):
+                dropped[ordinal] = (kept_ordinal, similarity)
+
+    conn.execute("CREATE TABLE dropped (ordinal BIGINT, kept BIGINT, similarity DOUBLE)")
+    dropped_rows = pa.table(
+        {
+            "ordinal": pa.array(list(dropped), pa.int64()),
+            "kept": pa.array([kept for kept, _ in dropped.values()], pa.int64()),
+            "similarity": pa.array([similarity for _, similarity in dropped.values()], pa.float64()),
+        }
+    )
+    conn.register("dropped_rows", dropped_rows)
+    conn.execute("INSERT INTO dropped SELECT * FROM dropped_rows")
+    conn.unregister("dropped_rows")
+    return len(dropped)
+
+
+def run_dedup_stage(
+    source: str,
+    output_dir: str,
+    similarity_threshold: float = SIMILARITY_THRESHOLD,
+    num_workers: int = NUM_WORKERS,
+) -> str:
+    """
+    Find the near-duplicate chunks of source, a DuckDB table function or
+    subquery with title_match, chunk_idx and chunk_text columns, and write
+    the dropped -> kept mapping to output_dir. Returns the mapping file.
+    """
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = os.path.join(output_dir, "_dedup")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    conn = duckdb.connect(os.path.join(work_dir, "work.duckdb"))
+    conn.execute(f"SET memory_limit = '{MEMORY_LIMIT}'")
+    conn.execute(f"SET temp_directory = '{work_dir}'")
+
+    n_chunks = _store_signatures(conn, source, num_workers)
+    n_dropped = _find_duplicates(conn, similarity_threshold)
+
+    duplicates_file = os.path.join(output_dir, DUPLICATES_FILE)
+    conn.execute(
+        f"""
+        COPY (
+            SELECT
+                s.title_match,
+                s.chunk_idx,
+                k.title_match AS kept_title_match,
+                k.chunk_idx AS kept_chunk_idx,
+                d.similarity
+            FROM dropped d
+            JOIN signatures s ON s.ordinal = d.ordinal
+            JOIN signatures k ON k.ordinal = d.kept
+            ORDER BY d.ordinal
+        ) TO '{duplicates_file}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """
+    )
+    conn.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print(
+        f"Dropped {n_dropped} of {n_chunks} chunks as near-duplicates"
+        f" ({n_dropped / max(n_chunks, 1):.1%}) in {time.perf_counter() - start:.1f}s"
+    )
+    return duplicates_file
+
+
+def deduplicated_chunks_sql(source: str, duplicates_file: str) -> str:
+    """The chunks of source without the dropped chunks of duplicates_file."""
+    return f"""
+        SELECT c.*
+        FROM {source} c
+        ANTI JOIN read_parquet('{duplicates_file}') d
+            ON c.title_match = d.title_match AND c.chunk_idx = d.chunk_idx
+    """
+
+
+def main():
+    input_path, output_dir = sys.argv[1], sys.argv[2]
+    if os.path.isdir(input_path):
+        source = f"read_parquet('{os.path.join(input_path, '*.parquet')}')"
+    else:
+        source = split_text_source(input_path)
+    run_dedup_stage(source, output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from pathlib import Path
 from sentence_transformers import SentenceTransformer
+import numpy as np
 import os
 
 HERE = Path(__file__).parent
@@ -19,10 +20,25 @@ class Embedder:
     #         self.model.save(local_model_path)
 
     # use serverless pinecone
-    def __init__(self):
-        pass
+    def __init__(self, model_name, embedding_cache=None):
+        # model_name: the embedding_model of the index in settings.yaml, also
+        # the key of the cached embeddings.
+        # embedding_cache: optional EmbeddingCache (embedding_cache.py), embed
+        # then only encodes the texts it has no embedding of
+        self.model_name = model_name
+        self.embedding_cache = embedding_cache
+        # Loaded on the first texts that are not in the cache
+        self.model = None
 
     def embed(self, texts):
+        if self.embedding_cache is None:
+            return self._encode(texts)
+        embeddings = self.embedding_cache.embed(self.model_name, texts, self._encode)
+        return np.array(embeddings, dtype=np.float32)
+
+    def _encode(self, texts):
+        if self.model is None:
+            self.model = SentenceTransformer(self.model_name)
         return self.model.encode(
             texts,
             batch_size=64,
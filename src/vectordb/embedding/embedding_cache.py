@@ -0,0 +1,129 @@
+"""
+Persistent cache of embeddings keyed by model and chunk content.
+
+Vector ids (md5(title + url)#i in create_chunks, title_normalized_chunkidx
+in WikiEmbedder) say where a chunk is, not what it contains, so they can not
+tell whether a chunk has to be embedded again after re-chunking or a dump
+refresh. The cache keys every embedding on the model and the SHA-256 of
+the normalized text that was embedded (NFC, whitespace collapsed), in a
+DuckDB table:
+
+    cache = EmbeddingCache("embedding_cache.duckdb")
+    vectors = cache.embed("multilingual-e5-large:passage", texts, embed_texts)
+
+embed_texts is only called with the texts that are not in the cache, each
+distinct text once.
+"""
+import hashlib
+import re
+import unicodedata
+from typing import Callable, List, Optional, Sequence
+
+import duckdb
+import pyarrow as pa
+
+CACHE_TABLE = "embedding_cache"
+
+
+def normalize_text(text: str) -> str:
+    """Text as hashed: NFC normalized, whitespace runs as one space, stripped."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self.conn = duckdb.connect(database_file)
+        self.conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+                model VARCHAR,
+                text_hash VARCHAR,
+                embedding FLOAT[],
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model: str, hashes: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached embeddings of hashes in order, None where there is none."""
+        lookup = pa.table({"position": range(len(hashes)), "text_hash": list(hashes)})
+        self.conn.register("lookup", lookup)
+        rows = self.conn.execute(
+            f"""
+            SELECT c.embedding
+            FROM lookup l
+            LEFT JOIN {CACHE_TABLE} c ON c.model = ? AND c.text_hash = l.text_hash
+            ORDER BY l.position
+            """,
+            [model],
+        ).fetchall()
+        self.conn.unregister("lookup")
+        return [embedding for (embedding,) in rows]
+
+    def put(self, model: str, hashes: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        """Store embeddings, hashes already in the cache keep their embedding."""
+        new_embeddings = pa.table(
+            {
+                "model": [model] * len(hashes),
+                "text_hash": list(hashes),
+                "embedding": pa.array(
+                    [list(embedding) for embedding in embeddings], type=pa.list_(pa.float32())
+                ),
+            }
+        )
+        self.conn.register("new_embeddings", new_embeddings)
+        self.conn.execute(
+            f"INSERT OR IGNORE INTO {CACHE_TABLE} SELECT * FROM new_embeddings"
+        )
+        self.conn.unregister("new_embeddings")
+
+    def embed(
+        self,
+        model: str,
+        texts: Sequence[str],
+        embed_texts: Callable[[List[str]], Sequence[Sequence[float]]],
+    ) -> List[List[float]]:
+        """
+        Embeddings of texts in order, from the cache where possible. The
+        texts that are not cached are embedded with a single call to
+        embed_texts and stored.
+        """
+        hashes = [text_hash(text) for text in texts]
+        embeddings = self.get(model, hashes)
+
+        missing = {}
+        for text, hash_, embedding in zip(texts, hashes, embeddings):
+            if embedding is None and hash_ not in missing:
+                missing[hash_] = text
+        self.hits += len(texts) - sum(embedding is None for embedding in embeddings)
+        self.misses += len(missing)
+
+        if missing:
+            new_embeddings = embed_texts(list(missing.values()))
+            self.put(model, list(missing), new_embeddings)
+            computed = {
+                hash_: [float(value) for value in embedding]
+                for hash_, embedding in zip(missing, new_embeddings)
+            }
+            embeddings = [
+                computed[hash_] if embedding is None else embedding
+                for hash_, embedding in zip(hashes, embeddings)
+            ]
+        return embeddings
+
+    def count(self, model: Optional[str] = None) -> int:
+        if model is None:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {CACHE_TABLE}").fetchone()[0]
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM {CACHE_TABLE} WHERE model = ?", [model]
+        ).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -1,8 +1,24 @@
 import json
+from pathlib import Path
+import yaml
 from .embedding.embedder import Embedder
 from .pinecone_interface import insert_vectors
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+HERE = Path(__file__).parent
+
+
+def embedding_model(index_name):
+    """The embedding_model of index_name in settings.yaml."""
+    settings_path = HERE / ".." / "settings.yaml"
+    with open(settings_path, "r") as file:
+        settings = yaml.safe_load(file)
+
+    for config in settings["pinecone"]["indices"].values():
+        if config["index_name"] == index_name:
+            return config["embedding_model"]
+    raise ValueError(f"No index {index_name} in {settings_path}")
+
 
 def split_text(text, chunk_size=1000, chunk_overlap=200):
     text_splitter = RecursiveCharacterTextSplitter(
@@ -14,7 +30,7 @@ def split_text(text, chunk_size=1000, chunk_overlap=200):
     return text_splitter.split_text(text)
 
 
-def load_and_embed_test_data(file_path):
+def load_and_embed_test_data(file_path, index_name):
     print(f"Loading data from {file_path}")
     with open(file_path, "r", encoding="utf-8") as f:
         data = json.load(f)
@@ -44,7 +60,7 @@ def load_and_embed_test_data(file_path):
                 }
             )
 
-    embedder = Embedder()
+    embedder = Embedder(model_name=embedding_model(index_name))
     vectors = embedder.embed(chunks)
 
     for chunk, vector in zip(chunks, vectors):
@@ -59,10 +75,11 @@ def insert_test_data(index_name, vectors, metadata):
 
 def main():
     file_path = "data/visindavefur_articles.json"
-    vectors = load_and_embed_test_data(file_path)
+    index_name = "is-index"
+    vectors = load_and_embed_test_data(file_path, index_name)
 
     namespace = "visindavefur"
-    insert_test_data("is-index", vectors, namespace)
+    insert_test_data(index_name, vectors, namespace)
 
 
 if __name__ == "__main__":
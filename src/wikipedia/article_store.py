@@ -0,0 +1,107 @@
+"""
+Split storage of the ingested articles: metadata in DuckDB, text in Parquet.
+
+The articles table of a language database only holds the narrow metadata
+columns plus title_match, sorted by (title_match, page_id), so filtering
+queries and the pageview merge never scan processed_text. The text lives in
+a zstd compressed Parquet store keyed and sorted by page_id, next to the
+database. The database has two views over it:
+
+    article_text        (page_id, processed_text)
+    articles_with_text  articles joined with their text, the old layout
+
+Text is only pulled in for the articles that survive filtering:
+
+    conn = duckdb.connect(DATABASE_FILE)
+    selected = materialize_text(conn, "SELECT * FROM articles WHERE word_count > 50")
+"""
+import os
+import shutil
+
+
+def title_match_sql(column):
+    """
+    SQL of the standardized title both articles and pageviews are joined on.
+    """
+    return f"LOWER(TRIM(REPLACE({column}, '-', '')))"
+
+
+# Matches the title_match of the pageviews table (see the final filtering notebooks)
+TITLE_MATCH_SQL = title_match_sql("title")
+
+TEXT_FILE_NAME = "text.parquet"
+
+# Rows per Parquet row group of the text store, smaller groups make
+# page_id lookups read less text
+TEXT_ROW_GROUP_SIZE = 50_000
+
+
+def text_source_sql(text_dir):
+    return f"read_parquet('{text_dir}/*.parquet')"
+
+
+def write_text_store(conn, query, text_dir):
+    """
+    Write the (page_id, processed_text) rows of query to a new text store and
+    return its temporary directory, commit it with swap_text_store.
+    """
+    tmp_dir = text_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    conn.execute(
+        f"""
+        COPY (
+            SELECT page_id, processed_text
+            FROM ({query})
+            ORDER BY page_id
+        ) TO '{tmp_dir}/{TEXT_FILE_NAME}'
+        (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE {TEXT_ROW_GROUP_SIZE})
+        """
+    )
+    return tmp_dir
+
+
+def swap_text_store(tmp_dir, text_dir):
+    """
+    Replace the text store in text_dir with the one written to tmp_dir.
+    """
+    old_dir = text_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(text_dir):
+        os.rename(text_dir, old_dir)
+    os.rename(tmp_dir, text_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def create_text_views(conn, text_dir):
+    conn.execute(
+        f"CREATE OR REPLACE VIEW article_text AS SELECT * FROM {text_source_sql(text_dir)}"
+    )
+    conn.execute(
+        """
+        CREATE OR REPLACE VIEW articles_with_text AS
+        SELECT a.*, t.processed_text
+        FROM articles a
+        JOIN article_text t USING (page_id)
+        """
+    )
+
+
+def materialize_text(conn, selection, output_table=None):
+    """
+    Join the text to the articles of selection, a table name or a SELECT
+    with a page_id column, and return the DuckDB relation.
+
+    With output_table the result is stored as that table instead.
+    """
+    if not selection.lstrip().upper().startswith(("SELECT", "WITH")):
+        selection = f"SELECT * FROM {selection}"
+    query = f"""
+        SELECT s.*, t.processed_text
+        FROM ({selection}) s
+        JOIN article_text t USING (page_id)
+    """
+    if output_table is None:
+        return conn.sql(query)
+    conn.execute(f"CREATE OR REPLACE TABLE {output_table} AS {query}")
+    return conn.table(output_table)
@@ -0,0 +1,122 @@
+"""
+Cache of decompressed dump blocks, so reprocessing a dump skips bz2.
+
+Every worker appends the XML of the blocks it decompresses to its own
+segment file as one zstd frame per block. When the worker closes the
+segment it writes a manifest next to it, mapping every block offset to the
+position and length of its frame. Only blocks listed in a manifest count
+as cached, so the segment of a crashed worker is ignored and removed by
+remove_partial_segments.
+
+zstd decompresses several times faster than bz2, see BLOCK_CACHE_LEVEL.
+"""
+import json
+import mmap
+import os
+
+import zstandard
+
+# zstd level of the cached blocks, low levels compress fast and decompress
+# equally fast, the cache is about 4x smaller than the XML at level 3
+BLOCK_CACHE_LEVEL = 3
+
+SEGMENT_SUFFIX = ".zst"
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def remove_partial_segments(cache_dir):
+    """
+    Remove the segments without a manifest, left behind by interrupted runs.
+    """
+    for file_name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, file_name)
+        if file_name.endswith(SEGMENT_SUFFIX) and not os.path.exists(
+            path + MANIFEST_SUFFIX
+        ):
+            os.remove(path)
+        elif file_name.endswith(MANIFEST_SUFFIX + ".tmp"):
+            os.remove(path)
+
+
+def read_manifests(cache_dir):
+    """
+    Return a dict of block offset to (segment_file, position, length) of all
+    cached blocks in cache_dir.
+    """
+    locations = {}
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(MANIFEST_SUFFIX):
+            continue
+        segment_file = file_name[: -len(MANIFEST_SUFFIX)]
+        with open(os.path.join(cache_dir, file_name), encoding="utf-8") as f:
+            for block_offset, position, length in json.load(f):
+                locations[block_offset] = (segment_file, position, length)
+    return locations
+
+
+class BlockCacheWriter:
+    """
+    Append-only segment of zstd compressed blocks, committed by close.
+    """
+
+    def __init__(self, cache_dir, segment_name, level=BLOCK_CACHE_LEVEL):
+        self.path = os.path.join(cache_dir, segment_name + SEGMENT_SUFFIX)
+        self.file = open(self.path, "wb")
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.entries = []
+        self.position = 0
+
+    def add(self, block_offset, xml_data):
+        frame = self.compressor.compress(xml_data)
+        self.file.write(frame)
+        self.entries.append((block_offset, self.position, len(frame)))
+        self.position += len(frame)
+
+    def close(self):
+        self.file.close()
+        if not self.entries:
+            os.remove(self.path)
+            return
+        manifest_path = self.path + MANIFEST_SUFFIX
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class BlockCacheReader:
+    """
+    Read cached blocks by their offset in the dump, segments are memory mapped
+    on first use.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.locations = read_manifests(cache_dir)
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.segments = {}
+
+    def __contains__(self, block_offset):
+        return block_offset in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _segment(self, segment_file):
+        if segment_file not in self.segments:
+            with open(os.path.join(self.cache_dir, segment_file), "rb") as f:
+                self.segments[segment_file] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self.segments[segment_file]
+
+    def read(self, block_offset):
+        segment_file, position, length = self.locations[block_offset]
+        with memoryview(self._segment(segment_file)) as segment, segment[
+            position : position + length
+        ] as frame:
+            return self.decompressor.decompress(frame)
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
@@ -0,0 +1,145 @@
+"""
+Crash recovery check of the pageviews dataset compaction.
+
+Writes a partition of several parts, compacts it and lets the compaction
+crash at every file operation in turn (the os.replace and os.remove calls
+of pageviews_dataset). After every crash the views read back must equal the
+views written, and after compacting again as well, with no replaced parts
+or stray merged files left in the partition. A second round compacts a
+partition that was compacted before and got new parts since.
+
+Usage:
+    python compaction_check.py
+"""
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import duckdb
+
+import pageviews_dataset
+from pageviews_dataset import (
+    COMPACTED_SUFFIX,
+    compact,
+    partition_dir,
+    partition_files,
+    read_pageviews,
+    write_part,
+)
+
+WIKI_CODE = "is.wikipedia"
+MONTH = 202401
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def write_parts(conn, dataset_dir, days):
+    for day in days:
+        write_part(
+            conn,
+            f"""
+            SELECT 'Title_' || (i % 7)::VARCHAR AS article_title, 10::BIGINT AS views,
+                   [{day}]::BIGINT[] AS page_ids
+            FROM range(5) t(i)
+            """,
+            dataset_dir,
+            WIKI_CODE,
+            MONTH,
+            f"pageviews-{MONTH}{day:02d}-user.bz2",
+        )
+
+
+def total_views(conn, dataset_dir):
+    return read_pageviews(conn, dataset_dir, WIKI_CODE).sum("views").fetchone()[0]
+
+
+def crashing(after):
+    """
+    Patch the file operations of pageviews_dataset to crash on call number
+    after, counting from 0. Returns the patcher and the list of calls.
+    """
+    calls = []
+
+    def wrap(function):
+        def crash_or_call(*args):
+            calls.append(function.__name__)
+            if len(calls) > after:
+                raise SimulatedCrash(function.__name__)
+            return function(*args)
+
+        return crash_or_call
+
+    patched_os = mock.Mock(wraps=os)
+    patched_os.path = os.path
+    patched_os.replace = wrap(os.replace)
+    patched_os.remove = wrap(os.remove)
+    return mock.patch.object(pageviews_dataset, "os", patched_os), calls
+
+
+def check_crashes(first_days, later_days):
+    """
+    Crash a compaction of a partition holding first_days, compacted first
+    when later_days are given, at every file operation. Returns the number
+    of failed checks.
+    """
+    failures = 0
+    expected = 50 * (len(first_days) + len(later_days))
+    after = 0
+    while True:
+        dataset_dir = tempfile.mkdtemp()
+        conn = duckdb.connect()
+        write_parts(conn, dataset_dir, first_days)
+        if later_days:
+            compact(dataset_dir)
+            write_parts(conn, dataset_dir, later_days)
+
+        patcher, calls = crashing(after)
+        crashed = False
+        with patcher:
+            try:
+                compact(dataset_dir)
+            except SimulatedCrash as e:
+                crashed = True
+                step = f"crash at {e} (call {after})"
+        if not crashed:
+            shutil.rmtree(dataset_dir)
+            conn.close()
+            return failures
+
+        views = total_views(conn, dataset_dir)
+        compact(dataset_dir)
+        views_after = total_views(conn, dataset_dir)
+        directory = partition_dir(dataset_dir, WIKI_CODE, MONTH)
+        files = partition_files(directory)
+        left = sorted(
+            name
+            for name in os.listdir(directory)
+            if name.endswith(".parquet") or COMPACTED_SUFFIX in name
+        )
+        ok = (
+            views == expected
+            and views_after == expected
+            and len(files) == 1
+            and left == [os.path.basename(files[0])]
+        )
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {step}: {views} views after the crash,"
+            f" {views_after} after compacting again, files {left}"
+        )
+        failures += not ok
+        shutil.rmtree(dataset_dir)
+        conn.close()
+        after += 1
+
+
+def main():
+    failures = check_crashes([1, 2], [])
+    failures += check_crashes([1, 2], [3, 4])
+    print(f"Compaction crash recovery: {failures} failures")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Persisted multistream index and random access to single articles of a dump.
+
+The index file maps every page to the offset of the bz2 stream that holds it.
+build_index_table stores it as the dump_index table (block_offset, block_end,
+page_id, title) so a single article can be fetched by decompressing and
+parsing only its own block.
+
+Usage:
+    index = DumpIndex(DATABASE_FILE, DUMP_FILE)
+    page = index.fetch_page(title="Reykjavík")
+    row = index.fetch_article_row(page_id=12345)
+"""
+import bz2
+import os
+
+import duckdb
+import pyarrow as pa
+
+from page_extractor import find_page
+
+INDEX_SCHEMA = pa.schema(
+    [
+        ("block_offset", pa.int64()),
+        ("page_id", pa.int64()),
+        ("title", pa.string()),
+    ]
+)
+
+# Rows per Arrow chunk inserted while building the index table
+INDEX_CHUNK_ROWS = 1_000_000
+
+# Rows fetched at a time when streaming the stored timestamps to the scheduler
+KNOWN_TIMESTAMP_FETCH_ROWS = 100_000
+
+
+def read_index_entries(index_file):
+    """
+    Yield (block_offset, page_id, title) for every line of the index file.
+    """
+    with bz2.open(index_file, "rt", encoding="utf-8") as f:
+        for line in f:
+            # Titles can contain colons, only split off offset and page id
+            parts = line.rstrip("\n").split(":", 2)
+            if len(parts) != 3:
+                continue
+            try:
+                yield int(parts[0]), int(parts[1]), parts[2]
+            except ValueError:
+                continue  # Skip lines with invalid format
+
+
+def _index_chunks(index_file):
+    offsets, page_ids, titles = [], [], []
+    for offset, page_id, title in read_index_entries(index_file):
+        offsets.append(offset)
+        page_ids.append(page_id)
+        titles.append(title)
+        if len(offsets) >= INDEX_CHUNK_ROWS:
+            yield pa.Table.from_arrays([offsets, page_ids, titles], schema=INDEX_SCHEMA)
+            offsets, page_ids, titles = [], [], []
+    if offsets:
+        yield pa.Table.from_arrays([offsets, page_ids, titles], schema=INDEX_SCHEMA)
+
+
+def dump_name(dump_file):
+    """
+    Return the name of a dump, e.g. "enwiki-20241001" for
+    enwiki-20241001-pages-articles-multistream.xml.bz2.
+    """
+    return os.path.basename(dump_file).split("-pages-articles")[0]
+
+
+def dump_language(dump_file):
+    """
+    Return the wiki code of a dump, e.g. "en" for enwiki-20241001-....
+    """
+    return dump_name(dump_file).split("-")[0].removesuffix("wiki")
+
+
+def has_table(conn, table_name):
+    return (
+        conn.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?",
+            [table_name],
+        ).fetchone()[0]
+        > 0
+    )
+
+
+def get_indexed_dump(conn):
+    """
+    Return the file name of the dump the dump_index table was built from, or None.
+    """
+    if not has_table(conn, "dump_index_meta"):
+        return None
+    return conn.execute("SELECT dump_file FROM dump_index_meta").fetchone()[0]
+
+
+def build_index_table(index_file, dump_file, database_file):
+    """
+    Persist the multistream index as the dump_index table of database_file.
+
+    block_end is the offset of the next stream, or the dump size for the last
+    one, so (block_offset, block_end) is the exact byte range of the block.
+    """
+    dump_size = os.path.getsize(dump_file)
+    conn = duckdb.connect(database_file)
+    conn.execute(
+        """
+        CREATE OR REPLACE TEMP TABLE dump_index_entries (
+            block_offset BIGINT,
+            page_id BIGINT,
+            title TEXT
+        )
+        """
+    )
+    for chunk in _index_chunks(index_file):
+        conn.register("index_chunk", chunk)
+        conn.execute("INSERT INTO dump_index_entries SELECT * FROM index_chunk")
+        conn.unregister("index_chunk")
+
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TABLE dump_index AS
+        WITH blocks AS (
+            SELECT
+                block_offset,
+                LEAD(block_offset, 1, {dump_size}) OVER (ORDER BY block_offset) AS block_end
+            FROM (SELECT DISTINCT block_offset FROM dump_index_entries)
+        )
+        SELECT e.block_offset, b.block_end, e.page_id, e.title
+        FROM dump_index_entries e
+        JOIN blocks b USING (block_offset)
+        ORDER BY e.block_offset, e.page_id
+        """
+    )
+    conn.execute("CREATE INDEX dump_index_page_id_idx ON dump_index (page_id)")
+    conn.execute("CREATE INDEX dump_index_title_idx ON dump_index (title)")
+    conn.execute("CREATE OR REPLACE TABLE dump_index_meta (dump_file TEXT)")
+    conn.execute(
+        "INSERT INTO dump_index_meta VALUES (?)", [os.path.basename(dump_file)]
+    )
+    count = conn.execute("SELECT COUNT(*) FROM dump_index").fetchone()[0]
+    conn.close()
+    print(f"Stored {count} index entries in {database_file}")
+
+
+def read_block_ranges(database_file):
+    """
+    Return the sorted (block_offset, block_end) ranges of all blocks in the index table.
+    """
+    conn = duckdb.connect(database_file, read_only=True)
+    block_ranges = conn.execute(
+        """
+        SELECT DISTINCT block_offset, block_end
+        FROM dump_index
+        ORDER BY block_offset
+        """
+    ).fetchall()
+    conn.close()
+    return block_ranges
+
+
+def _iter_fetched(result, fetch_rows):
+    while True:
+        rows = result.fetchmany(fetch_rows)
+        if not rows:
+            return
+        yield from rows
+
+
+def iter_known_timestamps(database_file, batches):
+    """
+    Yield, for every batch of (start, end) block ranges, a dict of page_id to
+    the last_modified of the articles already stored for pages in those blocks.
+
+    Timestamps are formatted like the dump's <timestamp> so they compare as
+    strings. Both the stored rows and the batches are walked in block order,
+    so only one batch worth of timestamps is held in memory.
+    """
+    conn = duckdb.connect(database_file, read_only=True)
+    try:
+        result = conn.execute(
+            """
+            SELECT i.block_offset, a.page_id, strftime(a.last_modified, '%Y-%m-%dT%H:%M:%SZ')
+            FROM dump_index i
+            JOIN articles a USING (page_id)
+            ORDER BY i.block_offset
+            """
+        )
+        rows = _iter_fetched(result, KNOWN_TIMESTAMP_FETCH_ROWS)
+        row = next(rows, None)
+        for batch in batches:
+            batch_offsets = {start for start, _ in batch}
+            last_offset = batch[-1][0]
+            known = {}
+            # Consume the rows up to the last block of the batch, rows of
+            # blocks that are not scheduled (already completed) are dropped
+            while row is not None and row[0] <= last_offset:
+                block_offset, page_id, timestamp = row
+                if block_offset in batch_offsets:
+                    known[page_id] = timestamp
+                row = next(rows, None)
+            yield known
+    finally:
+        conn.close()
+
+
+class DumpIndex:
+    """
+    Look up and fetch single pages of a multistream dump through the index table.
+    """
+
+    def __init__(self, database_file, dump_file):
+        self.dump_file = dump_file
+        self.conn = duckdb.connect(database_file, read_only=True)
+
+    def locate(self, title=None, page_id=None):
+        """
+        Return (page_id, block_offset, block_end) of a page, or None if the
+        index does not have it.
+        """
+        if page_id is not None:
+            condition, value = "page_id = ?", page_id
+        elif title is not None:
+            condition, value = "title = ?", title
+        else:
+            raise ValueError("Either title or page_id must be given")
+        return self.conn.execute(
+            f"SELECT page_id, block_offset, block_end FROM dump_index WHERE {condition} LIMIT 1",
+            [value],
+        ).fetchone()
+
+    def read_block(self, block_offset, block_end):
+        """
+        Decompress the single bz2 stream between block_offset and block_end.
+        """
+        with open(self.dump_file, "rb") as f:
+            f.seek(block_offset)
+            return bz2.BZ2Decompressor().decompress(f.read(block_end - block_offset))
+
+    def fetch_page(self, title=None, page_id=None):
+        """
+        Return the page dict (title, ns, id, timestamp, text and redirect for
+        redirects) of a page, or None if it is not in the dump.
+        """
+        location = self.locate(title=title, page_id=page_id)
+        if location is None:
+            return None
+        found_page_id, block_offset, block_end = location
+        return find_page(self.read_block(block_offset, block_end), found_page_id)
+
+    def fetch_article_row(self, title=None, page_id=None):
+        """
+        Return the articles row tuple of a page as the ingestion builds it,
+        None for missing pages, redirects, other namespaces and disambiguation pages.
+        """
+        # Imported here, the dump pipeline imports this module
+        from multiprocess_large_wiki_dump import build_article_row
+
+        page = self.fetch_page(title=title, page_id=page_id)
+        if page is None or page.get("ns") != "0" or "redirect" in page:
+            return None
+        return build_article_row(page, dump_language(self.dump_file))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,124 @@
+"""
+Parity check and throughput benchmark for the page extraction engines.
+
+Compares the byte-level extractor in page_extractor.py against the
+xml.sax WikiXmlHandler on the first blocks of a multistream dump.
+
+Usage:
+    python extractor_benchmark.py <dump_file> <index_file> [n_blocks]
+"""
+import io
+import os
+import sys
+import time
+import xml.sax
+
+import multiprocess_large_wiki_dump as dump
+from dump_index import dump_language
+from page_extractor import iter_article_pages
+
+
+class PageCollector(dump.WikiXmlHandler):
+    """
+    WikiXmlHandler that collects the page dicts instead of building rows.
+    """
+
+    def __init__(self):
+        super().__init__(queue=None)
+        self.pages = []
+
+    def process_page(self, page):
+        self.pages.append(dict(page))
+
+    def process_redirect(self, page):
+        pass  # fast_pages leaves out redirects as well
+
+
+def read_blocks(dump_file, index_file, n_blocks):
+    """
+    Decompress the first n_blocks streams of the dump.
+    """
+    offsets = dump.get_offsets(index_file)
+    block_ranges = dump.get_block_ranges(offsets, os.path.getsize(dump_file))
+    blocks = []
+    with open(dump_file, "rb") as f:
+        for start, end in block_ranges[:n_blocks]:
+            f.seek(start)
+            blocks.append(dump.decompress_block(f.read(end - start)))
+    return blocks
+
+
+def sax_pages(xml_data):
+    handler = PageCollector()
+    xml_content = b"<mediawiki>" + xml_data + b"</mediawiki>"
+    xml.sax.parse(io.BytesIO(xml_content), handler)
+    return handler.pages
+
+
+def fast_pages(xml_data):
+    return list(iter_article_pages(xml_data))
+
+
+def check_parity(blocks, language):
+    """
+    Compare pages and rows of both engines block by block.
+
+    Returns a list of (block_number, kind, sax_value, fast_value) mismatches.
+    """
+    mismatches = []
+    for i, xml_data in enumerate(blocks):
+        expected_pages, pages = sax_pages(xml_data), fast_pages(xml_data)
+        if expected_pages != pages:
+            mismatches.append((i, "pages", expected_pages, pages))
+            continue
+        expected_rows = dump.extract_rows(xml_data, language, extractor="sax")
+        rows = dump.extract_rows(xml_data, language, extractor="fast")
+        if expected_rows != rows:
+            mismatches.append((i, "rows", expected_rows, rows))
+    return mismatches
+
+
+def benchmark(blocks, language, repeat=3):
+    """
+    Return the best-of-repeat MB/s of decompressed XML for each engine,
+    both for page extraction alone and for extraction plus row building.
+    """
+    total_mb = sum(len(xml_data) for xml_data in blocks) / 1024 / 1024
+    runs = {
+        "sax pages": sax_pages,
+        "fast pages": fast_pages,
+        "sax rows": lambda xml_data: dump.extract_rows(xml_data, language, extractor="sax"),
+        "fast rows": lambda xml_data: dump.extract_rows(xml_data, language, extractor="fast"),
+    }
+    results = {}
+    for name, extract in runs.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for xml_data in blocks:
+                extract(xml_data)
+            best = min(best, time.perf_counter() - start)
+        results[name] = total_mb / best
+    return results
+
+
+def main():
+    dump_file, index_file = sys.argv[1], sys.argv[2]
+    n_blocks = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    blocks = read_blocks(dump_file, index_file, n_blocks)
+    total_mb = sum(len(xml_data) for xml_data in blocks) / 1024 / 1024
+    print(f"Read {len(blocks)} blocks, {total_mb:.1f} MB of XML")
+
+    language = dump_language(dump_file)
+    mismatches = check_parity(blocks, language)
+    print(f"Parity: {len(mismatches)} mismatching blocks")
+    for block_number, kind, _, _ in mismatches[:10]:
+        print(f"  block {block_number}: {kind} differ")
+
+    for name, mb_per_second in benchmark(blocks, language).items():
+        print(f"{name:>10}: {mb_per_second:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Article link graph and link based importance scores.
+
+With EMIT_LINKS the dump ingestion stores the normalized wikilink targets
+of every article and the targets of main namespace redirects in its shards.
+build_link_table resolves them through the article titles, following one
+redirect, into the integer links table (source_id, target_id).
+compute_importance runs PageRank over that table without holding the edges
+in memory and stores the in-degree and PageRank of every article in the
+importance table, which the filtering step can join on page_id.
+
+Usage:
+    python link_graph.py <database_file> [iterations]
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+from dump_index import has_table
+
+# Edges read from DuckDB and processed at a time
+EDGE_CHUNK_ROWS = 10_000_000
+
+PAGERANK_DAMPING = 0.85
+PAGERANK_ITERATIONS = 30
+
+# Stop early once the L1 change of the ranks between iterations is below this
+PAGERANK_TOLERANCE = 1e-9
+
+WHITESPACE_RE = re.compile(r"[\s_]+")
+
+
+def normalize_link_title(title):
+    """
+    Normalize a wikilink target or redirect title to the form of page
+    titles: underscores and runs of whitespace become one space, leading
+    colons and the section fragment are dropped and the first letter is
+    upper case. Returns None for empty targets.
+    """
+    title = WHITESPACE_RE.sub(" ", title.partition("#")[0]).strip().lstrip(":").strip()
+    if not title:
+        return None
+    return title[0].upper() + title[1:]
+
+
+def build_link_table(database_file, shard_dir, incremental=False):
+    """
+    Build the links table (source_id, target_id) of database_file from the
+    link titles and redirects in the shards.
+
+    The normalized link titles of every article are kept in the link_titles
+    table (source_id, title). Links are kept when both ends are in the
+    articles table, links to a redirect count for its target and self links
+    are dropped. With incremental the link titles of pages that were
+    unchanged in the shards are kept from the existing link_titles table and
+    resolved again, so their links to pages created since count too.
+    """
+    conn = duckdb.connect(database_file)
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP VIEW shards AS
+        SELECT * FROM read_parquet('{shard_dir}/*.parquet', union_by_name = true)
+        """
+    )
+    unchanged_ids = "(SELECT page_id FROM shards WHERE unchanged) u ON t.source_id = u.page_id"
+    unchanged_titles = ""
+    unchanged_links = ""
+    if incremental and has_table(conn, "link_titles"):
+        unchanged_titles = f"""
+            UNION ALL
+            SELECT t.source_id, t.title
+            FROM link_titles t
+            SEMI JOIN {unchanged_ids}
+        """
+    elif incremental and has_table(conn, "links"):
+        # Databases built before link_titles was stored only have the resolved links
+        unchanged_links = f"""
+            UNION ALL
+            SELECT t.source_id, t.target_id
+            FROM links t
+            SEMI JOIN {unchanged_ids}
+            SEMI JOIN articles a ON t.target_id = a.page_id
+        """
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE new_link_titles AS
+        SELECT CAST(page_id AS INTEGER) AS source_id, UNNEST(link_titles) AS title
+        FROM shards
+        WHERE link_titles IS NOT NULL
+        {unchanged_titles}
+        """
+    )
+    conn.execute("BEGIN TRANSACTION")
+    conn.execute(
+        """
+        CREATE OR REPLACE TABLE link_titles AS
+        SELECT * FROM new_link_titles ORDER BY source_id
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TABLE links AS
+        WITH redirects AS (
+            SELECT title, redirect_title
+            FROM shards
+            WHERE redirect_title IS NOT NULL
+        ),
+        edges AS (
+            SELECT l.source_id, a.page_id AS target_id
+            FROM link_titles l
+            LEFT JOIN redirects r ON r.title = l.title
+            JOIN articles a ON a.title = COALESCE(r.redirect_title, l.title)
+            {unchanged_links}
+        )
+        SELECT DISTINCT source_id, target_id
+        FROM edges
+        WHERE source_id <> target_id
+        ORDER BY source_id, target_id
+        """
+    )
+    conn.execute("COMMIT")
+    count = conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+    conn.close()
+    print(f"Stored {count} links in {database_file}")
+
+
+def _spill_edges(conn, page_ids, work_dir, chunk_rows):
+    """
+    Write the links table as dense int32 node indices to two memory mapped
+    .npy files in work_dir and return them as (sources, targets).
+    """
+    n_edges = conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+    sources = np.lib.format.open_memmap(
+        os.path.join(work_dir, "sources.npy"), mode="w+", dtype=np.int32, shape=(n_edges,)
+    )
+    targets = np.lib.format.open_memmap(
+        os.path.join(work_dir, "targets.npy"), mode="w+", dtype=np.int32, shape=(n_edges,)
+    )
+    reader = conn.execute("SELECT source_id, target_id FROM links").fetch_record_batch(
+        chunk_rows
+    )
+    position = 0
+    for batch in reader:
+        end = position + batch.num_rows
+        # page_ids is sorted and holds every end of every link
+        sources[position:end] = np.searchsorted(page_ids, batch.column(0).to_numpy())
+        targets[position:end] = np.searchsorted(page_ids, batch.column(1).to_numpy())
+        position = end
+    return sources, targets
+
+
+def _edge_chunks(n_edges, chunk_rows):
+    for start in range(0, n_edges, chunk_rows):
+        yield slice(start, min(start + chunk_rows, n_edges))
+
+
+def pagerank(sources, targets, n_nodes, damping=PAGERANK_DAMPING,
+             iterations=PAGERANK_ITERATIONS, chunk_rows=EDGE_CHUNK_ROWS):
+    """
+    Return (pagerank, in_degree) of the graph given by the sources and
+    targets index arrays, which may be memory mapped.
+
+    Every iteration streams the edges in chunks and scatters the rank
+    contributions with np.bincount, only arrays of n_nodes are kept in
+    memory. The rank of pages without outlinks is spread over all pages.
+    """
+    n_edges = len(sources)
+    out_degree = np.zeros(n_nodes, dtype=np.int64)
+    in_degree = np.zeros(n_nodes, dtype=np.int64)
+    for chunk in _edge_chunks(n_edges, chunk_rows):
+        out_degree += np.bincount(sources[chunk], minlength=n_nodes)
+        in_degree += np.bincount(targets[chunk], minlength=n_nodes)
+
+    dangling = out_degree == 0
+    inverse_out_degree = np.zeros(n_nodes)
+    np.divide(1.0, out_degree, out=inverse_out_degree, where=~dangling)
+
+    rank = np.full(n_nodes, 1.0 / n_nodes)
+    for iteration in range(iterations):
+        contribution = rank * inverse_out_degree
+        new_rank = np.zeros(n_nodes)
+        for chunk in _edge_chunks(n_edges, chunk_rows):
+            new_rank += np.bincount(
+                targets[chunk], weights=contribution[sources[chunk]], minlength=n_nodes
+            )
+        new_rank = damping * (new_rank + rank[dangling].sum() / n_nodes) + (
+            1.0 - damping
+        ) / n_nodes
+        change = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if change < PAGERANK_TOLERANCE:
+            break
+    print(f"PageRank finished after {iteration + 1} iterations, last change {change:.2e}")
+    return rank, in_degree
+
+
+def compute_importance(database_file, iterations=PAGERANK_ITERATIONS, work_dir=None):
+    """
+    Compute the in-degree and PageRank of every article from the links table
+    and store them as the importance table (page_id, in_degree, pagerank).
+
+    The edges are spilled to temporary files next to the database, or in
+    work_dir, so the link graph never has to fit in memory.
+    """
+    start = time.perf_counter()
+    conn = duckdb.connect(database_file)
+    page_ids = conn.execute("SELECT page_id FROM articles ORDER BY page_id").fetchnumpy()[
+        "page_id"
+    ]
+    work_dir = work_dir or os.path.dirname(os.path.abspath(database_file))
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        sources, targets = _spill_edges(conn, page_ids, tmp_dir, EDGE_CHUNK_ROWS)
+        rank, in_degree = pagerank(sources, targets, len(page_ids), iterations=iterations)
+        del sources, targets
+
+    importance = pa.table(
+        {
+            "page_id": pa.array(page_ids, type=pa.int32()),
+            "in_degree": pa.array(in_degree, type=pa.int32()),
+            "pagerank": pa.array(rank, type=pa.float64()),
+        }
+    )
+    conn.register("importance_scores", importance)
+    conn.execute("CREATE OR REPLACE TABLE importance AS SELECT * FROM importance_scores")
+    conn.unregister("importance_scores")
+    conn.close()
+    print(
+        f"Stored importance of {len(page_ids)} articles in {database_file}"
+        f" in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def main():
+    database_file = sys.argv[1]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else PAGERANK_ITERATIONS
+    compute_importance(database_file, iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Parity check of the incremental link graph build against a full rebuild.
+
+Builds a synthetic wiki of articles, redirects and link titles, some of
+them to pages that do not exist yet, and loads it with build_link_table.
+A second revision creates some of the missing pages, deletes and edits
+others and retargets redirects. Its links table is built once
+incrementally, with the unchanged pages only flagged in the shards like
+the dump ingestion does, and once in full from all pages; both must hold
+the same links.
+
+Usage:
+    python link_graph_parity.py [n_pages] [seed]
+"""
+import os
+import random
+import sys
+import tempfile
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from link_graph import build_link_table
+
+SHARD_SCHEMA = pa.schema(
+    [
+        ("page_id", pa.int64()),
+        ("title", pa.string()),
+        ("link_titles", pa.list_(pa.string())),
+        ("redirect_title", pa.string()),
+        ("unchanged", pa.bool_()),
+    ]
+)
+
+
+def synthetic_revision(n_pages, rng, previous=None):
+    """
+    Return the pages of a revision as {page_id: (title, link_titles,
+    redirect_title)}, derived from the previous revision when given. Link
+    titles point at a pool of twice n_pages titles, so many are missing.
+    """
+    titles = [f"Page {i}" for i in range(2 * n_pages)]
+
+    def article():
+        return None, rng.sample(titles, rng.randint(0, 8)), None
+
+    def redirect():
+        return None, None, rng.choice(titles)
+
+    if previous is None:
+        pages = {}
+        for page_id in range(n_pages):
+            pages[page_id] = redirect() if rng.random() < 0.1 else article()
+    else:
+        pages = {}
+        for page_id, page in previous.items():
+            roll = rng.random()
+            if roll < 0.05:
+                continue  # deleted
+            if roll < 0.15:
+                page = redirect() if page[2] is not None else article()
+            pages[page_id] = page
+        for page_id in range(n_pages, n_pages + n_pages // 5):
+            pages[page_id] = article()  # created, some were linked already
+    return {
+        page_id: (f"Page {page_id}", link_titles, redirect_title)
+        for page_id, (_, link_titles, redirect_title) in pages.items()
+    }
+
+
+def write_shard(shard_dir, pages, unchanged_ids=()):
+    os.makedirs(shard_dir, exist_ok=True)
+    rows = []
+    for page_id, (title, link_titles, redirect_title) in sorted(pages.items()):
+        unchanged = page_id in unchanged_ids
+        rows.append(
+            {
+                "page_id": page_id,
+                "title": title,
+                "link_titles": None if unchanged else link_titles,
+                "redirect_title": redirect_title,
+                "unchanged": unchanged,
+            }
+        )
+    pq.write_table(
+        pa.Table.from_pylist(rows, schema=SHARD_SCHEMA),
+        os.path.join(shard_dir, "shard-000000.parquet"),
+    )
+
+
+def load_articles(database_file, pages):
+    conn = duckdb.connect(database_file)
+    articles = pa.table(
+        {
+            "page_id": pa.array(
+                [page_id for page_id, page in pages.items() if page[2] is None], pa.int32()
+            ),
+            "title": [page[0] for page in pages.values() if page[2] is None],
+        }
+    )
+    conn.register("new_articles", articles)
+    conn.execute("CREATE OR REPLACE TABLE articles AS SELECT * FROM new_articles")
+    conn.unregister("new_articles")
+    conn.close()
+
+
+def read_links(database_file):
+    conn = duckdb.connect(database_file)
+    links = conn.execute("SELECT source_id, target_id FROM links ORDER BY ALL").fetchall()
+    conn.close()
+    return links
+
+
+def check_incremental(n_pages=2000, seed=0):
+    """
+    Return the number of links that differ between the incremental and the
+    full build of the second revision.
+    """
+    rng = random.Random(seed)
+    first = synthetic_revision(n_pages, rng)
+    second = synthetic_revision(n_pages, rng, first)
+    # Articles kept as they were, the ingestion does not parse them again
+    unchanged_ids = {
+        page_id
+        for page_id, page in second.items()
+        if page[2] is None and first.get(page_id) == page
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        incremental_db = os.path.join(tmp_dir, "incremental.duckdb")
+        load_articles(incremental_db, first)
+        write_shard(os.path.join(tmp_dir, "first"), first)
+        build_link_table(incremental_db, os.path.join(tmp_dir, "first"))
+        load_articles(incremental_db, second)
+        write_shard(os.path.join(tmp_dir, "second"), second, unchanged_ids)
+        build_link_table(incremental_db, os.path.join(tmp_dir, "second"), incremental=True)
+
+        full_db = os.path.join(tmp_dir, "full.duckdb")
+        load_articles(full_db, second)
+        write_shard(os.path.join(tmp_dir, "full"), second)
+        build_link_table(full_db, os.path.join(tmp_dir, "full"))
+
+        incremental_links = set(read_links(incremental_db))
+        full_links = set(read_links(full_db))
+
+    differences = len(incremental_links ^ full_links)
+    print(
+        f"{len(unchanged_ids)} unchanged pages, {len(full_links)} links in the full build,"
+        f" {differences} differ in the incremental build"
+    )
+    return differences
+
+
+def main():
+    n_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    check_incremental(n_pages, seed)
+
+
+if __name__ == "__main__":
+    main()
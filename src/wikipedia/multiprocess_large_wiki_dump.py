@@ -1,10 +1,50 @@
 import bz2
 import os
+import mmap
 import multiprocessing
 import duckdb
 import xml.sax
 import io
-import wikitextparser as wtp
+import json
+import time
+import itertools
+from collections import namedtuple
+from contextlib import ExitStack, nullcontext
+import pyarrow.parquet as pq
+
+from dump_index import (
+    build_index_table,
+    dump_language,
+    dump_name,
+    get_indexed_dump,
+    has_table,
+    iter_known_timestamps,
+    read_block_ranges,
+)
+from block_cache import BlockCacheReader, BlockCacheWriter, remove_partial_segments
+from article_store import (
+    TITLE_MATCH_SQL,
+    create_text_views,
+    swap_text_store,
+    text_source_sql,
+    write_text_store,
+)
+from link_graph import build_link_table, compute_importance, normalize_link_title
+from page_extractor import iter_article_pages
+from wikitext_fast import parse_wikitext
+from pipeline_stats import (
+    StageStats,
+    StatsReporter,
+    merge_profiles,
+    queue_size,
+    run_profiled,
+)
+from record_transport import (
+    ARTICLE_SCHEMA,
+    ByteBudgetQueue,
+    payload_to_table,
+    rows_to_payload,
+)
 
 DATA_DIR = "/Users/einar/git/hafsteinn/together_rag/data"
 
@@ -12,15 +52,98 @@ DATA_DIR = "/Users/einar/git/hafsteinn/together_rag/data"
 DUMP_FILE = f"{DATA_DIR}/wikipedia/en/enwiki-20241001-pages-articles-multistream.xml.bz2"
 INDEX_FILE = f"{DATA_DIR}/wikipedia/en/enwiki-20241001-pages-articles-multistream-index.txt.bz2"
 
-language = DUMP_FILE.split("/")[-2]
-DATABASE_FILE = f"{DATA_DIR}/wikipedia_articles_{language}.duckdb"
+# Dump and index pairs ingested in one run, their blocks share one worker pool.
+# The language comes from the dump file name (enwiki-... is "en"), each language
+# is loaded into its own wikipedia_articles_{language}.duckdb
+DUMPS = [
+    (DUMP_FILE, INDEX_FILE),
+]
 
-# Number of worker processes (adjust as needed)
-NUM_WORKERS = 10
+# Refresh an existing articles table from a newer dump, only new and changed
+# pages are parsed and the changed_pages table lists them for chunking/embedding
+INCREMENTAL_REFRESH = False
+
+# Number of worker processes, None to use every core not taken by a writer
+NUM_WORKERS = None
+
+# Number of shard writer processes
+NUM_WRITERS = 2
+
+# Roll over to a new shard after this many articles
+SHARD_MAX_ROWS = 100_000
+
+# Backpressure on the data queue, bytes of encoded payloads in flight
+DATA_QUEUE_MAX_BYTES = 512 * 1024 * 1024
+
+# Number of contiguous bz2 streams handed to a worker per queue message
+BLOCKS_PER_BATCH = 16
+
+# Page extraction engine, "fast" (byte-level page splitter) or "sax" (WikiXmlHandler)
+EXTRACTOR = "fast"
+
+# Wikitext parser, "wtp" (wikitextparser) or "fast" (single pass tokenizer in wikitext_fast.py)
+WIKITEXT_PARSER = "wtp"
+
+# Keep the decompressed blocks in a zstd cache per dump, later runs over the
+# same dump read them from there instead of decompressing the bz2 streams again
+BLOCK_CACHE = False
+
+# Store the wikilink targets of the articles and the main namespace redirects,
+# build the links table from them and compute the importance table (in-degree, PageRank)
+EMIT_LINKS = False
+
+# Seconds between the progress reports of the parent process
+REPORT_SECONDS = 30
+
+# Run every worker and writer under cProfile, the merged report is printed at the end
+PROFILE = False
 
 # Sentinel value to indicate the writer should stop
 SENTINEL = "DONE"
 
+# Output locations of one dump, see make_dump_job
+DumpJob = namedtuple(
+    "DumpJob",
+    [
+        "dump_name",
+        "language",
+        "dump_file",
+        "index_file",
+        "database_file",
+        "text_dir",
+        "shard_dir",
+        "cache_dir",
+    ],
+)
+
+def make_dump_job(dump_file, index_file):
+    """
+    Return the DumpJob of a dump. Article metadata goes to the DuckDB file
+    of the language and the text to its text store, the Parquet shards to a
+    directory per dump since the completion journal is keyed by stream offset.
+    cache_dir holds the decompressed block cache of the dump (BLOCK_CACHE).
+    """
+    name = dump_name(dump_file)
+    language = dump_language(dump_file)
+    return DumpJob(
+        dump_name=name,
+        language=language,
+        dump_file=dump_file,
+        index_file=index_file,
+        database_file=f"{DATA_DIR}/wikipedia_articles_{language}.duckdb",
+        text_dir=f"{DATA_DIR}/wikipedia_text_{language}",
+        shard_dir=f"{DATA_DIR}/wikipedia_shards/{name}",
+        cache_dir=f"{DATA_DIR}/wikipedia_block_cache/{name}",
+    )
+
+def get_num_workers():
+    """
+    Return NUM_WORKERS, or one worker per core left over by the writers.
+    """
+    if NUM_WORKERS:
+        return NUM_WORKERS
+    return max((os.cpu_count() or 1) - NUM_WRITERS, 1)
+
 def get_offsets(index_file):
     """
     Extract unique offsets from the index file.
@@ -37,13 +160,35 @@ def get_offsets(index_file):
                     continue  # Skip lines with invalid format
     return sorted(offsets)
 
+def get_block_ranges(offsets, dump_size):
+    """
+    Turn sorted stream offsets into exact (start, end) byte ranges.
+
+    Each bz2 stream ends where the next one starts, the last one ends at the
+    end of the dump (the trailing </mediawiki> stream is ignored by the
+    decompressor once the page stream hits its end-of-stream marker).
+    """
+    ends = offsets[1:] + [dump_size]
+    return list(zip(offsets, ends))
+
+def batch_block_ranges(block_ranges, blocks_per_batch=BLOCKS_PER_BATCH):
+    """
+    Group block ranges into batches of contiguous ranges, one batch per queue message.
+    """
+    return [
+        block_ranges[i : i + blocks_per_batch]
+        for i in range(0, len(block_ranges), blocks_per_batch)
+    ]
+
 class WikiXmlHandler(xml.sax.ContentHandler):
     """
     SAX handler to parse XML content and send rows to the queue.
     """
-    def __init__(self, queue):
+    def __init__(self, queue, language=None, stats=None):
         super().__init__()
         self.queue = queue
+        self.language = language
+        self.stats = stats
         self.current_tag = ""
         self.in_revision = False
         self.in_page = False
@@ -70,11 +215,16 @@ class WikiXmlHandler(xml.sax.ContentHandler):
                 and "redirect" not in self.page
             ):
                 self.process_page(self.page)
+            elif EMIT_LINKS and self.page.get("ns") == "0" and "redirect" in self.page:
+                self.process_redirect(self.page)
             self.page = {}
         elif name == "revision":
             self.in_revision = False
         elif self.current_tag in ["title", "ns", "id", "timestamp", "text"]:
-            self.page[self.current_tag] = self.buffer.strip()
+            # Only the first <id> is the page id, the later ones belong to
+            # the revision and the contributor
+            if self.current_tag != "id" or "id" not in self.page:
+                self.page[self.current_tag] = self.buffer.strip()
         self.buffer = ""
         self.current_tag = ""
 
@@ -86,212 +236,623 @@ class WikiXmlHandler(xml.sax.ContentHandler):
         """
         Extract metadata and processed text, then send it to the queue.
         """
-        try:
-            title = page.get("title", "")
-            text = page.get("text", "")
-            page_id = int(page.get("id", -1))
-            timestamp = page.get("timestamp", "")
-
-            if text and not text.lower().startswith("#redirect"):
-                parsed = wtp.parse(text)
-                plain_text = parsed.plain_text()
-                word_count = len(plain_text.split())
-                outlinks = parsed.wikilinks
-                outlink_count = len(outlinks)
-                categories = [
-                    link.title.strip()
-                    for link in outlinks
-                    if link.title.startswith("Category:")
-                ]
-                templates = parsed.templates
-
-                is_disambiguation = any(
-                    template.name.strip().lower() == "disambiguation"
-                    for template in templates
-                )
-                if is_disambiguation:
-                    return  # Skip disambiguation pages
-
-                external_links = parsed.external_links
-                url_title = title.replace(" ", "_")
-                url = f"https://{language}.wikipedia.org/wiki/{url_title}"
-
-                # Prepare the data tuple
-                data = (
-                    page_id,
-                    title,
-                    url,
-                    word_count,
-                    outlink_count,
-                    len(categories),
-                    "|".join(categories),
-                    len(templates),
-                    len(external_links),
-                    timestamp,
-                    plain_text,
-                )
+        with self.stats.time("wikitext") if self.stats else nullcontext():
+            data = build_article_row(page, self.language)
+        if data is not None:
+            # Send the data to the queue
+            self.queue.put(data)
+
+    def process_redirect(self, page):
+        """
+        Send the redirect row of a main namespace redirect to the queue (EMIT_LINKS).
+        """
+        self.queue.put(build_redirect_row(page))
+
+class RowCollector(list):
+    """
+    List with a queue-like put, lets WikiXmlHandler collect rows in-process.
+    """
+    put = list.append
 
-                # Send the data to the queue
-                self.queue.put(data)
-        except Exception as e:
-            print(f"Error processing page {page.get('id', 'Unknown')}: {e}")
 
-def writer_process(queue, database_file):
+def build_article_row(page, language):
     """
-    Writer process that consumes data from the queue and writes to DuckDB.
+    Build the articles row tuple for a main namespace, non-redirect page.
+
+    page is a dict with the title, id, timestamp and text of the page,
+    language the wiki code used in the article URL.
+    Returns None for empty pages, redirects and disambiguation pages.
     """
     try:
-        conn = duckdb.connect(database_file)
-        cursor = conn.cursor()
+        title = page.get("title", "")
+        text = page.get("text", "")
+        page_id = int(page.get("id", -1))
+        timestamp = page.get("timestamp", "")
+
+        if text and not text.lower().startswith("#redirect"):
+            parsed = parse_wikitext(text, parser=WIKITEXT_PARSER)
+            plain_text = parsed.plain_text
+            word_count = len(plain_text.split())
+            outlink_count = len(parsed.wikilink_titles)
+            categories = [
+                link_title.strip()
+                for link_title in parsed.wikilink_titles
+                if link_title.startswith("Category:")
+            ]
+
+            is_disambiguation = any(
+                name.strip().lower() == "disambiguation"
+                for name in parsed.template_names
+            )
+            if is_disambiguation:
+                return None  # Skip disambiguation pages
+
+            url_title = title.replace(" ", "_")
+            url = f"https://{language}.wikipedia.org/wiki/{url_title}"
+
+            link_titles = None
+            if EMIT_LINKS:
+                link_titles = list(
+                    dict.fromkeys(
+                        filter(None, map(normalize_link_title, parsed.wikilink_titles))
+                    )
+                )
 
-        # Create the table if it doesn't exist
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS articles (
-                page_id INTEGER,
-                title TEXT,
-                url TEXT,
-                word_count INTEGER,
-                outlink_count INTEGER,
-                category_count INTEGER,
-                categories TEXT,
-                template_count INTEGER,
-                external_link_count INTEGER,
-                last_modified TIMESTAMP,
-                processed_text TEXT
+            # Prepare the data tuple
+            return (
+                page_id,
+                title,
+                url,
+                word_count,
+                outlink_count,
+                len(categories),
+                "|".join(categories),
+                len(parsed.template_names),
+                parsed.external_link_count,
+                timestamp,
+                plain_text,
+                link_titles,
+                None,
             )
-            """
+    except Exception as e:
+        print(f"Error processing page {page.get('id', 'Unknown')}: {e}")
+    return None
+
+def build_redirect_row(page):
+    """
+    Build the row of a main namespace redirect for the link graph, only
+    page_id, title and the normalized redirect_title are set.
+    """
+    row = [None] * (len(ARTICLE_SCHEMA) - 1)
+    row[0] = int(page["id"])
+    row[1] = page["title"]
+    row[-1] = normalize_link_title(page["redirect"])
+    return tuple(row)
+
+def extract_rows(xml_data, language, extractor=None, known_timestamps=None, stats=None):
+    """
+    Extract article rows from the decompressed XML of one bz2 stream of the
+    language's dump.
+
+    extractor is "fast" for the byte-level page splitter or "sax" for
+    WikiXmlHandler, defaults to EXTRACTOR.
+
+    known_timestamps maps page ids to stored revision timestamps, pages
+    whose timestamp is unchanged are not parsed. Returns the rows and the
+    ids of the unchanged pages (the sax engine always parses every page).
+
+    stats is an optional StageStats, the time spent building the rows is
+    added to its wikitext stage.
+    """
+    extractor = extractor or EXTRACTOR
+    if extractor == "sax":
+        rows = RowCollector()
+        # Wrap the XML fragment with <mediawiki> tags
+        xml_content = b"<mediawiki>" + xml_data + b"</mediawiki>"
+        xml.sax.parse(io.BytesIO(xml_content), WikiXmlHandler(rows, language, stats))
+        return rows, []
+
+    rows = []
+    unchanged_page_ids = []
+    for page in iter_article_pages(xml_data, known_timestamps, EMIT_LINKS):
+        if page.get("unchanged"):
+            unchanged_page_ids.append(int(page["id"]))
+            continue
+        if "redirect" in page:
+            rows.append(build_redirect_row(page))
+            continue
+        with stats.time("wikitext") if stats else nullcontext():
+            data = build_article_row(page, language)
+        if data is not None:
+            rows.append(data)
+    return rows, unchanged_page_ids
+
+class ShardFile:
+    """
+    Parquet shard written under a temporary name until it is closed.
+
+    The offsets of the blocks it holds are stored in its footer and the
+    rename on close commits the rows and their journal entries together,
+    so only complete shards are ever visible in the shard directory.
+    """
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.tmp_path = shard_path + ".tmp"
+        self.writer = pq.ParquetWriter(self.tmp_path, ARTICLE_SCHEMA, compression="zstd")
+        self.num_rows = 0
+        self.block_offsets = []
+
+    def write(self, table, block_offsets):
+        self.writer.write_table(table)
+        self.num_rows += table.num_rows
+        self.block_offsets.extend(block_offsets)
+
+    def close(self):
+        self.writer.add_key_value_metadata(
+            {"block_offsets": json.dumps(self.block_offsets)}
         )
-        conn.commit()
+        self.writer.close()
+        os.replace(self.tmp_path, self.shard_path)
+
+def shard_writer_process(data_queue, shard_dirs, shard_prefix, stats_queue=None):
+    """
+    Writer process that consumes Arrow payloads from the queue and appends them
+    to Parquet shards, one open ShardFile per dump.
 
+    shard_dirs maps the dump name of a payload to the directory of its shards.
+    Stage timings are sent to stats_queue.
+    """
+    stats = StageStats("writer", stats_queue)
+    try:
         count = 0
-        batch = []
-        batch_size = 1000  # Adjust batch size as needed
+        shard_number = 0
+        shards = {}
 
         while True:
-            row = queue.get()
-            if row == SENTINEL:
+            with stats.time("queue_wait"):
+                payload = data_queue.get()
+            if payload == SENTINEL:
                 break
-            batch.append(row)
-            count += 1
-            if count % 25_000 == 0:
-                print(f"Processed {count} articles")
-
-            # Insert in batches for efficiency
-            if len(batch) >= batch_size:
-                cursor.executemany(
-                    """
-                    INSERT INTO articles (
-                        page_id, title, url, word_count, outlink_count,
-                        category_count, categories, template_count,
-                        external_link_count, last_modified, processed_text
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    batch,
-                )
-                conn.commit()
-                batch = []
-
-        # Insert any remaining data
-        if batch:
-            cursor.executemany(
-                """
-                INSERT INTO articles (
-                    page_id, title, url, word_count, outlink_count,
-                    category_count, categories, template_count,
-                    external_link_count, last_modified, processed_text
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                batch,
-            )
-            conn.commit()
-
-        print(f"Writer process finished. Total articles processed: {count}")
-        conn.close()
+            with stats.time("decode"):
+                table, block_offsets, name = payload_to_table(payload)
+
+            with stats.time("write"):
+                shard = shards.get(name)
+                if shard is None:
+                    shard = shards[name] = ShardFile(
+                        os.path.join(
+                            shard_dirs[name], f"{shard_prefix}-{shard_number:05d}.parquet"
+                        )
+                    )
+                    shard_number += 1
+                shard.write(table, block_offsets)
+
+                if shard.num_rows >= SHARD_MAX_ROWS:
+                    shard.close()
+                    del shards[name]
+
+            count += table.num_rows
+            stats.flush()
+
+        with stats.time("write"):
+            for shard in shards.values():
+                shard.close()
+        stats.flush(force=True)
+
+        print(f"Writer {shard_prefix} finished. Total articles processed: {count}")
     except Exception as e:
         print(f"Writer process encountered an error: {e}")
 
-def worker_process(offset_queue, data_queue):
+def get_completed_blocks(shard_dir):
+    """
+    Read the completion journal, the block offsets stored in the footers of
+    the committed shards.
+
+    Leftover temporary shards of an interrupted run are removed, their
+    blocks were never committed and will be processed again.
+    """
+    completed = set()
+    for file_name in os.listdir(shard_dir):
+        path = os.path.join(shard_dir, file_name)
+        if file_name.endswith(".parquet.tmp"):
+            os.remove(path)
+        elif file_name.endswith(".parquet"):
+            metadata = pq.read_metadata(path).metadata
+            completed.update(json.loads(metadata[b"block_offsets"]))
+    return completed
+
+# Metadata columns of the articles table, processed_text goes to the text store
+ARTICLE_COLUMNS_SQL = """
+    CAST(page_id AS INTEGER) AS page_id,
+    title,
+    url,
+    CAST(word_count AS INTEGER) AS word_count,
+    CAST(outlink_count AS INTEGER) AS outlink_count,
+    CAST(category_count AS INTEGER) AS category_count,
+    categories,
+    CAST(template_count AS INTEGER) AS template_count,
+    CAST(external_link_count AS INTEGER) AS external_link_count,
+    CAST(last_modified AS TIMESTAMP) AS last_modified
+"""
+
+def load_shards(database_file, shard_dir, text_dir, incremental=False):
+    """
+    Bulk load all Parquet shards into the DuckDB articles table and the
+    text store in text_dir (see article_store.py).
+
+    The table and the text store are rebuilt from the shards on every load,
+    every block is committed to exactly one shard so reruns never duplicate rows.
+
+    With incremental the metadata and text of unchanged pages are kept from
+    the existing articles table and text store, and the changed_pages table
+    lists the new, changed and deleted pages relative to the articles table
+    before the load.
     """
-    Worker process that reads from the dump, parses XML, and sends data to the queue.
+    conn = duckdb.connect(database_file)
+    # Redirect rows are only there for the link graph
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP VIEW shards AS
+        SELECT * FROM read_parquet('{shard_dir}/*.parquet', union_by_name = true)
+        WHERE redirect_title IS NULL
+        """
+    )
+    new_articles = f"""
+        SELECT {ARTICLE_COLUMNS_SQL}, processed_text
+        FROM shards
+        WHERE NOT unchanged
     """
+    if not incremental:
+        swap_text_store(write_text_store(conn, new_articles, text_dir), text_dir)
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TABLE articles AS
+            SELECT * EXCLUDE (processed_text), {TITLE_MATCH_SQL} AS title_match
+            FROM ({new_articles})
+            ORDER BY title_match, page_id
+            """
+        )
+    else:
+        # Databases loaded before the text store kept the text in articles
+        if os.path.isdir(text_dir):
+            old_text = text_source_sql(text_dir)
+        else:
+            old_text = "articles"
+        unchanged_ids = "(SELECT page_id FROM shards WHERE unchanged) u ON t.page_id = u.page_id"
+        tmp_text_dir = write_text_store(
+            conn,
+            f"""
+            SELECT t.page_id, t.processed_text
+            FROM {old_text} t
+            SEMI JOIN {unchanged_ids}
+            UNION ALL
+            SELECT page_id, processed_text FROM ({new_articles})
+            """,
+            text_dir,
+        )
+        # A failed load is redone from the shards, which hold the text of every changed page
+        swap_text_store(tmp_text_dir, text_dir)
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(
+            """
+            CREATE OR REPLACE TABLE changed_pages AS
+            SELECT
+                CAST(s.page_id AS INTEGER) AS page_id,
+                s.title,
+                CASE WHEN a.page_id IS NULL THEN 'new' ELSE 'changed' END AS change
+            FROM shards s
+            LEFT JOIN articles a ON a.page_id = s.page_id
+            WHERE NOT s.unchanged
+            UNION ALL
+            SELECT a.page_id, a.title, 'deleted' AS change
+            FROM articles a
+            ANTI JOIN shards s ON a.page_id = s.page_id
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TABLE articles AS
+            WITH merged AS (
+                SELECT {ARTICLE_COLUMNS_SQL}
+                FROM articles t
+                SEMI JOIN {unchanged_ids}
+                UNION ALL
+                SELECT * EXCLUDE (processed_text) FROM ({new_articles})
+            )
+            SELECT *, {TITLE_MATCH_SQL} AS title_match
+            FROM merged
+            ORDER BY title_match, page_id
+            """
+        )
+    # The pageview join and the article selection look articles up by title_match
+    conn.execute("CREATE INDEX articles_title_match ON articles (title_match)")
+    create_text_views(conn, text_dir)
+    conn.execute("COMMIT")
+
+    if incremental:
+        changes = conn.execute(
+            "SELECT change, COUNT(*) FROM changed_pages GROUP BY change ORDER BY change"
+        ).fetchall()
+        print(f"Changed pages: {dict(changes)}")
+
+    count = conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+    conn.close()
+    print(f"Loaded shards into {database_file}, articles table has {count} rows")
+    print(f"Stored the article text in {text_dir}")
+
+def decompress_block(block):
+    """
+    Decompress a single bz2 stream from a buffer holding exactly that stream.
+    """
+    decompressor = bz2.BZ2Decompressor()
+    return decompressor.decompress(block)
+
+def worker_process(batch_queue, data_queue, dumps, stats_queue=None, cache_segment=None):
+    """
+    Worker process that reads from the dumps, parses XML, and sends data to the queue.
+
+    dumps maps dump names to (dump_file, language, cache_dir). Each task from the queue
+    is (dump_name, batch, known_timestamps), the batch holds contiguous
+    (start, end) byte ranges of that dump. A dump is memory mapped once per
+    worker, on its first batch, and every stream is decompressed from a
+    zero-copy slice of the map. known_timestamps holds the stored revision
+    timestamps of the batch's pages in incremental mode, None otherwise.
+    Stage timings and block, byte and article counts are sent to stats_queue.
+
+    With a cache_dir, blocks found in the block cache are read from there and
+    the blocks the worker decompresses are added to its segment cache_segment.
+    """
+    stats = StageStats("worker", stats_queue)
     try:
-        while True:
-            offset = offset_queue.get()
-            if offset == SENTINEL:
-                break  # Exit the loop if sentinel is received
-
-            with open(DUMP_FILE, "rb") as dump_file:
-                dump_file.seek(offset)
-                decompressor = bz2.BZ2Decompressor()
-                xml_data = b""
-                while True:
-                    chunk = dump_file.read(1024 * 1024 * 8)  # 16 MB
-                    if not chunk:
-                        break
+        with ExitStack() as stack:
+            dump_views = {}
+            block_caches = {}
+            while True:
+                with stats.time("queue_wait"):
+                    task = batch_queue.get()
+                if task == SENTINEL:
+                    break  # Exit the loop if sentinel is received
+                name, batch, known_timestamps = task
+                dump_file, language, cache_dir = dumps[name]
+
+                if name not in dump_views:
+                    f = stack.enter_context(open(dump_file, "rb"))
+                    dump_map = stack.enter_context(
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    )
+                    dump_views[name] = stack.enter_context(memoryview(dump_map))
+                    if cache_dir is not None:
+                        cache_reader = BlockCacheReader(cache_dir)
+                        stack.callback(cache_reader.close)
+                        cache_writer = BlockCacheWriter(cache_dir, cache_segment)
+                        stack.callback(cache_writer.close)
+                        block_caches[name] = (cache_reader, cache_writer)
+                dump_view = dump_views[name]
+                cache_reader, cache_writer = block_caches.get(name, (None, None))
+
+                rows = []
+                unchanged_page_ids = []
+                block_offsets = []
+                for start, end in batch:
+                    if cache_reader is not None and start in cache_reader:
+                        with stats.time("cache_read"):
+                            xml_data = cache_reader.read(start)
+                        stats.add(cached_blocks=1)
+                    else:
+                        with dump_view[start:end] as block:
+                            try:
+                                with stats.time("decompress"):
+                                    xml_data = decompress_block(block)
+                            except OSError as e:
+                                print(f"Decompression error in {name} at offset {start}: {e}")
+                                continue
+                        if cache_writer is not None:
+                            with stats.time("cache_write"):
+                                cache_writer.add(start, xml_data)
+
                     try:
-                        decompressed = decompressor.decompress(chunk)
-                        xml_data += decompressed
-                        if decompressor.eof:
-                            break
-                    except OSError as e:
-                        print(f"Decompression error at offset {offset}: {e}")
-                        break
-
-                # Wrap the XML fragment with <mediawiki> tags
-                xml_content = b"<mediawiki>" + xml_data + b"</mediawiki>"
-
-                handler = WikiXmlHandler(data_queue)
-                try:
-                    xml.sax.parse(io.BytesIO(xml_content), handler)
-                except Exception as e:
-                    print(f"XML parsing error at offset {offset}: {e}")
+                        with stats.time("extract"):
+                            block_rows, block_unchanged = extract_rows(
+                                xml_data,
+                                language,
+                                known_timestamps=known_timestamps,
+                                stats=stats,
+                            )
+                    except Exception as e:
+                        print(f"XML parsing error in {name} at offset {start}: {e}")
+                        continue
+                    rows.extend(block_rows)
+                    unchanged_page_ids.extend(block_unchanged)
+                    block_offsets.append(start)
+                    stats.add(
+                        blocks=1,
+                        bz2_bytes=end - start,
+                        xml_bytes=len(xml_data),
+                        articles=len(block_rows),
+                    )
+
+                # Hand the whole batch off as one columnar payload,
+                # blocks that failed are left out of the journal
+                with stats.time("encode"):
+                    payload = rows_to_payload(rows, block_offsets, unchanged_page_ids, name)
+                with stats.time("queue_put"):
+                    data_queue.put(payload)
+                stats.flush()
+        stats.flush(force=True)
     except Exception as e:
         print(f"Worker process encountered an error: {e}")
 
+def schedule_dump(job):
+    """
+    Prepare a dump for the run and return (batches, known_timestamps, incremental).
+
+    The index is persisted once per dump, later runs and single article
+    lookups reuse it. Blocks committed by earlier runs are skipped. In
+    incremental mode known_timestamps yields the stored timestamps of the
+    pages of every batch, otherwise None per batch.
+    """
+    if BLOCK_CACHE:
+        os.makedirs(job.cache_dir, exist_ok=True)
+        remove_partial_segments(job.cache_dir)
+
+    conn = duckdb.connect(job.database_file)
+    indexed_dump = get_indexed_dump(conn)
+    incremental = INCREMENTAL_REFRESH and has_table(conn, "articles")
+    conn.close()
+    if indexed_dump != os.path.basename(job.dump_file):
+        print(f"Storing the index file of {job.dump_name} in the database...")
+        build_index_table(job.index_file, job.dump_file, job.database_file)
+
+    block_ranges = read_block_ranges(job.database_file)
+    print(f"Total blocks in the index of {job.dump_name}: {len(block_ranges)}")
+
+    # Skip the blocks committed by earlier runs
+    os.makedirs(job.shard_dir, exist_ok=True)
+    completed_blocks = get_completed_blocks(job.shard_dir)
+    if completed_blocks:
+        print(f"Resuming {job.dump_name}, {len(completed_blocks)} blocks already completed")
+    block_ranges = [
+        (start, end) for start, end in block_ranges if start not in completed_blocks
+    ]
+    batches = batch_block_ranges(block_ranges, BLOCKS_PER_BATCH)
+    print(f"Scheduling {len(block_ranges)} blocks of {job.dump_name} in {len(batches)} batches")
+
+    if incremental:
+        print(f"Incremental refresh of {job.dump_name}, unchanged pages are not parsed")
+        known_timestamps = iter_known_timestamps(job.database_file, batches)
+    else:
+        known_timestamps = (None for _ in batches)
+    return batches, known_timestamps, incremental
+
+def interleave_tasks(jobs, schedules):
+    """
+    Yield the (dump_name, batch, known_timestamps) tasks of all dumps round
+    robin, so the blocks of small dumps are spread between those of large ones.
+    """
+    task_iterators = [
+        zip(itertools.repeat(job.dump_name), batches, known_timestamps)
+        for job, (batches, known_timestamps, _) in zip(jobs, schedules)
+    ]
+    for tasks in itertools.zip_longest(*task_iterators):
+        for task in tasks:
+            if task is not None:
+                yield task
+
+def start_process(target, args, profile_path=None):
+    """
+    Start target(*args) in a new process, under cProfile when profile_path is set.
+    """
+    if profile_path is not None:
+        target, args = run_profiled, (profile_path, target, *args)
+    process = multiprocessing.Process(target=target, args=args)
+    process.start()
+    return process
+
 def main():
-    # Extract unique offsets
-    print("Extracting offsets from the index file...")
-    offsets = get_offsets(INDEX_FILE)
-    print(f"Total unique offsets extracted: {len(offsets)}")
-    
-    # Create a multiprocessing.Queue for data
-    data_queue = multiprocessing.Queue(maxsize=10000)  # Adjust maxsize as needed
-
-    # Create a multiprocessing.Queue for offsets
-    print(f"Creating offset queue")
-    offset_queue = multiprocessing.Queue()
-
-    # Start the writer process
-    print(f"Starting writer process")
-    writer = multiprocessing.Process(target=writer_process, args=(data_queue, DATABASE_FILE))
-    writer.start()
-
-    # Start worker processes
-    print(f"Starting {NUM_WORKERS} worker processes")
+    jobs = [make_dump_job(dump_file, index_file) for dump_file, index_file in DUMPS]
+    languages = [job.language for job in jobs]
+    if len(set(languages)) != len(languages):
+        raise ValueError(f"Only one dump per language can be ingested per run: {languages}")
+
+    schedules = [schedule_dump(job) for job in jobs]
+    num_workers = get_num_workers()
+
+    # Create a queue for the Arrow payloads, bounded by bytes in flight
+    data_queue = ByteBudgetQueue(DATA_QUEUE_MAX_BYTES)
+
+    # Create a multiprocessing.Queue for batches of block ranges, bounded so
+    # the stored timestamps are only read ahead of the workers by a few batches
+    print("Creating batch queue")
+    batch_queue = multiprocessing.Queue(maxsize=num_workers * 4)
+
+    # Stage timings of all processes are aggregated and reported by a thread
+    stats_queue = multiprocessing.Queue()
+    reporter = StatsReporter(
+        stats_queue,
+        {
+            "batch queue": lambda: queue_size(batch_queue),
+            "data queue MB": lambda: data_queue.bytes_in_flight() // (1024 * 1024),
+        },
+        REPORT_SECONDS,
+    )
+    reporter.start()
+
+    run_id = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+    profile_dir = f"{DATA_DIR}/profiles/{run_id}"
+    if PROFILE:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def profile_path(name):
+        return f"{profile_dir}/{name}.prof" if PROFILE else None
+
+    # Start the shard writer processes, shard names are unique per run
+    print(f"Starting {NUM_WRITERS} shard writer processes")
+    shard_dirs = {job.dump_name: job.shard_dir for job in jobs}
+    writers = []
+    for writer_id in range(NUM_WRITERS):
+        shard_prefix = f"part-{run_id}-{writer_id:03d}"
+        writers.append(
+            start_process(
+                shard_writer_process,
+                (data_queue, shard_dirs, shard_prefix, stats_queue),
+                profile_path(f"writer-{writer_id:03d}"),
+            )
+        )
+
+    # Start worker processes, shared by all dumps
+    print(f"Starting {num_workers} worker processes")
+    dumps = {
+        job.dump_name: (job.dump_file, job.language, job.cache_dir if BLOCK_CACHE else None)
+        for job in jobs
+    }
     workers = []
-    for _ in range(NUM_WORKERS):
-        worker = multiprocessing.Process(target=worker_process, args=(offset_queue, data_queue))
-        worker.start()
-        workers.append(worker)
+    for worker_id in range(num_workers):
+        workers.append(
+            start_process(
+                worker_process,
+                (batch_queue, data_queue, dumps, stats_queue, f"{run_id}-{worker_id:03d}"),
+                profile_path(f"worker-{worker_id:03d}"),
+            )
+        )
 
-    # Now fill the offset_queue
-    for offset in offsets:
-        offset_queue.put(offset)
+    # Now fill the batch_queue with the blocks of all dumps
+    for task in interleave_tasks(jobs, schedules):
+        batch_queue.put(task)
+    # Close the read-only connections to the databases before the load
+    for _, known_timestamps, _ in schedules:
+        known_timestamps.close()
 
-    # After all offsets are added, put a sentinel for each worker
-    for _ in range(NUM_WORKERS):
-        offset_queue.put(SENTINEL)
+    # After all batches are added, put a sentinel for each worker
+    for _ in range(num_workers):
+        batch_queue.put(SENTINEL)
 
     # Wait for all workers to finish
     for worker in workers:
         worker.join()
 
-    # Send the sentinel to the writer to indicate completion
-    data_queue.put(SENTINEL)
-
-    # Wait for the writer to finish
-    writer.join()
+    # Send a sentinel to each writer to indicate completion
+    for _ in range(NUM_WRITERS):
+        data_queue.put(SENTINEL)
+
+    # Wait for the writers to finish
+    for writer in writers:
+        writer.join()
+
+    reporter.stop()
+    print("Totals:")
+    reporter.report()
+    if PROFILE:
+        merge_profiles(profile_dir)
+
+    # Bulk load the shards of every dump into the DuckDB file of its language
+    for job, (_, _, incremental) in zip(jobs, schedules):
+        start = time.perf_counter()
+        load_shards(job.database_file, job.shard_dir, job.text_dir, incremental=incremental)
+        print(f"Loaded {job.dump_name} in {time.perf_counter() - start:.1f}s")
+        if EMIT_LINKS:
+            build_link_table(job.database_file, job.shard_dir, incremental=incremental)
+            compute_importance(job.database_file)
 
     print("All processes have completed successfully.")
 
@@ -0,0 +1,162 @@
+"""
+Byte-level page extraction for the decompressed XML of a multistream dump block.
+
+Pages are located with plain byte searches and the namespace and redirect
+checks only look at the page header (everything before <revision>), so the
+wikitext of non-article pages and redirects is never decoded.
+"""
+import re
+
+# Only the XML predefined entities and character references appear in dumps
+XML_ENTITY_RE = re.compile(r"&(?:#x([0-9a-fA-F]+)|#([0-9]+)|(amp|lt|gt|quot|apos));")
+
+XML_ENTITIES = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+
+
+def _replace_entity(match):
+    hex_ref, dec_ref, name = match.groups()
+    if hex_ref:
+        return chr(int(hex_ref, 16))
+    if dec_ref:
+        return chr(int(dec_ref))
+    return XML_ENTITIES[name]
+
+
+def unescape_xml(raw):
+    """
+    Decode raw element content to str the way an XML parser would.
+
+    Line endings are normalized to \\n before the entities are replaced,
+    so an escaped &#13; survives as a carriage return.
+    """
+    text = raw.decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if "&" in text:
+        text = XML_ENTITY_RE.sub(_replace_entity, text)
+    return text
+
+
+def _element_span(data, name, start, end):
+    """
+    Return the (start, end) byte span of the content of the first <name> element
+    between start and end, (i, i) for an empty element and None if it is missing.
+    """
+    open_tag = b"<" + name
+    open_at = data.find(open_tag, start, end)
+    # Skip elements that merely share the prefix, e.g. <idx> when looking for <id>
+    while open_at != -1 and data[open_at + len(open_tag)] not in b" />":
+        open_at = data.find(open_tag, open_at + 1, end)
+    if open_at == -1:
+        return None
+    tag_end = data.find(b">", open_at, end)
+    if tag_end == -1:
+        return None
+    if data[tag_end - 1 : tag_end] == b"/":
+        return tag_end + 1, tag_end + 1
+    close_at = data.find(b"</" + name + b">", tag_end, end)
+    if close_at == -1:
+        return None
+    return tag_end + 1, close_at
+
+
+def _element_text(data, name, start, end):
+    span = _element_span(data, name, start, end)
+    if span is None:
+        return None
+    return unescape_xml(data[span[0] : span[1]]).strip()
+
+
+REDIRECT_TITLE_RE = re.compile(rb'<redirect\s+title="([^"]*)"')
+
+
+def _iter_page_spans(xml_data):
+    """
+    Yield (page_start, header_end, page_end) for every <page> element, the
+    header is everything before <revision>.
+    """
+    pos = 0
+    while True:
+        page_start = xml_data.find(b"<page>", pos)
+        if page_start == -1:
+            return
+        page_end = xml_data.find(b"</page>", page_start)
+        if page_end == -1:
+            return
+        pos = page_end + len(b"</page>")
+
+        header_end = xml_data.find(b"<revision>", page_start, page_end)
+        if header_end == -1:
+            header_end = page_end
+        yield page_start, header_end, page_end
+
+
+def _read_page(xml_data, page_start, header_end, page_end):
+    page = {
+        "title": _element_text(xml_data, b"title", page_start, header_end),
+        "ns": _element_text(xml_data, b"ns", page_start, header_end),
+        "id": _element_text(xml_data, b"id", page_start, header_end),
+        "timestamp": _element_text(xml_data, b"timestamp", header_end, page_end),
+        "text": _element_text(xml_data, b"text", header_end, page_end),
+    }
+    redirect = REDIRECT_TITLE_RE.search(xml_data, page_start, header_end)
+    if redirect is not None:
+        page["redirect"] = unescape_xml(redirect.group(1))
+    return {key: value for key, value in page.items() if value is not None}
+
+
+def iter_article_pages(xml_data, known_timestamps=None, include_redirects=False):
+    """
+    Yield a dict with title, ns, id, timestamp and text for every main
+    namespace, non-redirect page in the decompressed XML of one bz2 stream.
+
+    The dicts have the same keys and values as the pages WikiXmlHandler
+    hands to process_page.
+
+    known_timestamps optionally maps page ids to the revision timestamp that
+    is already stored. A page whose timestamp matches is yielded as
+    {"id", "timestamp", "unchanged": True} without decoding its text.
+
+    With include_redirects main namespace redirects are yielded as well, as
+    {"title", "ns", "id", "redirect"} without their text.
+    """
+    for page_start, header_end, page_end in _iter_page_spans(xml_data):
+        # Reject by namespace and redirect before the text is touched
+        ns_span = _element_span(xml_data, b"ns", page_start, header_end)
+        if ns_span is None or xml_data[ns_span[0] : ns_span[1]].strip() != b"0":
+            continue
+        if xml_data.find(b"<redirect", page_start, header_end) != -1:
+            redirect = REDIRECT_TITLE_RE.search(xml_data, page_start, header_end)
+            if include_redirects and redirect is not None:
+                yield {
+                    "title": _element_text(xml_data, b"title", page_start, header_end),
+                    "ns": "0",
+                    "id": _element_text(xml_data, b"id", page_start, header_end),
+                    "redirect": unescape_xml(redirect.group(1)),
+                }
+            continue
+
+        if known_timestamps:
+            page_id = _element_text(xml_data, b"id", page_start, header_end)
+            timestamp = _element_text(xml_data, b"timestamp", header_end, page_end)
+            if page_id is not None and known_timestamps.get(int(page_id)) == timestamp:
+                yield {"id": page_id, "timestamp": timestamp, "unchanged": True}
+                continue
+
+        yield _read_page(xml_data, page_start, header_end, page_end)
+
+
+def find_page(xml_data, page_id):
+    """
+    Return the page dict of page_id from the decompressed XML of one bz2
+    stream, or None if the block does not hold it.
+
+    Any namespace is returned, redirects have a "redirect" key with the target title.
+    Only the matching page is decoded.
+    """
+    wanted = str(page_id).encode()
+    for page_start, header_end, page_end in _iter_page_spans(xml_data):
+        id_span = _element_span(xml_data, b"id", page_start, header_end)
+        if id_span is not None and xml_data[id_span[0] : id_span[1]].strip() == wanted:
+            return _read_page(xml_data, page_start, header_end, page_end)
+    return None
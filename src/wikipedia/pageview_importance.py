@@ -0,0 +1,234 @@
+"""
+Per-article pageview importance, kept up to date as months of pageviews arrive.
+
+The pageview_importance table of a language database has one row per
+title_match with the views of every month in the pageviews dataset as its
+own column (views_202401, views_202402, ...), the total and a time decayed
+score in which a month counts half as much every half_life_months before
+the latest month:
+
+    score = SUM(views_<month> * 0.5 ^ (months before the latest month / half_life_months))
+
+An update only aggregates the months that are new or whose files changed
+since the last update, recorded with a signature of their part files and
+of the title_match normalization in pageview_importance_months. The monthly
+columns of the other months are kept as they are, only the score and
+ranking are recomputed from them. Titles left without views in any month,
+e.g. of removed months or an old title_match normalization, are deleted.
+
+The table is stored sorted by score with score_rank 1, 2, ... so the top N
+articles are a range scan on score_rank, and title_match is indexed for
+joins with the articles table:
+
+    SELECT a.*, p.score
+    FROM pageview_importance p JOIN articles a USING (title_match)
+    WHERE p.score_rank <= 100000
+
+Usage:
+    python pageview_importance.py <database_file> <dataset_dir> <wiki_code> [half_life_months]
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+
+import duckdb
+
+from dump_index import has_table
+from pageviews_dataset import (
+    PAGEVIEW_TITLE_MATCH_SQL,
+    list_partitions,
+    pageviews_source_sql,
+    partition_dir,
+    partition_files,
+)
+
+IMPORTANCE_TABLE = "pageview_importance"
+MONTHS_TABLE = "pageview_importance_months"
+
+# Months after which the views of a month count half as much in the score
+HALF_LIFE_MONTHS = 12
+
+# Part of every month signature, a change of the title_match normalization
+# aggregates all months again
+TITLE_MATCH_VERSION = hashlib.sha256(PAGEVIEW_TITLE_MATCH_SQL.encode("utf-8")).hexdigest()[:16]
+
+
+def month_column(month):
+    return f"views_{month}"
+
+
+def month_index(month):
+    return month // 100 * 12 + month % 100 - 1
+
+
+def month_signature(dataset_dir, wiki_code, month):
+    """
+    Names, sizes and mtimes of the files of a partition and the
+    TITLE_MATCH_VERSION, changes when a part is added, replaced or compacted
+    or the title_match normalization changes. None when the partition has
+    no parts.
+    """
+    parts = []
+    for file_path in partition_files(partition_dir(dataset_dir, wiki_code, month)):
+        stat = os.stat(file_path)
+        parts.append([os.path.basename(file_path), stat.st_size, stat.st_mtime_ns])
+    if not parts:
+        return None
+    return json.dumps({"title_match": TITLE_MATCH_VERSION, "parts": parts})
+
+
+def _month_views_sql(dataset_dir, wiki_code, month):
+    return f"""
+        SELECT
+            {PAGEVIEW_TITLE_MATCH_SQL} AS title_match,
+            CAST(SUM(views) AS BIGINT) AS views
+        FROM {pageviews_source_sql(dataset_dir, wiki_code)}
+        WHERE wiki_code = '{wiki_code}' AND month = {month}
+        GROUP BY title_match
+    """
+
+
+def _score_sql(months, half_life_months):
+    latest = month_index(months[-1])
+    terms = []
+    for month in months:
+        weight = 0.5 ** ((latest - month_index(month)) / half_life_months)
+        terms.append(f"CAST(COALESCE({month_column(month)}, 0) AS DOUBLE) * {weight!r}")
+    return " + ".join(terms)
+
+
+def _update_month(conn, dataset_dir, wiki_code, month):
+    """
+    Replace the views column of month in the work table with the views
+    aggregated from its partition.
+    """
+    column = month_column(month)
+    conn.execute(
+        f"CREATE TEMP TABLE month_views AS {_month_views_sql(dataset_dir, wiki_code, month)}"
+    )
+    conn.execute(f"ALTER TABLE work DROP COLUMN IF EXISTS {column}")
+    conn.execute(f"ALTER TABLE work ADD COLUMN {column} BIGINT")
+    conn.execute(
+        """
+        INSERT INTO work (title_match)
+        SELECT title_match FROM month_views ANTI JOIN work USING (title_match)
+        """
+    )
+    conn.execute(
+        f"""
+        UPDATE work SET {column} = m.views
+        FROM month_views m
+        WHERE work.title_match = m.title_match
+        """
+    )
+    conn.execute("DROP TABLE month_views")
+
+
+def update_pageview_importance(
+    database_file, dataset_dir, wiki_code, half_life_months=HALF_LIFE_MONTHS
+):
+    """
+    Bring the pageview_importance table of database_file up to date with the
+    wiki_code partitions of the pageviews dataset and recompute the score.
+    """
+    start = time.perf_counter()
+    conn = duckdb.connect(database_file)
+    stored = {}
+    if has_table(conn, MONTHS_TABLE):
+        stored = dict(conn.execute(f"SELECT month, signature FROM {MONTHS_TABLE}").fetchall())
+    current = {}
+    for _, month in list_partitions(dataset_dir, wiki_code):
+        signature = month_signature(dataset_dir, wiki_code, month)
+        if signature is not None:
+            current[month] = signature
+    if not current:
+        # Nothing left to rank, the stored table would only have stale views
+        conn.execute(f"DROP TABLE IF EXISTS {IMPORTANCE_TABLE}")
+        conn.execute(f"DROP TABLE IF EXISTS {MONTHS_TABLE}")
+        conn.close()
+        print(f"No pageviews of {wiki_code} in {dataset_dir}")
+        return
+    changed = sorted(month for month in current if stored.get(month) != current[month])
+    removed = sorted(set(stored) - set(current))
+
+    if has_table(conn, IMPORTANCE_TABLE) and stored:
+        conn.execute(
+            f"""
+            CREATE TEMP TABLE work AS
+            SELECT * EXCLUDE (total_views, score, score_rank) FROM {IMPORTANCE_TABLE}
+            """
+        )
+    else:
+        conn.execute("CREATE TEMP TABLE work (title_match VARCHAR)")
+    for month in removed:
+        conn.execute(f"ALTER TABLE work DROP COLUMN IF EXISTS {month_column(month)}")
+    for month in changed:
+        _update_month(conn, dataset_dir, wiki_code, month)
+        print(f"Aggregated {wiki_code} pageviews of {month}")
+
+    months = sorted(current)
+    # Titles that only had views in removed or re-aggregated months
+    conn.execute(
+        f"""
+        DELETE FROM work
+        WHERE {" AND ".join(f"{month_column(month)} IS NULL" for month in months)}
+        """
+    )
+    total_sql = " + ".join(f"COALESCE({month_column(month)}, 0)" for month in months)
+    score_sql = _score_sql(months, half_life_months)
+    conn.execute("BEGIN TRANSACTION")
+    conn.execute(f"DROP INDEX IF EXISTS {IMPORTANCE_TABLE}_title_match")
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TABLE {IMPORTANCE_TABLE} AS
+        SELECT
+            title_match,
+            {", ".join(month_column(month) for month in months)},
+            {total_sql} AS total_views,
+            {score_sql} AS score,
+            ROW_NUMBER() OVER (ORDER BY {score_sql} DESC, title_match) AS score_rank
+        FROM work
+        ORDER BY score_rank
+        """
+    )
+    conn.execute(
+        f"CREATE INDEX {IMPORTANCE_TABLE}_title_match ON {IMPORTANCE_TABLE} (title_match)"
+    )
+    conn.execute(f"CREATE OR REPLACE TABLE {MONTHS_TABLE} (month INTEGER, signature VARCHAR)")
+    conn.executemany(f"INSERT INTO {MONTHS_TABLE} VALUES (?, ?)", list(current.items()))
+    conn.execute("COMMIT")
+    count = conn.execute(f"SELECT COUNT(*) FROM {IMPORTANCE_TABLE}").fetchone()[0]
+    conn.close()
+    print(
+        f"Stored pageview importance of {count} titles over {len(months)} months"
+        f" ({len(changed)} aggregated, {len(removed)} removed) in {database_file}"
+        f" in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def top_articles(conn, n):
+    """
+    Return the n articles with the highest pageview score as a DuckDB
+    relation, joined on title_match like the final filtering notebooks.
+    """
+    return conn.sql(
+        f"""
+        SELECT a.*, p.total_views, p.score, p.score_rank
+        FROM {IMPORTANCE_TABLE} p
+        JOIN articles a USING (title_match)
+        WHERE p.score_rank <= {int(n)}
+        ORDER BY p.score_rank
+        """
+    )
+
+
+def main():
+    database_file, dataset_dir, wiki_code = sys.argv[1:4]
+    half_life_months = float(sys.argv[4]) if len(sys.argv) > 4 else HALF_LIFE_MONTHS
+    update_pageview_importance(database_file, dataset_dir, wiki_code, half_life_months)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Parity check and throughput benchmark for the pageviews aggregation engines.
+
+Compares the columnar aggregate_pageviews in process_pageviews.py against
+the line by line process_pageviews on a synthetic monthly file in the
+format of the pageviews-complete user dumps.
+
+Usage:
+    python pageviews_benchmark.py [n_lines] [output_file]
+"""
+import bz2
+import os
+import random
+import sys
+import tempfile
+import time
+
+import duckdb
+import pyarrow as pa
+
+from parallel_bz2 import open_parallel_bz2
+from process_pageviews import (
+    READ_BLOCK_SIZE,
+    WIKI_CODES,
+    aggregate_pageviews,
+    process_pageviews,
+)
+
+# Wiki codes of the synthetic file, the wanted ones are a small share of the
+# lines like in the real dumps
+OTHER_WIKI_CODES = [
+    "aa.wikibooks", "commons.wikimedia", "es.wikipedia", "fr.wikipedia",
+    "ja.wikipedia", "ru.wikipedia", "en.wiktionary", "zh.wikipedia",
+]
+
+HOURS = "ABCDEFGHIJKLMNOPQRSTUVWX"
+
+
+def write_synthetic_file(path, n_lines, seed=0):
+    """
+    Write n_lines pageview lines to a .bz2 file at path.
+
+    Titles are drawn with a skewed distribution so popular titles repeat
+    across access methods and page ids, some lines have no page id and only
+    5 columns, and a few are broken.
+    """
+    rng = random.Random(seed)
+    wiki_codes = WIKI_CODES[:5] + OTHER_WIKI_CODES
+    with bz2.open(path, "wt", encoding="utf-8") as f:
+        for i in range(n_lines):
+            wiki_code = rng.choice(wiki_codes)
+            title = f"Title_{int(rng.paretovariate(0.8)) % 200_000}"
+            if i % 97 == 0:
+                title += '_"quoted"_(ß)'
+            page_id = str(rng.randint(1, 10_000_000)) if rng.random() < 0.9 else "null"
+            access_method = rng.choice(["desktop", "mobile-web", "mobile-app"])
+            views = rng.randint(1, 300)
+            hourly = f"{rng.choice(HOURS)}{views}"
+            if i % 1000 == 0:
+                f.write(f"{wiki_code} {title} {access_method} {views} {hourly}\n")
+            elif i % 5000 == 1:
+                f.write(f"{wiki_code} {title} {page_id} {access_method} n/a {hourly}\n")
+            else:
+                f.write(f"{wiki_code} {title} {page_id} {access_method} {views} {hourly}\\1\n")
+
+
+def decompress_only(bz2_file_path, wiki_codes):
+    """
+    Only decompress the file, the floor both engines share.
+    """
+    with pa.input_stream(bz2_file_path, compression="bz2") as stream:
+        while stream.read(READ_BLOCK_SIZE):
+            pass
+
+
+def decompress_parallel(bz2_file_path, wiki_codes):
+    """
+    Only decompress the file, with the blocks spread over all cores.
+    """
+    with open_parallel_bz2(bz2_file_path, threads=os.cpu_count()) as f:
+        while f.read(READ_BLOCK_SIZE):
+            pass
+
+
+def reference_views(bz2_file_path, wiki_codes):
+    """
+    process_pageviews as a dict of (wiki_code, article_title) to
+    (views, sorted integer page_ids), the form of aggregate_pageviews.
+    """
+    return {
+        key: (
+            stats["views"],
+            sorted(int(page_id) for page_id in stats["page_ids"] if page_id != "null"),
+        )
+        for key, stats in process_pageviews(bz2_file_path, wiki_codes).items()
+    }
+
+
+def columnar_views(bz2_file_path, wiki_codes):
+    conn = duckdb.connect()
+    rows = aggregate_pageviews(bz2_file_path, wiki_codes, conn).fetchall()
+    conn.close()
+    return {
+        (wiki_code, article_title): (views, page_ids)
+        for wiki_code, article_title, views, page_ids in rows
+    }
+
+
+def check_parity(bz2_file_path, wiki_codes):
+    """
+    Return the (key, reference_value, columnar_value) of every title the
+    engines disagree on.
+    """
+    expected, result = reference_views(bz2_file_path, wiki_codes), columnar_views(
+        bz2_file_path, wiki_codes
+    )
+    return [
+        (key, expected.get(key), result.get(key))
+        for key in expected.keys() | result.keys()
+        if expected.get(key) != result.get(key)
+    ]
+
+
+def benchmark(bz2_file_path, wiki_codes, repeat=3):
+    """
+    Return the best-of-repeat seconds of each engine on the file, and of
+    decompression alone.
+    """
+    runs = {
+        "bz2 only": decompress_only,
+        "bz2 parallel": decompress_parallel,
+        "python": reference_views,
+        "columnar": columnar_views,
+    }
+    results = {}
+    for name, aggregate in runs.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            aggregate(bz2_file_path, wiki_codes)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+    return results
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(tmp_dir, "pageviews-user.bz2")
+        if not os.path.exists(path):
+            write_synthetic_file(path, n_lines)
+        print(f"Pageviews file {path}, {os.path.getsize(path) / 1024 / 1024:.1f} MB bz2")
+
+        mismatches = check_parity(path, WIKI_CODES)
+        print(f"Parity: {len(mismatches)} mismatching titles")
+        for key, expected, result in mismatches[:10]:
+            print(f"  {key}: {expected} != {result}")
+
+        for name, seconds in benchmark(path, WIKI_CODES).items():
+            print(f"{name:>12}: {seconds:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
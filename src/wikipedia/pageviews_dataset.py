@@ -0,0 +1,393 @@
+"""
+Hive partitioned dataset of the aggregated pageviews.
+
+Every processed pageviews file adds one part file per language to the
+partition of its month, existing files are never rewritten:
+
+    <dataset_dir>/wiki_code=en.wikipedia/month=202501/part-pageviews-202501-user.parquet
+
+Reprocessing a file replaces its own part. A month built from several files
+(e.g. the daily dumps) has one part per file, compact merges them into one
+file per partition, summing the views of titles seen in several parts.
+
+The merged file is named so the *.parquet glob does not match it, and the
+partition's _compacted.json names it together with the parts it replaces.
+Replacing _compacted.json is the single atomic step of a compaction, the
+readers take the files of a partition from partition_files, so a crash
+at any point leaves every view counted once and the next compact removes
+the leftovers.
+
+The manifest, _manifest.json in the dataset directory, records the size and
+mtime of every processed file and the wiki codes it was processed for, so
+only new or changed files are processed again (see pending_files).
+
+DuckDB reads the dataset with the partition columns wiki_code and month,
+filters on them only open the matching directories:
+
+    conn = duckdb.connect(DATABASE_FILE)
+    create_pageviews_view(conn, DATASET_DIR, wiki_code="en.wikipedia")
+    conn.sql("SELECT title_match, SUM(views) FROM pageviews WHERE month >= 202401 GROUP BY 1")
+
+The view lists the files of the dataset when it is created, create it again
+after processing or compacting.
+
+Usage:
+    python pageviews_dataset.py compact <dataset_dir> [wiki_code]
+"""
+import glob
+import json
+import os
+import re
+import shutil
+import sys
+import uuid
+
+import duckdb
+
+from article_store import title_match_sql
+
+PART_PREFIX = "part-"
+
+# Merged file of a compacted partition, compacted-<id>.parquet.compacted, and
+# the file in the partition naming it and the parts it replaces
+COMPACTED_SUFFIX = ".parquet.compacted"
+COMPACTED_MANIFEST = "_compacted.json"
+
+# pageviews-202501-user.bz2 (monthly) or pageviews-20250101-user.bz2 (daily)
+PAGEVIEWS_FILE_RE = re.compile(r"pageviews-(\d{6})(\d{2})?-")
+
+HIVE_TYPES_SQL = "{'wiki_code': VARCHAR, 'month': INTEGER}"
+
+MANIFEST_FILE = "_manifest.json"
+
+# Pageview titles have underscores for spaces, unlike the article titles
+PAGEVIEW_TITLE_MATCH_SQL = title_match_sql("REPLACE(article_title, '_', ' ')")
+
+
+def file_month(bz2_file_path):
+    """
+    Return the month of a pageviews file as an integer, e.g. 202501.
+    """
+    match = PAGEVIEWS_FILE_RE.search(os.path.basename(bz2_file_path))
+    if match is None:
+        raise ValueError(f"No month in pageviews file name {bz2_file_path}")
+    return int(match.group(1))
+
+
+def part_name(bz2_file_path):
+    file_name = os.path.basename(bz2_file_path)
+    return PART_PREFIX + file_name.removesuffix(".bz2") + ".parquet"
+
+
+def partition_dir(dataset_dir, wiki_code, month):
+    return os.path.join(dataset_dir, f"wiki_code={wiki_code}", f"month={month}")
+
+
+def write_part(conn, query, dataset_dir, wiki_code, month, bz2_file_path):
+    """
+    Write the (article_title, views, page_ids) rows of query as the part of
+    bz2_file_path in its partition, replacing the part of an earlier run.
+    """
+    directory = partition_dir(dataset_dir, wiki_code, month)
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, part_name(bz2_file_path))
+    conn.execute(
+        f"""
+        COPY (SELECT article_title, views, page_ids FROM ({query}))
+        TO '{file_path}.tmp' (FORMAT parquet, COMPRESSION zstd)
+        """
+    )
+    os.replace(file_path + ".tmp", file_path)
+    return file_path
+
+
+def remove_parts(dataset_dir, bz2_file_path):
+    """
+    Remove the parts of bz2_file_path from all partitions of its month.
+    """
+    month = file_month(bz2_file_path)
+    pattern = os.path.join(dataset_dir, "wiki_code=*", f"month={month}", part_name(bz2_file_path))
+    for file_path in glob.glob(pattern):
+        os.remove(file_path)
+
+
+def is_compacted(dataset_dir, month):
+    pattern = os.path.join(dataset_dir, "wiki_code=*", f"month={month}", COMPACTED_MANIFEST)
+    return bool(glob.glob(pattern))
+
+
+def read_compacted(directory):
+    """
+    Return the compaction record of a partition directory, a dict with the
+    merged file name and the names of the parts it replaces, or None.
+    """
+    path = os.path.join(directory, COMPACTED_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def partition_files(directory):
+    """
+    Return the files of a partition directory that hold its rows, sorted:
+    the merged file of its last compaction and the parts written since.
+    Parts the merged file replaces are left out.
+    """
+    files = sorted(glob.glob(os.path.join(directory, "*.parquet")))
+    compacted = read_compacted(directory)
+    if compacted is None:
+        return files
+    replaced = set(compacted["parts"])
+    files = [f for f in files if os.path.basename(f) not in replaced]
+    return sorted(files + [os.path.join(directory, compacted["file"])])
+
+
+def remove_month(dataset_dir, month):
+    for directory in glob.glob(os.path.join(dataset_dir, "wiki_code=*", f"month={month}")):
+        shutil.rmtree(directory)
+
+
+def read_manifest(dataset_dir):
+    """
+    Return the manifest of dataset_dir, a dict of pageviews file name to its
+    size, mtime_ns, wiki_codes and languages.
+    """
+    path = os.path.join(dataset_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(dataset_dir, manifest):
+    path = os.path.join(dataset_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def manifest_entry(bz2_file_path, wiki_codes, languages):
+    stat = os.stat(bz2_file_path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "wiki_codes": sorted(wiki_codes),
+        "languages": sorted(languages),
+    }
+
+
+def is_processed(manifest, bz2_file_path, wiki_codes):
+    """
+    True when bz2_file_path is in the manifest with its current size and
+    mtime and was processed for all of wiki_codes.
+    """
+    entry = manifest.get(os.path.basename(bz2_file_path))
+    if entry is None:
+        return False
+    stat = os.stat(bz2_file_path)
+    return (
+        entry["size"] == stat.st_size
+        and entry["mtime_ns"] == stat.st_mtime_ns
+        and set(wiki_codes) <= set(entry["wiki_codes"])
+    )
+
+
+def pending_files(dataset_dir, bz2_files, wiki_codes):
+    """
+    Return the files of bz2_files that need processing and prepare the
+    dataset for them: their manifest entries and old parts are removed.
+
+    The parts of a compacted month can no longer be replaced one by one, so
+    a pending file in a compacted month makes all files of that month
+    pending and its partitions are removed.
+    """
+    manifest = read_manifest(dataset_dir)
+    pending = [f for f in bz2_files if not is_processed(manifest, f, wiki_codes)]
+    compacted_months = {
+        file_month(f) for f in pending if is_compacted(dataset_dir, file_month(f))
+    }
+    pending = [f for f in bz2_files if f in pending or file_month(f) in compacted_months]
+
+    for bz2_file_path in pending:
+        manifest.pop(os.path.basename(bz2_file_path), None)
+    write_manifest(dataset_dir, manifest)
+    for month in compacted_months:
+        remove_month(dataset_dir, month)
+    for bz2_file_path in pending:
+        remove_parts(dataset_dir, bz2_file_path)
+    return pending
+
+
+def record_processed(dataset_dir, bz2_file_path, wiki_codes, languages):
+    """
+    Add bz2_file_path to the manifest once all its parts are written.
+    """
+    manifest = read_manifest(dataset_dir)
+    manifest[os.path.basename(bz2_file_path)] = manifest_entry(
+        bz2_file_path, wiki_codes, languages
+    )
+    write_manifest(dataset_dir, manifest)
+
+
+def pageviews_source_sql(dataset_dir, wiki_code=None):
+    """
+    SQL reading the rows of the dataset, or of wiki_code, with the partition
+    columns. The files are listed now, see partition_files.
+    """
+    files = [
+        file_path
+        for partition_code, month in list_partitions(dataset_dir, wiki_code)
+        for file_path in partition_files(partition_dir(dataset_dir, partition_code, month))
+    ]
+    if not files:
+        return """(
+            SELECT
+                NULL::VARCHAR AS article_title,
+                NULL::BIGINT AS views,
+                NULL::BIGINT[] AS page_ids,
+                NULL::INTEGER AS month,
+                NULL::VARCHAR AS wiki_code
+            WHERE false
+        )"""
+    return (
+        f"read_parquet({files},"
+        f" hive_partitioning = true, hive_types = {HIVE_TYPES_SQL})"
+    )
+
+
+def read_pageviews(conn, dataset_dir, wiki_code=None, first_month=None, last_month=None):
+    """
+    Return the pageviews rows (article_title, views, page_ids, wiki_code,
+    month) of wiki_code between first_month and last_month, inclusive, as a
+    DuckDB relation. Partitions outside the filter are not read.
+
+    Before compaction a title can have several rows per month.
+    """
+    conditions = []
+    if wiki_code is not None:
+        conditions.append(f"wiki_code = '{wiki_code}'")
+    if first_month is not None:
+        conditions.append(f"month >= {int(first_month)}")
+    if last_month is not None:
+        conditions.append(f"month <= {int(last_month)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return conn.sql(f"SELECT * FROM {pageviews_source_sql(dataset_dir, wiki_code)} {where}")
+
+
+def create_pageviews_view(conn, dataset_dir, wiki_code=None, name="pageviews"):
+    """
+    Create a view over the dataset with the title_match column of the
+    articles table, for the filtering step to join on.
+    """
+    where = f"WHERE wiki_code = '{wiki_code}'" if wiki_code is not None else ""
+    conn.execute(
+        f"""
+        CREATE OR REPLACE VIEW {name} AS
+        SELECT *, {PAGEVIEW_TITLE_MATCH_SQL} AS title_match
+        FROM {pageviews_source_sql(dataset_dir, wiki_code)}
+        {where}
+        """
+    )
+
+
+def list_partitions(dataset_dir, wiki_code=None):
+    """
+    Return the (wiki_code, month) of all partitions, sorted.
+    """
+    pattern = os.path.join(dataset_dir, f"wiki_code={wiki_code or '*'}", "month=*")
+    partitions = []
+    for directory in glob.glob(pattern):
+        code_dir, month_dir = os.path.split(directory)
+        partitions.append(
+            (os.path.basename(code_dir).split("=", 1)[1], int(month_dir.split("=", 1)[1]))
+        )
+    return sorted(partitions)
+
+
+def remove_superseded(directory):
+    """
+    Remove what an interrupted compaction left in a partition directory:
+    the parts its merged file replaces and merged files it does not name.
+    """
+    compacted = read_compacted(directory)
+    keep = compacted["file"] if compacted is not None else None
+    for file_path in glob.glob(os.path.join(directory, "*" + COMPACTED_SUFFIX + "*")):
+        if os.path.basename(file_path) != keep:
+            os.remove(file_path)
+    if compacted is not None:
+        for part in compacted["parts"]:
+            part_path = os.path.join(directory, part)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+
+def compact_partition(conn, dataset_dir, wiki_code, month):
+    """
+    Merge the files of a partition into one file sorted by article_title.
+
+    The merged file gets a new name the *.parquet glob does not match and
+    is committed by replacing the partition's _compacted.json, which names
+    it and the parts it replaces. The replaced files are removed after
+    that, a crash at any point leaves them to remove_superseded and readers
+    of partition_files count every view once.
+    Returns False when the partition has a single file already.
+    """
+    directory = partition_dir(dataset_dir, wiki_code, month)
+    remove_superseded(directory)
+    files = partition_files(directory)
+    if len(files) <= 1:
+        return False
+
+    compacted = read_compacted(directory)
+    merged_file = f"compacted-{uuid.uuid4().hex}{COMPACTED_SUFFIX}"
+    conn.execute(
+        f"""
+        COPY (
+            SELECT
+                article_title,
+                CAST(SUM(views) AS BIGINT) AS views,
+                list_sort(list_distinct(flatten(list(page_ids)))) AS page_ids
+            FROM read_parquet({files})
+            GROUP BY article_title
+            ORDER BY article_title
+        ) TO '{os.path.join(directory, merged_file)}' (FORMAT parquet, COMPRESSION zstd)
+        """
+    )
+    parts = [os.path.basename(f) for f in files if f.endswith(".parquet")]
+    path = os.path.join(directory, COMPACTED_MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"file": merged_file, "parts": parts}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+    if compacted is not None:
+        os.remove(os.path.join(directory, compacted["file"]))
+    for part in parts:
+        os.remove(os.path.join(directory, part))
+    return True
+
+
+def compact(dataset_dir, wiki_code=None):
+    """
+    Compact every partition of the dataset, or of wiki_code, with more than
+    one file, and remove the leftovers of interrupted compactions.
+    """
+    conn = duckdb.connect()
+    compacted = 0
+    for partition_code, month in list_partitions(dataset_dir, wiki_code):
+        if compact_partition(conn, dataset_dir, partition_code, month):
+            compacted += 1
+            print(f"Compacted {partition_code} {month}")
+    conn.close()
+    print(f"Compacted {compacted} partitions of {dataset_dir}")
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != "compact":
+        print(__doc__)
+        sys.exit(1)
+    compact(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Parallel decompression of a single bz2 file, in the way of pbzip2.
+
+A bz2 stream is a sequence of independently compressed blocks of at most
+900 kB, but they are not byte aligned: every block starts with the 48 bit
+magic 0x314159265359 at an arbitrary bit position and the stream ends with
+the 48 bit magic 0x177245385090, the combined CRC and padding. The file is
+memory mapped and scanned for both magics at all 8 bit shifts. The bits of
+every block are then wrapped into a stream of their own (header, block,
+end of stream magic, the block CRC as combined CRC, padding) and
+decompressed by a thread pool, bz2 releases the GIL while decompressing.
+
+The decompressed blocks are yielded in file order, ParallelBZ2Reader turns
+them into a file object:
+
+    with open_parallel_bz2(path, "rt", threads=8) as f:
+        for line in f:
+            ...
+
+A magic can occur by chance inside compressed data, both the block and the
+end of stream magic. Such a false boundary makes its block fail to
+decompress, the block is then extended to the next candidate boundary of
+either kind until it decompresses, and the blocks found inside it are
+dropped.
+"""
+import bz2
+import collections
+import io
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+
+# Block header after the magic, the 32 bit block CRC
+CRC_BITS = 32
+
+# Compressed bytes scanned for block boundaries at a time
+SCAN_WINDOW = 32 * 1024 * 1024
+
+# Blocks decompressing or waiting to be read, per thread
+BLOCKS_IN_FLIGHT_PER_THREAD = 4
+
+# Compressed bytes scanned at a time for the next boundary of a block with a
+# false boundary, a compressed block is rarely larger than its 900 kB
+MERGE_SCAN_WINDOW = 1024 * 1024
+
+
+def _magic_patterns(magic):
+    """
+    Return (shift, pattern) for the 8 bit shifts of magic within a byte:
+    pattern is bytes 1 to 5 of the 7 bytes covering a magic that starts at
+    bit shift of its first byte, the bytes the magic fully determines.
+    """
+    patterns = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, "big")
+        patterns.append((shift, window[1:6]))
+    return patterns
+
+
+BLOCK_PATTERNS = _magic_patterns(BLOCK_MAGIC)
+EOS_PATTERNS = _magic_patterns(EOS_MAGIC)
+
+
+def _bits_at(data, bit_position, n_bits):
+    first = bit_position // 8
+    last = (bit_position + n_bits + 7) // 8
+    if last > len(data):
+        return None
+    value = int.from_bytes(data[first:last], "big")
+    return (value >> (last * 8 - bit_position - n_bits)) & ((1 << n_bits) - 1)
+
+
+def _find_magics(data, start, end, patterns, magic):
+    """
+    Return the bit positions in [start * 8, end * 8) where magic starts.
+    """
+    positions = []
+    for shift, pattern in patterns:
+        # The pattern starts one byte after the first byte of the magic
+        stop = end + len(pattern)
+        position = data.find(pattern, start + 1, stop)
+        while position != -1:
+            bit_position = (position - 1) * 8 + shift
+            if _bits_at(data, bit_position, MAGIC_BITS) == magic:
+                positions.append(bit_position)
+            position = data.find(pattern, position + 1, stop)
+    return positions
+
+
+def iter_block_ranges(data, window=SCAN_WINDOW):
+    """
+    Yield the (start_bit, end_bit) of every block of the bz2 data, from its
+    block magic to the next block or end of stream magic, scanning window
+    bytes at a time. False magics yield ranges that do not decompress, see
+    _merge_false_boundaries.
+    """
+    if data[:3] != b"BZh":
+        raise ValueError("Not a bz2 file")
+    block_start = None
+    for start in range(0, len(data), window):
+        end = min(start + window, len(data))
+        block_starts = _find_magics(data, start, end, BLOCK_PATTERNS, BLOCK_MAGIC)
+        stream_ends = _find_magics(data, start, end, EOS_PATTERNS, EOS_MAGIC)
+        markers = sorted(
+            [(position, True) for position in block_starts]
+            + [(position, False) for position in stream_ends]
+        )
+        for position, is_block in markers:
+            if block_start is not None:
+                yield block_start, position
+            block_start = position if is_block else None
+    if block_start is not None:
+        raise ValueError("Truncated bz2 file, the last block has no end of stream")
+
+
+def _next_boundary(data, bit_position, window=MERGE_SCAN_WINDOW):
+    """
+    Return the bit position of the first block or end of stream magic after
+    bit_position, None when there is none.
+    """
+    start = bit_position // 8
+    while start < len(data):
+        end = min(start + window, len(data))
+        positions = [
+            position
+            for patterns, magic in ((BLOCK_PATTERNS, BLOCK_MAGIC), (EOS_PATTERNS, EOS_MAGIC))
+            for position in _find_magics(data, start, end, patterns, magic)
+            if position > bit_position
+        ]
+        if positions:
+            return min(positions)
+        start = end
+    return None
+
+
+def block_stream(data, start_bit, end_bit):
+    """
+    Return the bits of the block at [start_bit, end_bit) of data as a
+    complete single block bz2 stream.
+    """
+    n_bits = end_bit - start_bit
+    block = _bits_at(data, start_bit, n_bits)
+    block_crc = (block >> (n_bits - MAGIC_BITS - CRC_BITS)) & 0xFFFFFFFF
+    n_stream_bits = n_bits + MAGIC_BITS + CRC_BITS
+    padding = -n_stream_bits % 8
+    value = ((block << MAGIC_BITS | EOS_MAGIC) << CRC_BITS | block_crc) << padding
+    return b"BZh9" + value.to_bytes((n_stream_bits + padding) // 8, "big")
+
+
+def decompress_block(data, start_bit, end_bit):
+    return bz2.decompress(block_stream(data, start_bit, end_bit))
+
+
+def iter_decompressed_blocks(data, threads=None):
+    """
+    Yield the decompressed blocks of the bz2 data in order, decompressing
+    up to threads blocks at a time.
+    """
+    threads = threads or os.cpu_count()
+    ranges = iter_block_ranges(data)
+    pending = collections.deque()
+    # End of the last block merged over false boundaries, the blocks
+    # starting before it are parts of that block
+    merged_end_bit = -1
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+
+        def submit_next():
+            block_range = next(ranges, None)
+            if block_range is not None:
+                future = executor.submit(decompress_block, data, *block_range)
+                pending.append((block_range, future))
+
+        for _ in range(threads * BLOCKS_IN_FLIGHT_PER_THREAD):
+            submit_next()
+        while pending:
+            (start_bit, end_bit), future = pending.popleft()
+            if start_bit < merged_end_bit:
+                future.cancel()
+                submit_next()
+                continue
+            try:
+                block_data = future.result()
+            except (OSError, ValueError):
+                block_data, merged_end_bit = _merge_false_boundaries(data, start_bit, end_bit)
+            submit_next()
+            yield block_data
+
+
+def _merge_false_boundaries(data, start_bit, end_bit):
+    """
+    Decompress the block at [start_bit, end_bit) after end_bit turned out
+    to be a false boundary, extending the block to the next block or end of
+    stream magic until it decompresses. Returns the decompressed data and
+    the end of the block.
+    """
+    while True:
+        end_bit = _next_boundary(data, end_bit)
+        if end_bit is None:
+            raise OSError("Invalid bz2 data")
+        try:
+            return decompress_block(data, start_bit, end_bit), end_bit
+        except (OSError, ValueError):
+            continue
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """
+    Read only binary file object over the decompressed data of a bz2 file,
+    decompressed by iter_decompressed_blocks.
+    """
+
+    def __init__(self, path, threads=None):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._blocks = iter_decompressed_blocks(self._mmap, threads)
+        self._buffer = b""
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._position == len(self._buffer):
+            self._buffer = next(self._blocks, None)
+            self._position = 0
+            if self._buffer is None:
+                self._buffer = b""
+                return 0
+        n = min(len(b), len(self._buffer) - self._position)
+        b[:n] = self._buffer[self._position : self._position + n]
+        self._position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._blocks.close()
+            self._mmap.close()
+            self._file.close()
+        super().close()
+
+
+def open_parallel_bz2(path, mode="rb", threads=None, encoding="utf-8"):
+    """
+    Open a bz2 file for reading with parallel decompression, like bz2.open
+    with mode "rb" or "rt".
+    """
+    reader = io.BufferedReader(ParallelBZ2Reader(path, threads), buffer_size=1024 * 1024)
+    if mode == "rb":
+        return reader
+    if mode == "rt":
+        return io.TextIOWrapper(reader, encoding=encoding)
+    raise ValueError(f"Unsupported mode {mode}")
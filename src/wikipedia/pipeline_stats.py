@@ -0,0 +1,177 @@
+"""
+Per-stage throughput counters and profiling for the dump ingestion processes.
+
+Every worker and writer keeps a StageStats with the seconds spent per stage
+and counters (blocks, bytes, articles). It sends its deltas to the parent
+through a stats queue about once a second, where a StatsReporter thread
+aggregates them and prints throughput and queue depths periodically.
+
+With profiling enabled each process runs under cProfile and dumps its stats
+to a file, merge_profiles combines them into one pstats report.
+"""
+import cProfile
+import glob
+import os
+import pstats
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Seconds between the stats sent by a process to the parent
+STATS_FLUSH_SECONDS = 1.0
+
+STATS_DONE = "DONE"
+
+
+class StageStats:
+    """
+    Seconds per stage and counters of one process, sent to the parent as deltas.
+    """
+
+    def __init__(self, role, stats_queue=None):
+        self.role = role
+        self.stats_queue = stats_queue
+        self.seconds = Counter()
+        self.counts = Counter()
+        self.last_flush = time.perf_counter()
+        self._nested_seconds = []
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Add the time spent in the block to stage. Stages can be nested, the
+        time of an inner stage is not counted again in the outer one.
+        """
+        start = time.perf_counter()
+        self._nested_seconds.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[stage] += elapsed - self._nested_seconds.pop()
+            if self._nested_seconds:
+                self._nested_seconds[-1] += elapsed
+
+    def add(self, **counts):
+        self.counts.update(counts)
+
+    def flush(self, force=False):
+        """
+        Send the stats gathered since the last flush to the parent, at most
+        once per STATS_FLUSH_SECONDS unless force is set.
+        """
+        now = time.perf_counter()
+        if self.stats_queue is None or not (
+            force or now - self.last_flush >= STATS_FLUSH_SECONDS
+        ):
+            return
+        self.stats_queue.put((self.role, dict(self.seconds), dict(self.counts)))
+        self.seconds.clear()
+        self.counts.clear()
+        self.last_flush = now
+
+
+def queue_size(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None  # qsize is not available on macOS
+
+
+class StatsReporter(threading.Thread):
+    """
+    Thread in the parent that aggregates the stats of all processes and
+    prints a progress line every interval seconds.
+
+    queue_depths maps a label to a function returning the current depth of a
+    queue, e.g. the number of batches waiting for a worker.
+    """
+
+    def __init__(self, stats_queue, queue_depths, interval=30.0):
+        super().__init__(daemon=True)
+        self.stats_queue = stats_queue
+        self.queue_depths = queue_depths
+        self.interval = interval
+        self.seconds = {}
+        self.counts = Counter()
+        self.start_time = None
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        next_report = self.start_time + self.interval
+        while True:
+            try:
+                message = self.stats_queue.get(timeout=max(next_report - time.perf_counter(), 0.1))
+            except queue.Empty:
+                message = None
+            if message == STATS_DONE:
+                return
+            if message is not None:
+                role, seconds, counts = message
+                self.seconds.setdefault(role, Counter()).update(seconds)
+                self.counts.update(counts)
+            if time.perf_counter() >= next_report:
+                self.report()
+                next_report += self.interval
+
+    def stop(self):
+        self.stats_queue.put(STATS_DONE)
+        self.join()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        counts = self.counts
+        mb = 1024 * 1024
+        depths = []
+        for label, depth in self.queue_depths.items():
+            value = depth()
+            depths.append(f"{label} {'n/a' if value is None else value}")
+        cached = f", {counts['cached_blocks']} cached" if counts["cached_blocks"] else ""
+        print(
+            f"[{elapsed:7.0f}s] {counts['blocks']} blocks ({counts['blocks'] / elapsed:.1f}/s{cached})"
+            f" | {counts['bz2_bytes'] / mb / elapsed:.1f} MB/s bz2"
+            f", {counts['xml_bytes'] / mb / elapsed:.1f} MB/s xml"
+            f" | {counts['articles']} articles ({counts['articles'] / elapsed:.0f}/s)"
+            f" | {', '.join(depths)}"
+        )
+        for role, seconds in self.seconds.items():
+            total = sum(seconds.values()) or 1.0
+            shares = " ".join(
+                f"{stage} {value / total:.0%}" for stage, value in seconds.items()
+            )
+            print(f"{'':>10} {role} time: {shares}")
+
+
+def run_profiled(profile_path, target, *args):
+    """
+    Run target(*args) under cProfile and dump the stats to profile_path.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        target(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+
+
+def merge_profiles(profile_dir, sort_by="cumulative", limit=40):
+    """
+    Merge the .prof files of all processes in profile_dir into merged.prof
+    and print the top functions.
+    """
+    paths = sorted(
+        path
+        for path in glob.glob(os.path.join(profile_dir, "*.prof"))
+        if os.path.basename(path) != "merged.prof"
+    )
+    if not paths:
+        print(f"No profiles found in {profile_dir}")
+        return None
+    stats = pstats.Stats(*paths)
+    stats.dump_stats(os.path.join(profile_dir, "merged.prof"))
+    print(f"Merged {len(paths)} profiles into {profile_dir}/merged.prof")
+    stats.sort_stats(sort_by).print_stats(limit)
+    return stats
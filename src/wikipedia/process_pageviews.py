@@ -1,37 +1,80 @@
 import os
-import bz2
+import shutil
 from collections import defaultdict
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+from pageviews_dataset import file_month, pending_files, record_processed, write_part
+from parallel_bz2 import open_parallel_bz2
 
 # Filesystem paths
 DATA_DIR = "/Users/einar/git/hafsteinn/together_rag/data/wikipedia_meta/"
 OUTPUT_DIR = "/Users/einar/git/hafsteinn/together_rag/data/wikipedia_meta/aggregated/"
 
-# Ensure the output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Languages to keep, all of them are aggregated in one pass over each file
+WIKI_CODES = [
+    "is.wikipedia", "no.wikipedia", "nn.wikipedia", "de.wikipedia",
+    "en.wikipedia", "fo.wikipedia",
+    "nl.wikipedia", "se.wikipedia", "dk.wikipedia", "lu.wikipedia",
+]
+
+# Number of files processed in parallel, the cores left over are used to
+# decompress the blocks of a file in parallel (see parallel_bz2.py)
+NUM_PROCESSES = os.cpu_count()
+
+# Hive partitioned output, one part per input file and language (see pageviews_dataset.py)
+DATASET_DIR = os.path.join(OUTPUT_DIR, "pageviews")
+
+# DuckDB spill files of the running aggregations
+TMP_DIR = os.path.join(OUTPUT_DIR, "_tmp")
+
+# Bytes of decompressed text parsed into one Arrow batch
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+# DuckDB settings of each file's aggregation, the group by spills to disk
+# beyond the memory limit, so the processes must share the machine's memory.
+# DUCKDB_THREADS is the most threads a file's aggregation gets out of the
+# file's share of the cores, the rest decompress
+DUCKDB_THREADS = 2
+DUCKDB_MEMORY_LIMIT = "4GB"
 
-# Languages to keep, split into three batches
-WIKI_CODES_BATCHES = [
-    ["is.wikipedia", "no.wikipedia", "nn.wikipedia", "de.wikipedia"],
-    ["en.wikipedia", "fo.wikipedia"],
-    ["nl.wikipedia", "se.wikipedia", "dk.wikipedia", "lu.wikipedia"],
+# Columns of a pageviews line, the hourly counts are never parsed
+PAGEVIEW_COLUMNS = [
+    "wiki_code", "article_title", "page_id", "access_method", "views", "hourly_counts",
 ]
 
+PAGEVIEW_SCHEMA = pa.schema(
+    [
+        ("wiki_code", pa.string()),
+        ("article_title", pa.string()),
+        ("page_id", pa.int64()),
+        ("views", pa.int64()),
+    ]
+)
+
 
-def process_pageviews(bz2_file_path, wiki_codes_to_keep):
+def process_pageviews(bz2_file_path, wiki_codes_to_keep, decompress_threads=1):
     """
     Process a single .bz2 pageviews file and aggregate data for specified wiki codes.
 
+    Line by line reference implementation of aggregate_pageviews, kept for
+    pageviews_benchmark.py.
+
     Parameters:
         bz2_file_path (str): Path to the .bz2 file.
         wiki_codes_to_keep (list): List of wiki codes to process.
+        decompress_threads (int): Threads decompressing the bz2 blocks.
 
     Returns:
         defaultdict: Aggregated views and page_ids per (wiki_code, article_title).
     """
+    wiki_codes_to_keep = set(wiki_codes_to_keep)
     monthly_views = defaultdict(lambda: {"views": 0, "page_ids": set()})
 
-    with bz2.open(bz2_file_path, "rt") as file:
+    with open_parallel_bz2(bz2_file_path, "rt", decompress_threads) as file:
         for line in file:
             parts = line.strip().split()
             if len(parts) < 6:
@@ -55,86 +98,180 @@ def process_pageviews(bz2_file_path, wiki_codes_to_keep):
     return monthly_views
 
 
-def monthly_stats_to_df(monthly_stats):
-    """
-    Convert aggregated monthly_stats to a pandas DataFrame.
+def skip_invalid_row(row):
+    return "skip"  # Lines without a page id have only 5 columns
 
-    Parameters:
-        monthly_stats (dict): Aggregated data.
 
-    Returns:
-        pd.DataFrame: DataFrame containing aggregated data.
+def iter_pageview_batches(
+    bz2_file_path, wiki_codes_to_keep, block_size=READ_BLOCK_SIZE, decompress_threads=1
+):
     """
-    data = []
-    for (wiki_code, article_title), stats in monthly_stats.items():
-        data.append(
-            {
-                "wiki_code": wiki_code,
-                "article_title": article_title,
-                "views": stats["views"],
-                "page_ids": list(stats["page_ids"]),
-            }
-        )
+    Stream a .bz2 pageviews file as Arrow record batches of PAGEVIEW_SCHEMA,
+    keeping the rows of wiki_codes_to_keep.
 
-    df = pd.DataFrame(data)
-    return df
+    The decompressed text is parsed by the Arrow CSV reader in chunks of
+    block_size bytes and filtered with vectorized predicates: rows with a
+    non numeric view count are dropped and a "null" page id becomes null.
+    """
+    with open_parallel_bz2(bz2_file_path, threads=decompress_threads) as file:
+        yield from _filter_pageview_batches(file, wiki_codes_to_keep, block_size)
+
+
+def _filter_pageview_batches(file, wiki_codes_to_keep, block_size):
+    value_set = pa.array(sorted(set(wiki_codes_to_keep)), type=pa.string())
+    reader = pacsv.open_csv(
+        file,
+        read_options=pacsv.ReadOptions(column_names=PAGEVIEW_COLUMNS, block_size=block_size),
+        parse_options=pacsv.ParseOptions(
+            delimiter=" ", quote_char=False, invalid_row_handler=skip_invalid_row
+        ),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=["wiki_code", "article_title", "page_id", "views"],
+            column_types={name: pa.string() for name in PAGEVIEW_COLUMNS},
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    for batch in reader:
+        batch = batch.filter(pc.is_in(batch.column("wiki_code"), value_set=value_set))
+        batch = batch.filter(pc.utf8_is_digit(batch.column("views")))
+        if batch.num_rows == 0:
+            continue
+        page_id = batch.column("page_id")
+        page_id = pc.if_else(pc.utf8_is_digit(page_id), page_id, pa.scalar(None, pa.string()))
+        yield pa.RecordBatch.from_arrays(
+            [
+                batch.column("wiki_code"),
+                batch.column("article_title"),
+                page_id.cast(pa.int64()),
+                batch.column("views").cast(pa.int64()),
+            ],
+            schema=PAGEVIEW_SCHEMA,
+        )
 
 
-def append_to_parquet(df, language, output_dir):
+def aggregate_pageviews(bz2_file_path, wiki_codes_to_keep, conn, decompress_threads=1):
     """
-    Append DataFrame to a Parquet file specific to the language.
+    Aggregate a single .bz2 pageviews file with DuckDB, the columnar
+    counterpart of process_pageviews.
 
-    Parameters:
-        df (pd.DataFrame): DataFrame to append.
-        language (str): Wiki code/language.
-        output_dir (str): Directory to save Parquet files.
+    Returns:
+        duckdb.DuckDBPyRelation: wiki_code, article_title, the summed views
+        and the sorted distinct integer page_ids of every title, an empty
+        list when no row had a page id.
     """
-    file_path = os.path.join(output_dir, f"{language}_monthly_views.parquet")
-    if os.path.exists(file_path):
-        existing_df = pd.read_parquet(file_path)
-        combined_df = pd.concat([existing_df, df], ignore_index=True)
-        combined_df.to_parquet(file_path)
-    else:
-        df.to_parquet(file_path)
+    batches = pa.RecordBatchReader.from_batches(
+        PAGEVIEW_SCHEMA,
+        iter_pageview_batches(
+            bz2_file_path, wiki_codes_to_keep, decompress_threads=decompress_threads
+        ),
+    )
+    conn.register("pageview_batches", batches)
+    return conn.sql(
+        """
+        SELECT
+            wiki_code,
+            article_title,
+            CAST(SUM(views) AS BIGINT) AS views,
+            COALESCE(
+                list(DISTINCT page_id ORDER BY page_id) FILTER (WHERE page_id IS NOT NULL),
+                []
+            ) AS page_ids
+        FROM pageview_batches
+        GROUP BY wiki_code, article_title
+        """
+    )
 
 
-def process_batch(batch, bz2_files):
+def process_file(
+    bz2_file_path, wiki_codes, decompress_threads=1, duckdb_threads=DUCKDB_THREADS
+):
     """
-    Process a batch of wiki codes for all .bz2 files.
+    Aggregate one .bz2 pageviews file for all wiki codes in a single pass and
+    write the rows of each language as the file's part in the dataset.
 
     Parameters:
-        batch (list): List of wiki codes to process in this batch.
-        bz2_files (list): List of .bz2 file paths to process.
+        bz2_file_path (str): Path to the .bz2 file.
+        wiki_codes (list): List of wiki codes to process.
+        decompress_threads (int): Threads decompressing the bz2 blocks.
+        duckdb_threads (int): Threads of the DuckDB aggregation.
+
+    Returns:
+        list: The languages that had rows in the file.
     """
-    for bz2_file_path in bz2_files:
-        print(f"Processing file: {bz2_file_path} for batch: {batch}")
-        monthly_stats = process_pageviews(bz2_file_path, batch)
-        df = monthly_stats_to_df(monthly_stats)
+    print(f"Processing file: {bz2_file_path}")
+    month = file_month(bz2_file_path)
+    tmp_dir = os.path.join(TMP_DIR, os.path.basename(bz2_file_path))
+    conn = duckdb.connect()
+    conn.execute(f"SET threads = {duckdb_threads}")
+    conn.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    conn.execute(f"SET temp_directory = '{tmp_dir}'")
+    aggregate_pageviews(bz2_file_path, wiki_codes, conn, decompress_threads).create(
+        "monthly_views"
+    )
 
-        for language in batch:
-            language_df = df[df["wiki_code"] == language]
-            if not language_df.empty:
-                append_to_parquet(language_df, language, OUTPUT_DIR)
-                print(
-                    f"Appended data for {language} to {language}_monthly_views.parquet"
-                )
+    languages = []
+    for (language,) in conn.execute(
+        "SELECT DISTINCT wiki_code FROM monthly_views ORDER BY wiki_code"
+    ).fetchall():
+        write_part(
+            conn,
+            f"SELECT * FROM monthly_views WHERE wiki_code = '{language}'",
+            DATASET_DIR,
+            language,
+            month,
+            bz2_file_path,
+        )
+        languages.append(language)
+    conn.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"Finished file: {bz2_file_path}, languages: {languages}")
+    return languages
 
 
 def main():
     """
-    Main function to process all .bz2 pageview files and aggregate data in batches.
+    Main function to process the new or changed .bz2 pageview files, one
+    pass per file spread over a process pool, into the partitioned pageviews
+    dataset. Files in the dataset manifest are skipped.
     """
-    bz2_files = [
+    bz2_files = sorted(
         os.path.join(DATA_DIR, f)
         for f in os.listdir(DATA_DIR)
         if f.endswith("-user.bz2")
-    ]
+    )
+
+    os.makedirs(DATASET_DIR, exist_ok=True)
+    pending = pending_files(DATASET_DIR, bz2_files, WIKI_CODES)
+    print(f"{len(pending)} of {len(bz2_files)} files to process")
+
+    # Every file gets an equal share of the cores, a single new month all of
+    # them. DuckDB aggregates with up to DUCKDB_THREADS of the share and the
+    # rest decompress the bz2 blocks, so the two never oversubscribe the cores
+    num_processes = max(1, min(NUM_PROCESSES, len(pending)))
+    cores_per_file = max(1, os.cpu_count() // num_processes)
+    duckdb_threads = max(1, min(DUCKDB_THREADS, cores_per_file // 2))
+    decompress_threads = max(1, cores_per_file - duckdb_threads)
 
-    for batch_num, batch in enumerate(WIKI_CODES_BATCHES, 1):
-        print(f"Processing batch {batch_num} of {len(WIKI_CODES_BATCHES)}")
-        process_batch(batch, bz2_files)
+    languages = set()
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = {
+            executor.submit(
+                process_file,
+                bz2_file_path,
+                WIKI_CODES,
+                decompress_threads,
+                duckdb_threads,
+            ): bz2_file_path
+            for bz2_file_path in pending
+        }
+        for future in as_completed(futures):
+            file_languages = future.result()
+            record_processed(DATASET_DIR, futures[future], WIKI_CODES, file_languages)
+            languages.update(file_languages)
 
-    print("Processing complete.")
+    print(f"Processing complete, languages: {sorted(languages)}")
+    print(f"Dataset: {DATASET_DIR}, see pageviews_dataset.py to compact and read it")
 
 
 if __name__ == "__main__":
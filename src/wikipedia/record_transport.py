@@ -0,0 +1,119 @@
+"""
+Columnar transport of article rows between the dump workers and the shard writers.
+
+Workers encode the rows of a whole batch of blocks into one Arrow IPC payload,
+and the queue between them and the writers is bounded by payload bytes
+rather than by message count.
+"""
+import json
+import multiprocessing
+
+import pyarrow as pa
+
+ARTICLE_SCHEMA = pa.schema(
+    [
+        ("page_id", pa.int64()),
+        ("title", pa.string()),
+        ("url", pa.string()),
+        ("word_count", pa.int64()),
+        ("outlink_count", pa.int64()),
+        ("category_count", pa.int64()),
+        ("categories", pa.string()),
+        ("template_count", pa.int64()),
+        ("external_link_count", pa.int64()),
+        ("last_modified", pa.string()),
+        ("processed_text", pa.string()),
+        # Link graph, normalized wikilink targets of articles and the target
+        # of redirect rows (EMIT_LINKS)
+        ("link_titles", pa.list_(pa.string())),
+        ("redirect_title", pa.string()),
+        # Incremental refresh, the page is unchanged and only page_id is set
+        ("unchanged", pa.bool_()),
+    ]
+)
+
+
+def rows_to_payload(
+    rows, block_offsets, unchanged_page_ids=(), dump_name="", schema=ARTICLE_SCHEMA
+):
+    """
+    Encode a list of row tuples as a single Arrow IPC stream.
+
+    block_offsets are the stream offsets of the blocks the rows came from,
+    they travel in the schema metadata so the writer can journal them
+    together with the rows, even when a block produced no rows. dump_name
+    tells the writer which dump the blocks belong to.
+
+    unchanged_page_ids are added as rows with only page_id set and unchanged true.
+    """
+    schema = schema.with_metadata(
+        {"block_offsets": json.dumps(block_offsets), "dump_name": dump_name}
+    )
+    n_unchanged = len(unchanged_page_ids)
+    # Row tuples hold every column but the trailing unchanged flag
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in range(len(schema) - 1)]
+    columns[0].extend(unchanged_page_ids)
+    for column in columns[1:]:
+        column.extend([None] * n_unchanged)
+    columns.append([False] * len(rows) + [True] * n_unchanged)
+    batch = pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def payload_to_table(payload):
+    """
+    Decode an Arrow IPC payload back into a pyarrow Table, its block offsets
+    and its dump name.
+    """
+    table = pa.ipc.open_stream(payload).read_all()
+    metadata = table.schema.metadata
+    block_offsets = json.loads(metadata[b"block_offsets"])
+    return table, block_offsets, metadata[b"dump_name"].decode()
+
+
+class ByteBudgetQueue:
+    """
+    multiprocessing.Queue bounded by the bytes of the payloads in flight.
+
+    put blocks while adding the payload would exceed max_bytes, a payload
+    larger than the whole budget is still let through once the queue is empty.
+    Anything that is not bytes (e.g. a sentinel) does not count against the budget.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._queue = multiprocessing.Queue()
+        self._condition = multiprocessing.Condition()
+        self._bytes_in_flight = multiprocessing.Value("q", 0, lock=False)
+
+    @staticmethod
+    def _payload_size(payload):
+        return len(payload) if isinstance(payload, bytes) else 0
+
+    def put(self, payload):
+        size = self._payload_size(payload)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._bytes_in_flight.value == 0
+                or self._bytes_in_flight.value + size <= self.max_bytes
+            )
+            self._bytes_in_flight.value += size
+        self._queue.put(payload)
+
+    def get(self):
+        payload = self._queue.get()
+        size = self._payload_size(payload)
+        if size:
+            with self._condition:
+                self._bytes_in_flight.value -= size
+                self._condition.notify_all()
+        return payload
+
+    def bytes_in_flight(self):
+        return self._bytes_in_flight.value
@@ -0,0 +1,147 @@
+"""
+Selection of the articles to embed: the top articles by pageviews with their
+metadata and text, replacing the final filtering notebooks (05_*).
+
+Everything runs in DuckDB on the language database. The ranking comes from
+the pageview_importance table (pageview_importance.py), articles are matched
+on their title_match column, computed and indexed once at ingestion, and the
+text is only read from the text store for the selected articles. The result
+is streamed to a Parquet file or as Arrow batches, so selecting 500k English
+articles does not need the articles in memory.
+
+    conn = connect(DATABASE_FILE)
+    selection = select_articles(conn, "en", 50_000)
+    for batch in iter_selected_batches(selection):
+        ...
+
+Usage:
+    python select_articles.py <database_file> <language> <n_articles> <output_file> [pageviews_dataset_dir]
+"""
+import sys
+import time
+
+import duckdb
+
+from article_store import materialize_text
+from dump_index import has_table
+from pageview_importance import IMPORTANCE_TABLE, update_pageview_importance
+
+# Top titles by pageviews considered, more than are selected since some
+# have no article or too few words
+VIEW_LIMIT = 700_000
+
+# Articles with at most this many words are left out
+MIN_WORD_COUNT = 50
+
+# Ranking column of pageview_importance, the recency weighted score or the
+# plain total_views of the notebooks
+RANK_BY = "score"
+
+# DuckDB spills the joins and sorts beyond this limit
+MEMORY_LIMIT = "4GB"
+
+OUTPUT_BATCH_ROWS = 10_000
+
+URL_TEMPLATE = "https://{language}.wikipedia.org/w/index.php?curid="
+
+
+def connect(database_file, memory_limit=MEMORY_LIMIT):
+    conn = duckdb.connect(database_file)
+    conn.execute(f"SET memory_limit = '{memory_limit}'")
+    return conn
+
+
+def selection_sql(language, n_articles, view_limit=VIEW_LIMIT,
+                  min_word_count=MIN_WORD_COUNT, rank_by=RANK_BY):
+    """
+    SQL of the selected articles (metadata only) in the order of rank_by.
+
+    The view_limit top titles by pageviews are joined with the articles on
+    title_match, a title matching several articles keeps the longest one,
+    as in the notebooks. views_percentile is computed over all matched
+    articles before the word count filter.
+    """
+    if rank_by == "score":
+        # The table is stored in score_rank order
+        top_pageviews = f"WHERE score_rank <= {int(view_limit)}"
+    elif rank_by == "total_views":
+        top_pageviews = f"ORDER BY total_views DESC LIMIT {int(view_limit)}"
+    else:
+        raise ValueError(f"Unknown ranking {rank_by}")
+    url_prefix = URL_TEMPLATE.format(language=language)
+    return f"""
+        WITH top_pageviews AS (
+            SELECT title_match, total_views, score
+            FROM {IMPORTANCE_TABLE}
+            {top_pageviews}
+        ),
+        ranked_articles AS (
+            SELECT
+                a.*,
+                p.total_views,
+                p.score,
+                '{url_prefix}' || a.page_id AS url_pageviews,
+                PERCENT_RANK() OVER (ORDER BY p.{rank_by} DESC) AS views_percentile,
+                ROW_NUMBER() OVER (PARTITION BY a.title_match ORDER BY a.word_count DESC) AS rn
+            FROM articles a
+            JOIN top_pageviews p USING (title_match)
+        )
+        SELECT
+            * EXCLUDE (rn),
+            ROW_NUMBER() OVER (ORDER BY {rank_by} DESC, page_id) AS selection_rank
+        FROM ranked_articles
+        WHERE rn = 1 AND word_count > {int(min_word_count)}
+        ORDER BY selection_rank
+        LIMIT {int(n_articles)}
+    """
+
+
+def select_articles(conn, language, n_articles, view_limit=VIEW_LIMIT,
+                    min_word_count=MIN_WORD_COUNT, rank_by=RANK_BY, with_text=True):
+    """
+    Return the n_articles selected articles as a DuckDB relation ordered by
+    selection_rank, with their processed_text unless with_text is False.
+    """
+    if not has_table(conn, IMPORTANCE_TABLE):
+        raise ValueError(
+            f"No {IMPORTANCE_TABLE} table, build it with pageview_importance.py first"
+        )
+    query = selection_sql(language, n_articles, view_limit, min_word_count, rank_by)
+    if not with_text:
+        return conn.sql(query)
+    return materialize_text(conn, query).order("selection_rank")
+
+
+def iter_selected_batches(selection, batch_rows=OUTPUT_BATCH_ROWS):
+    """
+    Yield the rows of a selection as Arrow record batches of batch_rows.
+    """
+    reader = selection.fetch_record_batch(batch_rows)
+    yield from reader
+
+
+def write_selection(selection, output_file):
+    """
+    Stream a selection to a zstd compressed Parquet file.
+    """
+    selection.write_parquet(output_file, compression="zstd")
+
+
+def main():
+    database_file, language, n_articles, output_file = sys.argv[1:5]
+    if len(sys.argv) > 5:
+        update_pageview_importance(database_file, sys.argv[5], f"{language}.wikipedia")
+
+    start = time.perf_counter()
+    conn = connect(database_file)
+    write_selection(select_articles(conn, language, int(n_articles)), output_file)
+    count = conn.execute(f"SELECT COUNT(*) FROM read_parquet('{output_file}')").fetchone()[0]
+    conn.close()
+    print(
+        f"Wrote {count} selected articles to {output_file}"
+        f" in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
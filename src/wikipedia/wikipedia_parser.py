@@ -1,13 +1,18 @@
 import xml.etree.ElementTree as ET
-import wikitextparser as wtp
 from collections import Counter
 import pandas as pd
 from urllib.parse import quote
 
+from wikitext_fast import parse_wikitext
+
+# Wikitext parser, "wtp" (wikitextparser) or "fast" (single pass tokenizer in wikitext_fast.py)
+WIKITEXT_PARSER = "wtp"
+
 
 class WikiXMLHandler:
-    def __init__(self, max_pages=None):
+    def __init__(self, max_pages=None, wikitext_parser=WIKITEXT_PARSER):
         self.current_page = {}
+        self.wikitext_parser = wikitext_parser
         self.pages_processed = 0
         self.max_pages = max_pages
         self.page_count = Counter()
@@ -30,19 +35,16 @@ class WikiXMLHandler:
             timestamp = elem.findtext(".//{*}timestamp")
 
             if text and not text.lower().startswith("#redirect"):
-                parsed = wtp.parse(text)
+                parsed = parse_wikitext(text, parser=self.wikitext_parser)
 
-                plain_text = parsed.plain_text()
+                plain_text = parsed.plain_text
                 word_count = len(plain_text.split())
-                outlinks = parsed.wikilinks
-                outlink_count = len(outlinks)
+                outlink_count = len(parsed.wikilink_titles)
                 categories = [
-                    link.title.strip()
-                    for link in outlinks
-                    if link.title.startswith("Category:")
+                    link_title.strip()
+                    for link_title in parsed.wikilink_titles
+                    if link_title.startswith("Category:")
                 ]
-                templates = parsed.templates
-                external_links = parsed.external_links
 
                 # Generate URL
                 url = f"https://is.wikipedia.org/wiki/{quote(title.replace(' ', '_'))}"
@@ -56,8 +58,8 @@ class WikiXMLHandler:
                         "outlink_count": outlink_count,
                         "category_count": len(categories),
                         "categories": "|".join(categories),
-                        "template_count": len(templates),
-                        "external_link_count": len(external_links),
+                        "template_count": len(parsed.template_names),
+                        "external_link_count": parsed.external_link_count,
                         "last_modified": timestamp,
                         "processed_text": plain_text,  # This is the text we'll use for embedding
                         "raw_text": text,  # Original wikitext, in case we need it later
@@ -77,8 +79,8 @@ class WikiXMLHandler:
                 )
 
 
-def process_wikipedia_dump(file_path, max_pages=None):
-    handler = WikiXMLHandler(max_pages)
+def process_wikipedia_dump(file_path, max_pages=None, wikitext_parser=WIKITEXT_PARSER):
+    handler = WikiXMLHandler(max_pages, wikitext_parser)
     handler.parse(file_path)
 
     print(f"Total pages processed: {handler.pages_processed}")
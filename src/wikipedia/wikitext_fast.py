@@ -0,0 +1,331 @@
+"""
+Lightweight wikitext extraction, a fast alternative to wikitextparser.
+
+fast_parse makes one tokenizing pass over the wikitext and returns the plain
+text, the wikilink titles, the template names and the external link count
+that build_article_row needs. The plain text follows the conventions of
+wtp.parse(text).plain_text(): templates, parser functions, comments, file
+links and markup are dropped, link labels, tag contents and table cells are
+kept. It is an approximation, wikitext_parity.py measures how close it is.
+
+parse_wikitext returns the same FastParse from either parser, selected by
+name ("wtp" or "fast").
+"""
+import html
+import re
+
+import wikitextparser as wtp
+from collections import namedtuple
+
+FastParse = namedtuple(
+    "FastParse",
+    ["plain_text", "wikilink_titles", "template_names", "external_link_count"],
+)
+
+# Magic words that wikitextparser parses as parser functions, not templates
+PARSER_FUNCTION_NAMES = {
+    "lc", "uc", "lcfirst", "ucfirst", "formatnum", "fullurl", "localurl",
+    "canonicalurl", "urlencode", "anchorencode", "ns", "nse", "int", "padleft",
+    "padright", "plural", "grammar", "gender", "tag", "filepath", "language",
+    "special", "speciale", "bidi", "msgnw", "raw",
+}
+
+MAGIC_VARIABLES = {
+    "PAGENAME", "PAGENAMEE", "FULLPAGENAME", "FULLPAGENAMEE", "BASEPAGENAME",
+    "SUBPAGENAME", "ROOTPAGENAME", "TALKPAGENAME", "NAMESPACE", "NAMESPACENUMBER",
+    "SITENAME", "SERVER", "SERVERNAME", "SCRIPTPATH", "CURRENTYEAR",
+    "CURRENTMONTH", "CURRENTMONTHNAME", "CURRENTDAY", "CURRENTDAY2",
+    "CURRENTDAYNAME", "CURRENTTIME", "CURRENTHOUR", "CURRENTWEEK",
+    "CURRENTTIMESTAMP", "LOCALYEAR", "LOCALMONTH", "LOCALDAY", "LOCALTIME",
+    "NUMBEROFARTICLES", "NUMBEROFPAGES", "NUMBEROFFILES", "NUMBEROFEDITS",
+    "NUMBEROFUSERS", "NUMBEROFADMINS", "NUMBEROFACTIVEUSERS", "REVISIONID",
+    "REVISIONDAY", "REVISIONMONTH", "REVISIONYEAR", "REVISIONTIMESTAMP",
+    "REVISIONUSER", "PAGEID", "CONTENTLANGUAGE", "DIRECTIONMARK",
+}
+
+# Extensions of the file links wikitextparser drops from the plain text,
+# whatever the namespace prefix (File:, Mynd:, Skrá:, ...), after MediaWiki's
+# MimeAnalyzer
+FILE_EXTENSIONS = {
+    "bmp", "djvu", "gif", "iff", "jb2", "jp2", "jpc", "jpeg", "jpg", "jpx",
+    "mid", "mka", "mkv", "mp3", "oga", "ogg", "ogv", "ogx", "opus", "pdf",
+    "png", "psd", "spx", "stl", "svg", "swc", "swf", "tif", "tiff", "wbmp",
+    "webm", "webp", "wmf", "xbm", "xcf",
+}
+
+# Tags whose content is kept verbatim instead of being parsed
+RAW_CONTENT_TAGS = {"nowiki", "pre", "math", "syntaxhighlight", "source", "gallery", "chem"}
+
+RAW_CONTENT_CLOSE_RES = {
+    name: re.compile(r"</" + name + r"\s*>", re.IGNORECASE) for name in RAW_CONTENT_TAGS
+}
+
+URL_RE = r"(?:https?|ftp)://[^\s<>\[\]{}|\"]+"
+
+TOKEN_RE = re.compile(
+    r"(?P<comment><!--)"
+    r"|(?P<braces>\{\{)"
+    r"|(?P<link>\[\[)"
+    r"|(?P<ext_link>\[(?=(?:https?|ftp)://|//))"
+    r"|(?P<tag><(?P<closing>/?)(?P<tag_name>[a-zA-Z][a-zA-Z0-9]*)\b[^<>]*?(?P<self_closing>/?)>)"
+    r"|(?P<quotes>'{2,})"
+    r"|(?P<url>" + URL_RE + r")"
+    r"|(?P<table_line>^[ \t]*(?:\{\||\|\}|\|-|\|\+|\||!)[^\n]*)",
+    re.MULTILINE,
+)
+
+BRACE_RE = re.compile(r"[{}]")
+LINK_BRACKET_RE = re.compile(r"\[\[|\]\]")
+NESTING_RE = {
+    separator: re.compile(r"\{\{|\}\}|\[\[|\]\]|" + re.escape(separator))
+    for separator in ("|", "||", "!!")
+}
+
+
+def _match_links(text, start):
+    """
+    Return the position after the ]] closing the [[ at start, or -1.
+    """
+    depth = 0
+    for match in LINK_BRACKET_RE.finditer(text, start):
+        if match.group() == "[[":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return -1
+
+
+def _match_braces(text, start):
+    """
+    Return the position after the braces closing the {{ or {{{ at start, or -1.
+
+    Single braces are counted so {{{param}}} nested in {{template}} balances.
+    """
+    depth = 0
+    for match in BRACE_RE.finditer(text, start):
+        if match.group() == "{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return -1
+
+
+def _split_top_level(text, separator="|"):
+    """
+    Split on separator outside of nested {{ }} and [[ ]].
+    """
+    parts = []
+    depth = 0
+    last = 0
+    for match in NESTING_RE[separator].finditer(text):
+        token = match.group()
+        if token in ("{{", "[["):
+            depth += 1
+        elif token in ("}}", "]]"):
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            parts.append(text[last : match.start()])
+            last = match.end()
+    parts.append(text[last:])
+    return parts
+
+
+def _is_file_link(title):
+    """
+    A link to a file like wtp sees it: a prefixed title with a known file
+    extension, not escaped with a leading colon.
+    """
+    return title[:1] != ":" and title.partition(":")[2].rpartition(".")[2] in FILE_EXTENSIONS
+
+
+def _is_parser_function(name):
+    name = name.strip()
+    if name.startswith("#"):
+        return True
+    prefix, colon, _ = name.partition(":")
+    if colon:
+        return prefix.lower() in PARSER_FUNCTION_NAMES or (
+            prefix.isupper() and prefix.isalpha()
+        )
+    return name in MAGIC_VARIABLES
+
+
+class _Tokenizer:
+    def __init__(self):
+        self.wikilink_titles = []
+        self.template_names = []
+        self.external_link_count = 0
+        self.table_depth = 0
+
+    def scan(self, text, out):
+        """
+        Scan text, append plain text pieces to out and record links and templates.
+        out is None to only record the links and templates, e.g. inside templates.
+        """
+        pos = 0
+        while True:
+            match = TOKEN_RE.search(text, pos)
+            if match is None:
+                if out is not None:
+                    out.append(text[pos:])
+                return
+            if out is not None:
+                out.append(text[pos : match.start()])
+            pos = getattr(self, "_" + match.lastgroup)(text, match, out)
+
+    def _comment(self, text, match, out):
+        end = text.find("-->", match.end())
+        return len(text) if end == -1 else end + 3
+
+    def _braces(self, text, match, out):
+        end = _match_braces(text, match.start())
+        if end == -1:
+            if out is not None:
+                out.append(match.group())
+            return match.end()
+
+        if text.startswith("{{{", match.start()) and text.startswith("}}}", end - 3):
+            # Template parameter, only its default value is plain text
+            parts = _split_top_level(text[match.start() + 3 : end - 3])
+            self.scan(parts[0], None)
+            if len(parts) > 1:
+                self.scan("|".join(parts[1:]), out)
+            return end
+
+        inner = text[match.start() + 2 : end - 2]
+        name = _split_top_level(inner)[0]
+        if not _is_parser_function(name):
+            self.template_names.append(name)
+        self.scan(inner, None)
+        return end
+
+    def _link(self, text, match, out):
+        end = _match_links(text, match.start())
+        if end == -1:
+            if out is not None:
+                out.append(match.group())
+            return match.end()
+
+        inner = text[match.start() + 2 : end - 2]
+        target, pipe, label = inner.partition("|")
+        title = target.partition("#")[0]
+        self.wikilink_titles.append(title)
+        if _is_file_link(title):
+            # File links are dropped, links in their captions still count
+            self.scan(label, None)
+        elif pipe:
+            self.scan(label, out)
+        elif out is not None:
+            out.append(target)
+        return end
+
+    def _ext_link(self, text, match, out):
+        end = text.find("]", match.end())
+        if end == -1:
+            if out is not None:
+                out.append(match.group())
+            return match.end()
+        self.external_link_count += 1
+        _, _, label = text[match.end() : end].partition(" ")
+        self.scan(label, out)
+        return end + 1
+
+    def _tag(self, text, match, out):
+        name = match.group("tag_name").lower()
+        if (
+            name in RAW_CONTENT_TAGS
+            and not match.group("closing")
+            and not match.group("self_closing")
+        ):
+            close = RAW_CONTENT_CLOSE_RES[name].search(text, match.end())
+            if close is not None:
+                if out is not None:
+                    out.append(text[match.end() : close.start()])
+                return close.end()
+        # Any other tag is dropped and its content is scanned as usual
+        return match.end()
+
+    def _quotes(self, text, match, out):
+        quotes = match.group()
+        # '''' is an apostrophe followed by bold, more than five is
+        # apostrophes followed by bold italic
+        if out is not None and len(quotes) == 4:
+            out.append("'")
+        elif out is not None and len(quotes) > 5:
+            out.append("'" * (len(quotes) - 5))
+        return match.end()
+
+    def _url(self, text, match, out):
+        self.external_link_count += 1
+        if out is not None:
+            out.append(match.group())
+        return match.end()
+
+    def _table_line(self, text, match, out):
+        line = match.group().lstrip(" \t")
+        if line.startswith("{|"):
+            self.table_depth += 1
+            return match.end()
+        if self.table_depth == 0:
+            # A pipe at the start of a line outside of a table is plain text
+            if out is not None:
+                out.append(match.group()[: len(match.group()) - len(line) + 1])
+            return match.start() + len(match.group()) - len(line) + 1
+        if line.startswith("|}"):
+            self.table_depth -= 1
+            return match.end()
+        if line.startswith("|-"):
+            return match.end()
+
+        if line.startswith("|+"):
+            cells = [line[2:]]
+        else:
+            cells = _split_top_level(line[1:], "!!" if line[0] == "!" else "||")
+        for i, cell in enumerate(cells):
+            # Drop cell attributes, "style=... | content"
+            parts = _split_top_level(cell)
+            content = parts[-1] if len(parts) > 1 else cell
+            if out is not None and i > 0:
+                out.append("\t")
+            self.scan(content.strip() if not line.startswith("|+") else content, out)
+        return match.end()
+
+
+def fast_parse(text):
+    """
+    Tokenize wikitext once and return a FastParse with the plain text,
+    the wikilink titles, the template names and the external link count.
+    """
+    tokenizer = _Tokenizer()
+    out = []
+    tokenizer.scan(text, out)
+    return FastParse(
+        plain_text=html.unescape("".join(out)),
+        wikilink_titles=tokenizer.wikilink_titles,
+        template_names=tokenizer.template_names,
+        external_link_count=tokenizer.external_link_count,
+    )
+
+
+def parse_wikitext(text, parser="wtp"):
+    """
+    Parse wikitext into a FastParse with the plain text, wikilink titles,
+    template names and external link count.
+
+    parser is "wtp" for wikitextparser or "fast" for the single pass
+    tokenizer fast_parse.
+    """
+    if parser == "fast":
+        return fast_parse(text)
+
+    parsed = wtp.parse(text)
+    return FastParse(
+        plain_text=parsed.plain_text(),
+        wikilink_titles=[link.title for link in parsed.wikilinks],
+        template_names=[template.name for template in parsed.templates],
+        external_link_count=len(parsed.external_links),
+    )
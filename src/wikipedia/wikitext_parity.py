@@ -0,0 +1,181 @@
+"""
+Golden-file parity harness for the fast wikitext tokenizer.
+
+"golden" samples main namespace articles spread over a multistream dump and
+stores their wikitext together with the wikitextparser output as JSON lines.
+"check" runs the fast tokenizer on the stored wikitext, reports how often
+each field agrees with the golden output and the pages per second per core
+of both parsers. "fixtures" compares both parsers on FIXTURE_PAGES, small
+pages with the markup of non-English wikis (localized file namespaces), and
+check runs them too.
+
+Usage:
+    python wikitext_parity.py golden <dump_file> <index_file> <golden_file> [n_pages]
+    python wikitext_parity.py check <golden_file>
+    python wikitext_parity.py fixtures
+"""
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import multiprocess_large_wiki_dump as dump
+from page_extractor import iter_article_pages
+from wikitext_fast import parse_wikitext
+
+# Pages both parsers must agree on, file links are recognized by extension
+# in every namespace language
+FIXTURE_PAGES = [
+    "a [[Mynd:Foo.jpg|thumb|200px|x y]] b",
+    "a [[Skrá:Kort.svg|thumb|left|Kort af [[Ísland|Íslandi]]]] b",
+    "a [[Mynd:Foo.jpg#s|x]] b",
+    "a [[:Mynd:Foo.jpg|x]] b",
+    "a [[Mynd:Foo|x]] b",
+    "a [[Datei:Berlin.png|mini|Berlin]] b",
+    "a [[Fil:Oslo.JPEG|Oslo]] b",
+    "a [[Flokkur:Íslensk fjöll]] b",
+    "'''Reykjavík''' er [[höfuðborg]] [[Ísland]]s.[[Mynd:Reykjavik.jpg|thumb|Reykjavík]]",
+]
+
+
+def write_golden(dump_file, index_file, golden_file, n_pages=1000, pages_per_block=5):
+    """
+    Write the wtp output of n_pages articles, taken from blocks spread evenly over the dump.
+    """
+    offsets = dump.get_offsets(index_file)
+    block_ranges = dump.get_block_ranges(offsets, os.path.getsize(dump_file))
+    n_blocks = max(n_pages // pages_per_block, 1)
+    step = max(len(block_ranges) // n_blocks, 1)
+
+    written = 0
+    with open(dump_file, "rb") as f, open(golden_file, "w", encoding="utf-8") as out:
+        for start, end in block_ranges[::step]:
+            f.seek(start)
+            xml_data = dump.decompress_block(f.read(end - start))
+            for page in list(iter_article_pages(xml_data))[:pages_per_block]:
+                text = page.get("text", "")
+                if not text or text.lower().startswith("#redirect"):
+                    continue
+                parsed = parse_wikitext(text, parser="wtp")
+                record = {"page_id": page["id"], "title": page["title"], "text": text}
+                record.update(parsed._asdict())
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                written += 1
+                if written >= n_pages:
+                    print(f"Wrote {written} golden pages to {golden_file}")
+                    return
+    print(f"Wrote {written} golden pages to {golden_file}")
+
+
+def read_golden(golden_file):
+    with open(golden_file, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def categories(link_titles):
+    return [title.strip() for title in link_titles if title.startswith("Category:")]
+
+
+def is_disambiguation(template_names):
+    return any(name.strip().lower() == "disambiguation" for name in template_names)
+
+
+def word_overlap(expected_words, words):
+    """
+    Multiset overlap of two word lists, 1.0 when they hold the same words.
+    """
+    expected, actual = Counter(expected_words), Counter(words)
+    union = sum((expected | actual).values())
+    return sum((expected & actual).values()) / union if union else 1.0
+
+
+def compare(record, parsed):
+    """
+    Compare a FastParse against a golden record, field by field.
+    """
+    expected_words = record["plain_text"].split()
+    words = parsed.plain_text.split()
+    return {
+        "plain_text words identical": expected_words == words,
+        "plain_text word overlap": word_overlap(expected_words, words),
+        "word_count within 2%": abs(len(words) - len(expected_words))
+        <= 0.02 * max(len(expected_words), 1),
+        "outlink_count": len(parsed.wikilink_titles) == len(record["wikilink_titles"]),
+        "categories": categories(parsed.wikilink_titles)
+        == categories(record["wikilink_titles"]),
+        "template_count": len(parsed.template_names) == len(record["template_names"]),
+        "is_disambiguation": is_disambiguation(parsed.template_names)
+        == is_disambiguation(record["template_names"]),
+        "external_link_count": parsed.external_link_count
+        == record["external_link_count"],
+    }
+
+
+def pages_per_second(texts, parser):
+    start = time.perf_counter()
+    for text in texts:
+        parse_wikitext(text, parser=parser)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def check_fixtures():
+    """
+    Compare both parsers on FIXTURE_PAGES, returns the number of pages on
+    which they disagree.
+    """
+    mismatches = 0
+    for text in FIXTURE_PAGES:
+        expected = parse_wikitext(text, parser="wtp")
+        result = compare(expected._asdict(), parse_wikitext(text, parser="fast"))
+        failed = [field for field, value in result.items() if value is not True and value != 1.0]
+        if failed:
+            mismatches += 1
+            print(f"Fixture mismatch {failed}: {text!r}")
+    print(f"Fixtures: {mismatches} of {len(FIXTURE_PAGES)} pages differ")
+    return mismatches
+
+
+def check_golden(golden_file):
+    """
+    Print the agreement of the fast tokenizer with the golden file and the
+    single core throughput of both parsers.
+    """
+    records = read_golden(golden_file)
+    totals = Counter()
+    worst = []
+    for record in records:
+        result = compare(record, parse_wikitext(record["text"], parser="fast"))
+        totals.update({field: float(value) for field, value in result.items()})
+        worst.append((result["plain_text word overlap"], record["title"]))
+
+    print(f"Compared {len(records)} pages")
+    for field, total in totals.items():
+        print(f"{field:>28}: {total / len(records):7.2%}")
+    print("Lowest word overlap:")
+    for overlap, title in sorted(worst)[:5]:
+        print(f"  {overlap:7.2%} {title}")
+
+    texts = [record["text"] for record in records]
+    wtp_rate = pages_per_second(texts, "wtp")
+    fast_rate = pages_per_second(texts, "fast")
+    print(f"wtp:  {wtp_rate:8.1f} pages/s per core")
+    print(f"fast: {fast_rate:8.1f} pages/s per core ({fast_rate / wtp_rate:.1f}x)")
+    check_fixtures()
+
+
+def main():
+    command = sys.argv[1]
+    if command == "golden":
+        n_pages = int(sys.argv[5]) if len(sys.argv) > 5 else 1000
+        write_golden(sys.argv[2], sys.argv[3], sys.argv[4], n_pages)
+    elif command == "check":
+        check_golden(sys.argv[2])
+    elif command == "fixtures":
+        check_fixtures()
+    else:
+        print(__doc__)
+
+
+if __name__ == "__main__":
+    main()